@@ -0,0 +1,92 @@
+"""
+Microbenchmarks for route graph analysis.
+
+Run from the project root with the package installed, eg
+
+    python benchmarks/graph.py
+"""
+import random
+import timeit
+
+from nextbus.graph import Graph, _rearrange_cycles
+
+
+def route_edges(components, length, branches, circulars, seed=0):
+    """ Creates edges for a number of separate route-like graphs, each a main
+        path with branches rejoining it and circulars returning to the start.
+    """
+    rng = random.Random(seed)
+    edges = []
+    for c in range(components):
+        offset = c * length * (1 + branches + circulars)
+        main = list(range(offset, offset + length))
+        edges.extend(zip(main, main[1:]))
+        new = offset + length
+        for i in range(branches + circulars):
+            start = rng.randrange(length // 2)
+            if i < circulars:
+                end = start
+            else:
+                end = rng.randrange(start + 1, length)
+            branch = [main[start], *range(new, new + length // 4), main[end]]
+            edges.extend(zip(branch, branch[1:]))
+            new += length // 4
+
+    return edges
+
+
+def bench(name, func, number):
+    """ Prints average time for a function call. """
+    total = timeit.timeit(func, number=number)
+    print(f"{name:<40} {1000 * total / number:10.3f} ms")
+
+
+def bench_split():
+    """ Graph.split() on graphs with thousands of edges. """
+    for components, length in [(10, 100), (50, 100), (100, 200)]:
+        graph = Graph(route_edges(components, length, 3, 2))
+        name = f"split: {components} graphs, {len(graph.edges)} edges"
+        bench(name, graph.split, 10)
+
+
+def bench_layout():
+    """ Analysing and drawing 80-stop routes with a few branch points. """
+    for branches, circulars in [(2, 0), (3, 1), (6, 2)]:
+        edges = route_edges(1, 80, branches, circulars)
+
+        def analyse():
+            Graph(edges).analyse()
+
+        def draw():
+            Graph(edges).draw()
+
+        name = f"{branches} branches, {circulars} circulars"
+        bench(f"analyse: {name}", analyse, 20)
+        bench(f"draw: {name}", draw, 20)
+
+
+def bench_cycles():
+    """ Rearranging sequences for graphs with many cycles. """
+    for vertices, edges in [(60, 150), (120, 300)]:
+        rng = random.Random(vertices)
+        pairs = {(rng.randrange(vertices), rng.randrange(vertices))
+                 for _ in range(edges)}
+        graph = Graph([(u, v) for u, v in pairs if u != v])
+        sequence = list(graph)
+        rng.shuffle(sequence)
+
+        def rearrange():
+            _rearrange_cycles(graph, list(sequence))
+
+        bench(f"rearrange: {vertices} vertices, {len(graph.edges)} edges",
+              rearrange, 5)
+
+
+def main():
+    bench_split()
+    bench_layout()
+    bench_cycles()
+
+
+if __name__ == "__main__":
+    main()
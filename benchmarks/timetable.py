@@ -0,0 +1,68 @@
+"""
+Microbenchmarks for creating timetables from query results.
+
+Run from the project root with the package installed, eg
+
+    python benchmarks/timetable.py
+"""
+import collections
+import datetime
+import random
+import timeit
+
+from nextbus.timetable import Timetable
+
+
+Row = collections.namedtuple("Row", [
+    "journey_id", "departure", "local_operator_code", "operator_code",
+    "operator_name", "note_code", "note_text", "stop_point_ref",
+    "timing_point", "utc_arrive", "utc_depart", "arrive", "depart"
+])
+
+
+def journey_rows(journeys, stops, seed=0):
+    """ Creates rows for a service running every few minutes over a day, with
+        some journeys starting or finishing part way along the route.
+    """
+    rng = random.Random(seed)
+    sequence = [f"stop{i:04d}" for i in range(stops)]
+    start = datetime.datetime(2019, 3, 3, 5, 0)
+    headway = datetime.timedelta(minutes=18 * 60 // journeys)
+    rows = []
+    for j in range(journeys):
+        first = rng.randrange(stops // 4) if rng.random() < 0.2 else 0
+        last = stops - rng.randrange(stops // 4) if rng.random() < 0.2 else stops
+        time = start + j * headway
+        for code in sequence[first:last]:
+            time += datetime.timedelta(minutes=rng.randint(1, 3))
+            rows.append(Row(j, start.time(), "OP", "OP", "Operator", None,
+                            None, code, True, time, time, None, None))
+
+    return sequence, rows
+
+
+def bench(name, func, number):
+    """ Prints average time for a function call. """
+    total = timeit.timeit(func, number=number)
+    print(f"{name:<40} {1000 * total / number:10.3f} ms")
+
+
+def bench_timetable():
+    """ Timetables for services with hundreds of journeys and stops. """
+    date = datetime.date(2019, 3, 3)
+    for journeys, stops in [(100, 50), (300, 100), (600, 150)]:
+        sequence, rows = journey_rows(journeys, stops)
+        dict_stops = {code: None for code in sequence}
+
+        def create():
+            Timetable(0, False, date, sequence, dict_stops, rows)
+
+        bench(f"timetable: {journeys} journeys, {stops} stops", create, 5)
+
+
+def main():
+    bench_timetable()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+add stop departure
+
+Revision ID: 2b9f4c6e1a83
+Revises: 8e3a1d7c52f0
+Create Date: 2026-10-16 17:02:13.540921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b9f4c6e1a83'
+down_revision = '8e3a1d7c52f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'stop_departure',
+        sa.Column('journey_ref', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('sequence', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('stop_point_ref', sa.VARCHAR(length=12), nullable=False),
+        sa.Column('time', sa.Time(), nullable=False),
+        sa.Column('t_offset', sa.Interval(), nullable=False),
+        sa.ForeignKeyConstraint(['journey_ref'], ['journey.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('journey_ref', 'sequence')
+    )
+    op.create_index('ix_stop_departure_stop_point_ref_time', 'stop_departure',
+                    ['stop_point_ref', 'time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_stop_departure_stop_point_ref_time',
+                  table_name='stop_departure')
+    op.drop_table('stop_departure')
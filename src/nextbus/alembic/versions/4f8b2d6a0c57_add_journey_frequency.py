@@ -0,0 +1,42 @@
+"""
+add journey frequency
+
+Revision ID: 4f8b2d6a0c57
+Revises: 9a7c3e5d1f24
+Create Date: 2026-10-16 21:04:38.915027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '4f8b2d6a0c57'
+down_revision = '9a7c3e5d1f24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'journey_frequency',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('pattern_ref', sa.Integer(), nullable=False),
+        sa.Column('time_start', sa.Time(), nullable=False),
+        sa.Column('time_end', sa.Time(), nullable=False),
+        sa.Column('headway', sa.Interval(), nullable=False),
+        sa.Column('journeys', postgresql.ARRAY(sa.Integer(), dimensions=1),
+                  nullable=False),
+        sa.ForeignKeyConstraint(['pattern_ref'], ['journey_pattern.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_journey_frequency_pattern_ref'),
+                    'journey_frequency', ['pattern_ref'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_journey_frequency_pattern_ref'),
+                  table_name='journey_frequency')
+    op.drop_table('journey_frequency')
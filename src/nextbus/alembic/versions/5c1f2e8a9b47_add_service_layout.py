@@ -0,0 +1,40 @@
+"""
+add service layout
+
+Revision ID: 5c1f2e8a9b47
+Revises: d0ccaf403024
+Create Date: 2026-10-16 10:12:31.402177
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f2e8a9b47'
+down_revision = 'd0ccaf403024'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'service_layout',
+        sa.Column('service_ref', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('direction', sa.Boolean(), nullable=False),
+        sa.Column('sequence', postgresql.ARRAY(sa.Text(), dimensions=1),
+                  nullable=False),
+        sa.Column('paths', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=False),
+        sa.Column('layout', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=True),
+        sa.ForeignKeyConstraint(['service_ref'], ['service.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('service_ref', 'direction')
+    )
+
+
+def downgrade():
+    op.drop_table('service_layout')
@@ -0,0 +1,96 @@
+"""
+journey data arrays
+
+Revision ID: 6d4e0b7f93c2
+Revises: 2b9f4c6e1a83
+Create Date: 2026-10-16 18:41:05.276193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '6d4e0b7f93c2'
+down_revision = '2b9f4c6e1a83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('journey', sa.Column('stop_refs', postgresql.ARRAY(sa.Text(), dimensions=1), nullable=True))
+    op.add_column('journey', sa.Column('sequences', postgresql.ARRAY(sa.Integer(), dimensions=1), nullable=True))
+    op.add_column('journey', sa.Column('flags', postgresql.ARRAY(sa.SmallInteger(), dimensions=1), nullable=True))
+    op.add_column('journey', sa.Column('arrive', postgresql.ARRAY(sa.Integer(), dimensions=1), nullable=True))
+    op.add_column('journey', sa.Column('depart', postgresql.ARRAY(sa.Integer(), dimensions=1), nullable=True))
+
+    # Convert JSON data to arrays ordered by sequence, with flags for timing
+    # points (1) and stopping (2) and times in seconds
+    op.execute("""
+        UPDATE journey
+           SET stop_refs = d.stop_refs,
+               sequences = d.sequences,
+               flags = d.flags,
+               arrive = d.arrive,
+               depart = d.depart
+          FROM (
+                SELECT j.id,
+                       array_agg(l.stop_point_ref ORDER BY l.sequence) AS stop_refs,
+                       array_agg(l.sequence ORDER BY l.sequence) AS sequences,
+                       array_agg(
+                           CAST(CASE WHEN l.timing_point THEN 1 ELSE 0 END +
+                                CASE WHEN l.stopping THEN 2 ELSE 0 END AS SMALLINT)
+                           ORDER BY l.sequence
+                       ) AS flags,
+                       array_agg(CAST(EXTRACT(EPOCH FROM l.arrive) AS INTEGER)
+                                 ORDER BY l.sequence) AS arrive,
+                       array_agg(CAST(EXTRACT(EPOCH FROM l.depart) AS INTEGER)
+                                 ORDER BY l.sequence) AS depart
+                  FROM journey AS j
+                       CROSS JOIN LATERAL jsonb_to_recordset(j.data) AS l(
+                           stop_point_ref TEXT, timing_point BOOLEAN,
+                           stopping BOOLEAN, sequence INTEGER, arrive INTERVAL,
+                           depart INTERVAL
+                       )
+                 GROUP BY j.id
+               ) AS d
+         WHERE journey.id = d.id;
+    """)
+
+    op.drop_column('journey', 'data')
+
+
+def downgrade():
+    op.add_column('journey', sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+
+    op.execute("""
+        UPDATE journey
+           SET data = d.data
+          FROM (
+                SELECT j.id,
+                       jsonb_agg(
+                           jsonb_build_object(
+                               'stop_point_ref', l.stop_point_ref,
+                               'timing_point', (l.flags & 1) > 0,
+                               'stopping', (l.flags & 2) > 0,
+                               'sequence', l.sequence,
+                               'arrive', l.arrive * INTERVAL '1 second',
+                               'depart', l.depart * INTERVAL '1 second'
+                           )
+                           ORDER BY l.sequence
+                       ) AS data
+                  FROM journey AS j
+                       CROSS JOIN LATERAL unnest(j.stop_refs, j.sequences,
+                                                 j.flags, j.arrive, j.depart)
+                           AS l(stop_point_ref, sequence, flags, arrive, depart)
+                 GROUP BY j.id
+               ) AS d
+         WHERE journey.id = d.id;
+    """)
+
+    op.drop_column('journey', 'depart')
+    op.drop_column('journey', 'arrive')
+    op.drop_column('journey', 'flags')
+    op.drop_column('journey', 'sequences')
+    op.drop_column('journey', 'stop_refs')
@@ -0,0 +1,35 @@
+"""
+add journey calendar
+
+Revision ID: 8e3a1d7c52f0
+Revises: 5c1f2e8a9b47
+Create Date: 2026-10-16 15:20:48.118306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8e3a1d7c52f0'
+down_revision = '5c1f2e8a9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'journey_calendar',
+        sa.Column('journey_ref', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('date_start', sa.Date(), nullable=False),
+        sa.Column('dates', postgresql.BIT(varying=True), nullable=False),
+        sa.ForeignKeyConstraint(['journey_ref'], ['journey.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('journey_ref')
+    )
+
+
+def downgrade():
+    op.drop_table('journey_calendar')
@@ -0,0 +1,30 @@
+"""
+add data version
+
+Revision ID: 9a7c3e5d1f24
+Revises: 6d4e0b7f93c2
+Create Date: 2026-10-16 19:37:52.604418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a7c3e5d1f24'
+down_revision = '6d4e0b7f93c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'data_version',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('refreshed', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('data_version')
@@ -0,0 +1,380 @@
+"""
+Caching results shared across requests, workers and restarts.
+"""
+import collections
+import contextlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are not available on Windows
+    fcntl = None
+
+from flask import current_app, has_app_context
+
+from nextbus.logger import app_logger
+
+
+logger = app_logger.getChild("cache")
+
+# Value set with a time to live, with the expiry time in seconds since the epoch
+_Expiring = collections.namedtuple("_Expiring", ["value", "expires"])
+
+
+class LRUCache:
+    """ Bounded mapping of keys to values which discards the least recently
+        used items once the maximum size is reached.
+
+        :param maxsize: Maximum number of items to keep.
+    """
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError("Maximum size must be at least 1.")
+
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<LRUCache({len(self)}/{self.maxsize})>"
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """ Gets value for key, marking it as recently used. """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        """ Sets value for key, discarding the least recently used item if the
+            cache is full.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def keys(self):
+        """ Gets list of keys from least to most recently used. """
+        with self._lock:
+            return list(self._data)
+
+    def delete(self, key):
+        """ Removes item for key if it exists. """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Removes all items. """
+        with self._lock:
+            self._data.clear()
+
+
+class DirectoryStore:
+    """ Stores pickled values as files within a directory, such that values
+        can be shared by multiple processes.
+
+        Values are written to a temporary file first and moved into place so
+        incomplete files are never read. Files are marked as used by their
+        modification times, such that the least recently used files can be
+        removed with `evict()` once the maximum size is exceeded.
+
+        :param path: Directory to store values in, which is created if it does
+        not exist.
+        :param maxsize: Maximum number of values to keep, or None for no limit.
+    """
+    def __init__(self, path, maxsize=None):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError("Maximum size must be at least 1.")
+
+        self.path = path
+        self.maxsize = maxsize
+
+    def __repr__(self):
+        return f"<DirectoryStore({self.path!r}, {self.maxsize!r})>"
+
+    def _file(self, key):
+        if not key or not all(c.isalnum() or c in "-_" for c in key):
+            raise ValueError(f"Key {key!r} must be a non-empty string of "
+                             f"letters, numbers, '-' or '_'.")
+        return os.path.join(self.path, key)
+
+    def _entries(self):
+        """ Lists files holding values, excluding temporary and lock files. """
+        try:
+            with os.scandir(self.path) as entries:
+                return [e for e in entries if e.is_file() and
+                        not e.name.startswith(".") and
+                        not e.name.endswith(".lock")]
+        except FileNotFoundError:
+            return []
+
+    def keys(self):
+        """ Gets list of keys with values in the store. """
+        return [e.name for e in self._entries()]
+
+    def get(self, key, default=None):
+        """ Gets value for key from file, marking it as recently used. """
+        path = self._file(key)
+        try:
+            with open(path, "rb") as file_:
+                value = pickle.load(file_)
+        except FileNotFoundError:
+            return default
+        except (OSError, pickle.UnpicklingError, EOFError):
+            logger.warning(f"Failed to read {key!r} from {self!r}",
+                           exc_info=1)
+            return default
+
+        with contextlib.suppress(OSError):
+            os.utime(path)
+
+        return value
+
+    def set(self, key, value):
+        """ Sets value for key by replacing the file. """
+        path = self._file(key)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+            try:
+                with open(fd, "wb") as file_:
+                    pickle.dump(value, file_, pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        except OSError:
+            logger.warning(f"Failed to write {key!r} to {self!r}", exc_info=1)
+
+    def evict(self):
+        """ Removes least recently used values until within the maximum size.
+            Every file in the directory is checked, so this should not be
+            called for every value set.
+        """
+        if self.maxsize is None:
+            return
+
+        entries = self._entries()
+        excess = len(entries) - self.maxsize
+        if excess <= 0:
+            return
+
+        def _modified(entry):
+            try:
+                return entry.stat().st_mtime
+            except FileNotFoundError:
+                return 0
+
+        entries.sort(key=_modified)
+        for entry in entries[:excess]:
+            self.delete(entry.name)
+
+    def delete(self, key):
+        """ Removes value for key and its lock file if they exist. """
+        path = self._file(key)
+        for file_path in [path, path + ".lock"]:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.warning(f"Failed to remove {key!r} from {self!r}",
+                               exc_info=1)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """ Holds an exclusive lock on a key across processes until the
+            context exits. Does nothing if file locks are not supported.
+        """
+        path = self._file(key) + ".lock"
+        if fcntl is None:
+            yield
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(path, "a") as file_:
+            fcntl.flock(file_, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file_, fcntl.LOCK_UN)
+
+
+class KeyLocks:
+    """ Locks for each key within a process, kept only while in use. """
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """ Holds a lock on a key until the context exits. """
+        with self._lock:
+            lock, count = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[key] = lock, count + 1
+
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, count = self._locks[key]
+                if count > 1:
+                    self._locks[key] = lock, count - 1
+                else:
+                    del self._locks[key]
+
+
+class Cache:
+    """ LRU cache for a namespace, backed by a directory store if the
+        ``CACHE_DIRECTORY`` setting is set for the current app.
+
+        Keys must be strings as accepted by `DirectoryStore`. Values set with
+        a time to live are treated as missing once expired.
+
+        :param namespace: Name of subdirectory within the cache directory.
+        :param maxsize: Maximum number of items to keep in memory.
+        :param store_size: Maximum number of items to keep in the directory
+        store. The store is checked after a number of values are set by this
+        process instead of every time, so it may hold more items in between.
+    """
+    def __init__(self, namespace, maxsize=128, store_size=1024):
+        self.namespace = namespace
+        self.store_size = store_size
+        self.local = LRUCache(maxsize)
+        self._locks = KeyLocks()
+        self._evict_every = max(1, store_size // 16)
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Cache({self.namespace!r}, {self.local!r})>"
+
+    def _store(self):
+        if not has_app_context():
+            return None
+
+        directory = current_app.config.get("CACHE_DIRECTORY")
+        if directory:
+            return DirectoryStore(os.path.join(directory, self.namespace),
+                                  self.store_size)
+        else:
+            return None
+
+    @staticmethod
+    def _unwrap(value, default):
+        if isinstance(value, _Expiring):
+            return value.value if value.expires > time.time() else default
+        return value
+
+    def get(self, key, default=None):
+        """ Gets value from memory, or from the shared store if available. """
+        value = self.local.get(key, self)
+        if value is not self:
+            value = self._unwrap(value, self)
+            if value is not self:
+                return value
+
+        store = self._store()
+        if store is None:
+            return default
+
+        stored = store.get(key, self)
+        value = self._unwrap(stored, self)
+        if value is self:
+            return default
+
+        self.local.set(key, stored)
+        return value
+
+    def set(self, key, value, ttl=None, shared=True):
+        """ Sets value in memory and in the shared store if available.
+
+            :param ttl: Seconds until the value expires, or None to keep it
+            until discarded.
+            :param shared: Set value in the shared store as well. Values only
+            useful to a few requests can be kept in memory instead.
+        """
+        if ttl is not None:
+            value = _Expiring(value, time.time() + ttl)
+
+        self.local.set(key, value)
+        store = self._store()
+        if not shared or store is None:
+            return
+
+        store.set(key, value)
+        with self._writes_lock:
+            self._writes += 1
+            evict = self._writes >= self._evict_every
+            if evict:
+                self._writes = 0
+        if evict:
+            store.evict()
+
+    def get_or_set(self, key, func, ttl=None):
+        """ Gets value, or calls a function to create and set the value if
+            missing or expired.
+
+            Concurrent calls for the same key within this process, or across
+            processes sharing a store, wait for the first call to set the value
+            so the function is called only once.
+
+            :param func: Function without arguments returning the value.
+            :param ttl: Seconds until the value expires, or None to keep it
+            until discarded.
+        """
+        value = self.get(key, self)
+        if value is not self:
+            return value
+
+        store = self._store()
+        store_lock = (store.lock(key) if store is not None
+                      else contextlib.nullcontext())
+        with self._locks.lock(key), store_lock:
+            # Another thread or process may have set the value while waiting
+            value = self.get(key, self)
+            if value is self:
+                value = func()
+                self.set(key, value, ttl)
+
+        return value
+
+    def prune(self, keep):
+        """ Removes values held in memory and in the shared store if their keys
+            are not to be kept, eg keys from an earlier version of data.
+
+            :param keep: Function taking a key and returning True if the value
+            is to be kept.
+        """
+        for key in self.local.keys():
+            if not keep(key):
+                self.local.delete(key)
+
+        store = self._store()
+        if store is not None:
+            for key in store.keys():
+                if not keep(key):
+                    store.delete(key)
+            store.evict()
+
+    def clear(self):
+        """ Removes all values held in memory. """
+        self.local.clear()
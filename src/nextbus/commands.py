@@ -6,7 +6,7 @@ import os
 import click
 from flask.cli import FlaskGroup
 
-from nextbus import populate
+from nextbus import graph, populate, timetable
 
 
 def run_cli_app():
@@ -168,3 +168,17 @@ def populate_cmd(ctx, **kw):
         )
     else:
         click.echo(ctx.get_help())
+        return
+
+    # Timetables cached from other versions of data will not be used again
+    timetable.prune_cache()
+
+
+@cli.command(name="layouts",
+             help="Analyse and draw diagrams for all services using existing "
+             "data, replacing any layouts already created.")
+@click.option("--jobs", "-j", "jobs", default=None, type=click.IntRange(1),
+              help="Number of processes to use. Uses all CPUs by default.")
+def layouts_cmd(jobs):
+    """ Creates layouts for all services over a pool of processes. """
+    graph.refresh_layouts(jobs)
@@ -44,6 +44,15 @@ class Config:
     DATABASE_DUMP_PATH = _get_env_var("NXB_DATABASE_DUMP_PATH")
     # Temporary directory path for population
     TEMP_DIRECTORY = _get_env_var("NXB_TEMP_DIRECTORY")
+    # Time in milliseconds to spend ordering lines for a service diagram within
+    # a request before using the best layout so far. No limit if negative
+    LAYOUT_TIME_LIMIT = _get_env_var("NXB_LAYOUT_TIME_LIMIT", cast=int, default=1000)
+    # Number of processes used to create service layouts during population.
+    # Defaults to 1; use all CPUs if 0
+    POPULATE_JOBS = _get_env_var("NXB_POPULATE_JOBS", cast=int, default=1)
+    # Directory for caches shared by workers, eg service layouts and
+    # timetables. Caches are kept in memory only if not set
+    CACHE_DIRECTORY = _get_env_var("NXB_CACHE_DIRECTORY")
     # Directory to place logs in
     LOG_DIRECTORY = _get_env_var("NXB_LOG_DIRECTORY", default=".")
 
@@ -69,6 +78,31 @@ class Config:
     # Set a limit on the number of requests per day starting at 00:00 UTC
     # Further requests will utilise timetabled data. Ignored if negative or None
     TRANSPORT_API_LIMIT = _get_env_var("NXB_TAPI_LIMIT", cast=int)
+    # Number of requests reserved by each worker at once, such that the limit
+    # is checked and updated once for each block. Reserved requests not used by
+    # the end of the day are lost
+    TRANSPORT_API_QUOTA_BLOCK = _get_env_var("NXB_TAPI_QUOTA_BLOCK", cast=int, default=50)
+    # Time in milliseconds to wait for a connection to and a response from TAPI
+    TRANSPORT_API_CONNECT_TIMEOUT = _get_env_var("NXB_TAPI_CONNECT_TIMEOUT", cast=int, default=3000)
+    TRANSPORT_API_READ_TIMEOUT = _get_env_var("NXB_TAPI_READ_TIMEOUT", cast=int, default=5000)
+    # Number of times TAPI requests are retried after connection or server
+    # errors
+    TRANSPORT_API_RETRIES = _get_env_var("NXB_TAPI_RETRIES", cast=int, default=2)
+    # Maximum number of connections to TAPI kept open by each worker
+    TRANSPORT_API_POOL_SIZE = _get_env_var("NXB_TAPI_POOL_SIZE", cast=int, default=10)
+    # Maximum number of live data requests made at once for several stops
+    LIVE_BATCH_WORKERS = _get_env_var("NXB_LIVE_BATCH_WORKERS", cast=int, default=8)
+    # Stop requesting live data and use timetabled times after this number of
+    # failed or slow requests within the window in seconds
+    LIVE_BREAKER_FAILURES = _get_env_var("NXB_LIVE_BREAKER_FAILURES", cast=int, default=5)
+    LIVE_BREAKER_WINDOW = _get_env_var("NXB_LIVE_BREAKER_WINDOW", cast=int, default=60)
+    # Time in milliseconds for a live data request to be counted as slow
+    LIVE_BREAKER_SLOW = _get_env_var("NXB_LIVE_BREAKER_SLOW", cast=int, default=3000)
+    # Seconds to wait before trying live data again after failures
+    LIVE_BREAKER_RESET = _get_env_var("NXB_LIVE_BREAKER_RESET", cast=int, default=30)
+    # Seconds live times for a stop are shared by all requests and workers
+    # before requesting again. Not shared if 0
+    LIVE_CACHE_TTL = _get_env_var("NXB_LIVE_CACHE_TTL", cast=int, default=30)
     # ID for Transport API
     TRANSPORT_API_ID = _get_env_var("NXB_TAPI_ID")
     # Key for Transport API
@@ -1,6 +1,8 @@
 """
 Forms for searching bus stops.
 """
+import datetime
+
 from flask_wtf import FlaskForm
 from wtforms import fields, validators
 
@@ -57,6 +59,18 @@ class SelectDate(FlaskForm):
         csrf = False
 
     date = fields.DateField("date")
+    start = fields.TimeField("start", validators=[validators.Optional()])
+    end = fields.TimeField("end", validators=[validators.Optional()])
+    after = fields.StringField("after", validators=[
+        validators.Optional(),
+        validators.Regexp(r"^[0-2]\d[0-5]\d[0-5]\d-\d+$",
+                          message="Invalid page.")
+    ])
+    limit = fields.IntegerField("limit", validators=[
+        validators.Optional(),
+        validators.NumberRange(min=1)
+    ])
+    expand = fields.BooleanField("expand")
     _start = None
     _end = None
 
@@ -92,3 +106,34 @@ class SelectDate(FlaskForm):
                 f"Timetable data for this service is available up to "
                 f"{_date_long_form(self._end)}."
             )
+
+    def validate_end(self, field):
+        """ Validates ending time is after starting time. """
+        if (field.data is not None and self.start.data is not None and
+                field.data <= self.start.data):
+            raise validators.ValidationError(
+                "The end of the time range must be after the start."
+            )
+
+    @property
+    def after_cursor(self):
+        """ Gets tuple of departure time and journey ID from the page cursor
+            if valid, or None.
+        """
+        if not self.after.data or self.after.errors:
+            return None
+
+        time, journey_id = self.after.data.split("-")
+        try:
+            departure = datetime.datetime.strptime(time, "%H%M%S").time()
+        except ValueError:
+            return None
+
+        return departure, int(journey_id)
+
+    @staticmethod
+    def format_cursor(cursor):
+        """ Formats tuple of departure time and journey ID as a page cursor.
+        """
+        departure, journey_id = cursor
+        return f"{departure:%H%M%S}-{journey_id}"
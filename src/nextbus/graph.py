@@ -1,15 +1,32 @@
 """
 Draws a route graph for a service.
 """
+from array import array
+import bisect
 import collections
 from collections import abc
 import functools
+import hashlib
 import itertools
+import json
+import multiprocessing
+import os
+import time
 
-from nextbus import db, models
+from flask import current_app
+from sqlalchemy.dialects import postgresql as pg
+
+from nextbus import cache, db, models
+from nextbus.logger import app_logger
+from nextbus.populate import utils as populate_utils
 
 
 MAX_COLUMNS = 5
+# Increment if changes to analysing or drawing graphs change their layouts
+_LAYOUT_CACHE_VERSION = 1
+
+logger = app_logger.getChild("graph")
+_layout_cache = cache.Cache("layouts", maxsize=1024)
 
 
 class MaxColumnError(Exception):
@@ -148,8 +165,8 @@ def _merge_forward(graph, sequence, path, index):
         if v in sequence:
             continue
         # Check if any later vertices have this path and move index
-        after = [j for j, w in enumerate(sequence[i:], i)
-                 if v in graph.following(w)]
+        preceding = graph.preceding(v)
+        after = [j for j, w in enumerate(sequence[i:], i) if w in preceding]
         if after:
             i = after[-1] + 1
         sequence.insert(i, v)
@@ -165,8 +182,9 @@ def _merge_backward(graph, sequence, path, index):
         if v in sequence:
             continue
         # Check if any previous vertices have this path and move index
+        following = graph.following(v)
         after = [i - j for j, w in enumerate(sequence[i::-1])
-                 if v in graph.preceding(w)]
+                 if w in following]
         if after:
             i = after[-1]
         sequence.insert(i, v)
@@ -185,22 +203,75 @@ def _count_cycles(graph, sequence):
     return cycles
 
 
+def _strong_components(graph):
+    """ Finds strongly connected components with Tarjan's algorithm.
+
+        :returns: Dict of vertices and the index of the component each vertex
+        belongs to.
+    """
+    index = {}
+    low = {}
+    component = {}
+    stack = []
+    count = 0
+
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        # Iterate over successors of each vertex on the path being searched
+        path = [(root, iter(graph.following(root)))]
+        while path:
+            v, successors = path[-1]
+            for w in successors:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    path.append((w, iter(graph.following(w))))
+                    break
+                elif w not in component:
+                    # w is still on stack
+                    low[v] = min(low[v], index[w])
+            else:
+                path.pop()
+                if path:
+                    u = path[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        component[w] = count
+                        if w == v:
+                            break
+                    count += 1
+
+    return component
+
+
 def _rearrange_cycles(graph, sequence):
     """ Find all cycles which may include vertices in the wrong order and
         move them around.
+
+        Edges going back in the sequence are real cycles if both vertices are
+        in the same strongly connected component, which are found once
+        beforehand. Vertices reachable from each vertex are kept as moving
+        vertices does not change the graph.
     """
-    real_cycles = set()
+    component = _strong_components(graph)
+    reachable = {}
+
     cycles = _count_cycles(graph, sequence)
     while cycles:
         u, v = cycle = cycles.pop()
-        paths = graph.search_paths(v)
-        if paths[u]:
+        if component[u] == component[v]:
             # Path for v -> u exists so u -> v is cyclic
-            real_cycles.add(cycle)
             continue
         # u -> v is not cyclic; can assume that this is in the wrong order
+        if v not in reachable:
+            reachable[v] = {v} | set(graph.search_tree(v).reached)
+        tree = reachable[v]
         cutoff = sequence.index(u) + 1
-        tree = {v} | {w for p in paths.values() for w in p}
         sequence[:cutoff] = (
             [w for w in sequence[:cutoff] if w not in tree] +
             [w for w in sequence[:cutoff] if w in tree]
@@ -212,6 +283,24 @@ def _rearrange_cycles(graph, sequence):
             )
 
 
+def _longest_path(graph, vertex, forward):
+    """ Finds longest of the shortest paths starting or ending at vertex, with
+        paths of the same length sorted by the graph's ranking.
+    """
+    if not forward:
+        paths = graph.search_paths(vertex, forward=False).values()
+        return max(sorted(paths, key=graph.path_sort), key=len)
+
+    tree = graph.search_tree(vertex)
+    reached = tree.reached
+    if not reached:
+        return Path()
+
+    longest = tree.reached_from(tree.length(reached[-1]))
+
+    return min((tree[v] for v in longest), key=graph.path_sort)
+
+
 def _analyse_graph(graph):
     """ Analyses a connected graph to find a set of distinct paths and a
         topologically ordered sequence.
@@ -240,14 +329,13 @@ def _analyse_graph(graph):
         vertex, forward = stack.pop()
 
         try:
-            new_paths = g.search_paths(vertex, forward=forward).values()
+            longest = _longest_path(g, vertex, forward)
         except KeyError:
             continue
-        if not any(new_paths):
+        if not longest:
             continue
 
         # Add paths to list
-        longest = max(sorted(new_paths, key=graph.path_sort), key=len)
         g.remove_path(longest)
         paths.append(longest)
 
@@ -280,10 +368,12 @@ class LayoutRow:
     """ Helper class to hold data for each row in a layout. """
     def __init__(self, layout, vertex, column=None, start=None, end=None,
                  cycles_start=None, cycles_end=None):
-        if vertex not in layout.sequence:
+        try:
+            layout.position(vertex)
+        except KeyError:
             raise ValueError(
                 f"Vertex {vertex!r} not in sequence {layout.sequence!r}."
-            )
+            ) from None
 
         self.layout = layout
         self.vertex = vertex
@@ -301,7 +391,7 @@ class LayoutRow:
     @property
     def index(self):
         """ Index of vertex in layout's sequence. """
-        return self.layout.sequence.index(self.vertex)
+        return self.layout.position(self.vertex)
 
     @property
     def previous(self):
@@ -566,17 +656,14 @@ class LayoutRow:
     def count_crossings(self, *, start=None, end=None):
         """ Counts crossings within a row defined by starting and ending lines.
 
-            Each pair of paths are checked by seeing if the differences in
-            starting and ending vertices' positions are non-zero and of opposite
-            signs.
+            A pair of paths cross if the differences in starting and ending
+            vertices' positions are non-zero and of opposite signs, counted as
+            inversions of ending positions.
 
             :param start: Use this set of lines instead of row's starting lines.
             :param end: Use this set of lines instead of row's end lines.
         """
-        paths = self.lines(start=start, end=end)
-
-        return sum(1 for (a, b), (c, d) in itertools.combinations(paths, 2)
-                   if (a - c) * (b - d) < 0)
+        return _count_inversions(self.lines(start=start, end=end))
 
     def rearrange(self, new_order):
         """ Moves lines and columns around on starting lines for this row and
@@ -693,34 +780,80 @@ def _median_order(row, forward=True):
 
 
 def _transpose_order(row, forward=True):
-    """ Swaps lines within a row to see if the number of crossings improve. """
-    len_ = len(row.end) if forward else len(row.start)
+    """ Swaps lines within a row to see if the number of crossings improve.
+
+        Swapping two adjacent columns only changes crossings between lines
+        within these two columns so the change is counted from these lines
+        alone.
+    """
+    lines = row.end if forward else row.start
+    len_ = len(lines)
     order = list(range(len_))
 
     if len_ < 2:
         return order
 
-    crossings = row.count_crossings()
+    # Positions of lines at the other end, grouped by column being ordered
+    columns = [[] for _ in range(len_)]
+    for a, b in row.lines():
+        if forward:
+            columns[b].append(a)
+        else:
+            columns[a].append(b)
+
     improved = True
     while improved:
         improved = False
         for i in range(len_ - 1):
-            new_order = order[:i] + [order[i + 1], order[i]] + order[i + 2:]
-            if forward:
-                temp = [set(row.end[j]) for j in new_order]
-                new_crossings = row.count_crossings(end=temp)
-            else:
-                temp = [set(row.start[j]) for j in new_order]
-                new_crossings = row.count_crossings(start=temp)
+            # Lines matching ending lines exactly are drawn to the first one
+            # found so swapping identical lines would not change anything
+            if forward and lines[order[i]] == lines[order[i + 1]]:
+                continue
 
-            if new_crossings < crossings:
-                order = new_order
-                crossings = new_crossings
+            x, y = columns[i], columns[i + 1]
+            change = sum((p < q) - (p > q) for p in x for q in y)
+            if change < 0:
+                order[i], order[i + 1] = order[i + 1], order[i]
+                columns[i], columns[i + 1] = y, x
                 improved = True
 
     return order
 
 
+def _count_inversions(pairs):
+    """ Counts pairs of pairs (a, b) and (c, d) where a < c and b > d, using
+        a Fenwick tree over the second values.
+
+        :param pairs: Collection of pairs of non-negative integers.
+    """
+    if not pairs:
+        return 0
+
+    size = max(b for _, b in pairs) + 1
+    tree = [0] * (size + 1)
+    count = 0
+    inserted = 0
+    # Pairs with the same first value do not cross so each group is counted
+    # against previous groups before being added
+    for _, group in itertools.groupby(sorted(pairs), key=lambda p: p[0]):
+        group = [b for _, b in group]
+        for b in group:
+            # Number of inserted values less than or equal to b
+            i = b + 1
+            while i > 0:
+                count -= tree[i]
+                i -= i & -i
+            count += inserted
+        for b in group:
+            i = b + 1
+            while i <= size:
+                tree[i] += 1
+                i += i & -i
+        inserted += len(group)
+
+    return count
+
+
 class LayoutColumns(abc.Mapping):
     """ Column view for Layout. """
     def __init__(self, layout):
@@ -754,31 +887,46 @@ class Layout:
         exceed this maximum, the calculations stop and a MaxColumnError raised.
         :param ordered: Try ordering vertices and lines within each row to
         reduce crossings.
+        :param time_limit: Time in seconds to stop ordering lines, keeping the
+        best ordering found so far and marking the layout as approximate.
         :param _create: Internal parameter to draw layout on initialization.
     """
     ORDER_ITERATIONS = 8
 
-    def __init__(self, graph, max_columns=None, ordered=True, _create=True):
+    def __init__(self, graph, max_columns=None, ordered=True, time_limit=None,
+                 _create=True):
         self.g = graph
         self.sequence = graph.sequence()
         self.max_col = max_columns
         self.ordered = ordered
+        self.time_limit = time_limit
+        self.approximate = False
 
+        self._positions = {}
         self.rows = {v: LayoutRow(self, v) for v in self.sequence}
         self.columns = LayoutColumns(self)
         self.cycles = set()
         self.paths = {}
 
         if _create:
+            start = time.monotonic()
             self._set_lines()
-            self._order_lines()
+            self._order_lines(start)
             self._draw_paths()
 
     def __repr__(self):
         return f"<Layout({self.g!r})>"
 
+    def position(self, vertex):
+        """ Index of vertex in sequence. """
+        if len(self._positions) != len(self.sequence):
+            # Sequence has changed, eg with a row added for starting cycles
+            self._positions = {v: i for i, v in enumerate(self.sequence)}
+
+        return self._positions[vertex]
+
     def _adjacent(self, vertex, direct, cyclic, forward):
-        index = self.sequence.index(vertex)
+        index = self.position(vertex)
         if forward:
             adjacent = self.g.following(vertex)
             sequence = set(self.sequence[index + 1:])
@@ -858,7 +1006,7 @@ class Layout:
             if self.max_col is not None and len(row.end) > self.max_col:
                 raise MaxColumnError
 
-    def _order_lines(self):
+    def _order_lines(self, start=None):
         """ Processes layout to reduce the number of crossings.
 
             Heuristics based on the dot algorithm are used where over a number
@@ -866,13 +1014,36 @@ class Layout:
 
             Rows are set to the new orderings if the number of crossings is
             reduced.
+
+            :param start: Time the layout was started, used with the time
+            limit. If None, the time this method was called is used.
         """
         if not self.ordered:
             return
 
+        if self.time_limit is not None:
+            deadline = _coalesce(start, time.monotonic()) + self.time_limit
+        else:
+            deadline = None
+
+        def out_of_time():
+            return deadline is not None and time.monotonic() > deadline
+
         # Make copies of current columns and lines to modify
         nl = self.copy()
-        crossings = nl.crossings()
+        # Keep count of crossings for each row, updating only rows with lines
+        # that were moved
+        row_crossings = {v: r.count_crossings() for v, r in nl.rows.items()}
+        crossings = sum(row_crossings.values())
+
+        def rearrange(row, new_order):
+            if new_order == list(range(len(new_order))):
+                return
+            row.rearrange(new_order)
+            row_crossings[row.vertex] = row.count_crossings()
+            if row.previous is not None:
+                previous = row.previous
+                row_crossings[previous.vertex] = previous.count_crossings()
 
         # Iterate over rows in either order
         # If iterating from start, rearrange the next row
@@ -886,18 +1057,33 @@ class Layout:
             forward = i % 2 == 0
             rows = rows_forward if forward else rows_reverse
 
+            # Rows without crossings, such as most rows along chains of single
+            # vertices, are already ordered and are skipped
+            stopped = False
             for row, set_row in rows:
-                set_row.rearrange(_median_order(row, forward))
-
-            for row, set_row in rows:
-                set_row.rearrange(_transpose_order(row, forward))
+                if row_crossings[row.vertex]:
+                    rearrange(set_row, _median_order(row, forward))
+                    if stopped := out_of_time():
+                        break
+
+            if not stopped:
+                for row, set_row in rows:
+                    if row_crossings[row.vertex]:
+                        rearrange(set_row, _transpose_order(row, forward))
+                        if stopped := out_of_time():
+                            break
 
             # If crossings have been improved, copy them back into original data
-            new_crossings = nl.crossings()
+            new_crossings = sum(row_crossings.values())
             if new_crossings < crossings:
                 self.copy_from(nl)
                 crossings = new_crossings
 
+            if stopped or i < self.ORDER_ITERATIONS - 1 and out_of_time():
+                # Ran out of time; keep the best ordering found so far
+                self.approximate = True
+                break
+
     def _draw_paths(self):
         """ Draws all paths and adds to layout. """
         for v in self.sequence:
@@ -918,26 +1104,209 @@ class Layout:
 
 
 def _memoize_graph(graph, method):
-    """ Wraps graph method in a function that remembers adjacency list and last
-        result.
+    """ Wraps graph method in a function that remembers adjacency list,
+        arguments and last result. Approximate results, such as layouts cut
+        short by a time limit, are not remembered.
     """
     adj = None
+    key = None
     result = None
 
     @functools.wraps(method)
     def _method(*args, **kwargs):
-        nonlocal adj, result
+        nonlocal adj, key, result
 
         new_adj = graph.adj
-        if adj != new_adj:
-            result = method(*args, **kwargs)
-            adj = new_adj
+        new_key = (args, sorted(kwargs.items()))
+        if adj != new_adj or key != new_key:
+            new_result = method(*args, **kwargs)
+            if getattr(new_result, "approximate", False):
+                return new_result
+            adj, key, result = new_adj, new_key, new_result
 
         return result
 
     return _method
 
 
+class _DisjointSet:
+    """ Disjoint sets of integers from 0 to n - 1, merged by size and with
+        paths compressed when searching for the root of a set.
+    """
+    __slots__ = ("parent", "size")
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        """ Finds root of the set containing i. """
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+
+        return root
+
+    def union(self, i, j):
+        """ Merges sets containing i and j, returning the new root. """
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return i
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+        return i
+
+
+class _IndexedGraph:
+    """ Read-only copy of a graph with vertices interned as integers.
+
+        Edges are held as compressed arrays: the successors of vertex `i` are
+        `succ[succ_start[i]:succ_start[i + 1]]`, and likewise for predecessors.
+        Adjacent vertices are sorted by the graph's ranking function so
+        searches give the same results as iterating over sorted sets.
+
+        :param adj: Adjacency list as a dictionary of sets.
+        :param sort: Function to sort vertices by.
+    """
+    __slots__ = ("vertices", "index", "succ_start", "succ", "pred_start",
+                 "pred")
+
+    def __init__(self, adj, sort):
+        self.vertices = list(adj)
+        self.index = {v: i for i, v in enumerate(self.vertices)}
+
+        preceding = [[] for _ in self.vertices]
+        for v in self.vertices:
+            for w in adj[v]:
+                preceding[self.index[w]].append(v)
+
+        self.succ_start, self.succ = self._compress(
+            sorted(set(adj[v]), key=sort) for v in self.vertices
+        )
+        self.pred_start, self.pred = self._compress(
+            sorted(set(p), key=sort) for p in preceding
+        )
+
+    def _compress(self, lists):
+        """ Flattens lists of adjacent vertices into offsets and indices. """
+        start = array("l", [0])
+        values = array("l")
+        for adjacent in lists:
+            values.extend(self.index[v] for v in adjacent)
+            start.append(len(values))
+
+        return start, values
+
+    def search(self, root, target=None):
+        """ Does BFS from root, marking each vertex with the vertex it was first
+            reached from and the length of the path to it.
+
+            The root itself is only reached again if it is on a cycle; it is
+            not expanded a second time.
+
+            :returns: List of vertices in the order they were reached, list of
+            parent vertices (-1 for any vertex not reached) and list of path
+            lengths.
+        """
+        start, succ = self.succ_start, self.succ
+        parent = [-1] * len(self.vertices)
+        length = [0] * len(self.vertices)
+        length[root] = 1
+        order = []
+        queue = collections.deque([root])
+
+        while queue:
+            u = queue.popleft()
+            # Root may be reached again through a self-cycle
+            next_length = length[u] + 1
+            for i in range(start[u], start[u + 1]):
+                w = succ[i]
+                if parent[w] >= 0:
+                    continue
+                parent[w] = u
+                length[w] = next_length
+                order.append(w)
+                if w == target:
+                    return order, parent, length
+                if w != root:
+                    queue.append(w)
+
+        return order, parent, length
+
+    def path(self, root, vertex, parent):
+        """ Creates path from root to vertex by following parent vertices from
+            a search.
+        """
+        vertices = [self.vertices[vertex]]
+        u = parent[vertex]
+        while u != root:
+            vertices.append(self.vertices[u])
+            u = parent[u]
+        vertices.append(self.vertices[root])
+
+        return Path(reversed(vertices))
+
+
+class PathTree(abc.Mapping):
+    """ Shortest paths from a single vertex found by BFS, as a mapping of
+        vertices to paths.
+
+        Only the previous vertex and length of each path are kept; Path
+        objects are created when accessed.
+    """
+    def __init__(self, graph, root, order, parent, length):
+        self._g = graph
+        self._root = root
+        self._order = order
+        self._parent = parent
+        self._length = length
+
+    def __repr__(self):
+        return f"<PathTree({self._g.vertices[self._root]!r})>"
+
+    def __getitem__(self, vertex):
+        i = self._g.index[vertex]
+        if self._parent[i] < 0:
+            return Path()
+
+        return self._g.path(self._root, i, self._parent)
+
+    def __iter__(self):
+        yield from self.reached
+        for i, v in enumerate(self._g.vertices):
+            if self._parent[i] < 0:
+                yield v
+
+    def __len__(self):
+        return len(self._g.vertices)
+
+    @property
+    def reached(self):
+        """ Vertices with paths found, in the order they were reached. """
+        return [self._g.vertices[i] for i in self._order]
+
+    def reached_from(self, length):
+        """ Vertices with paths of at least this length, in the order they were
+            reached. Paths found by BFS do not get shorter so these are always
+            the last vertices reached.
+        """
+        lengths = [self._length[i] for i in self._order]
+        start = bisect.bisect_left(lengths, length)
+
+        return [self._g.vertices[i] for i in self._order[start:]]
+
+    def length(self, vertex):
+        """ Length of path to vertex without creating it. """
+        i = self._g.index[vertex]
+        return self._length[i] if self._parent[i] >= 0 else 0
+
+
 class Graph:
     """ Directed graph.
 
@@ -947,6 +1316,7 @@ class Graph:
     """
     def __init__(self, pairs=None, singles=None, sort=None):
         self._v = collections.defaultdict(set)
+        self._indexed = None
         if pairs is not None:
             for v1, v2 in pairs:
                 self.add_edge(v1, v2)
@@ -1086,7 +1456,10 @@ class Graph:
         if v not in self:
             raise KeyError(v)
 
-        return {u for u in self._v if v in self._v[u]}
+        graph = self._index()
+        i = graph.index[v]
+        return {graph.vertices[u]
+                for u in graph.pred[graph.pred_start[i]:graph.pred_start[i + 1]]}
 
     def incoming(self, v):
         """ All incoming edges for specified vertex. """
@@ -1119,13 +1492,16 @@ class Graph:
     def add_vertex(self, v):
         if v is not None and v not in self._v:
             self._v[v] = set()
+            self._indexed = None
 
     def remove_vertex(self, v):
         del self._v[v]
         for u in self._v:
             self._v[u].discard(v)
+        self._indexed = None
 
     def add_edge(self, v1, v2):
+        self._indexed = None
         if v2 is not None:
             self._v[v1].add(v2)
             if v2 not in self._v:
@@ -1143,6 +1519,7 @@ class Graph:
             raise KeyError(v2)
 
         self._v[v1].discard(v2)
+        self._indexed = None
 
         if delete and not self._v[v1] and v1 not in self.tails:
             self.remove_vertex(v1)
@@ -1196,21 +1573,62 @@ class Graph:
     def clear(self):
         """ Clears all vertices and edges from graph. """
         self._v.clear()
+        self._indexed = None
+
+    def _index(self):
+        """ Integer-indexed copy of this graph used for searches, kept until
+            the graph is modified.
+        """
+        if self._indexed is None:
+            self._indexed = _IndexedGraph(self._v, self._sort)
+
+        return self._indexed
+
+    def _chains(self):
+        """ Finds linear chains of vertices with exactly one preceding and one
+            following vertex, ending at the next vertex with multiple edges.
+
+            Chains that form a cycle by themselves are excluded.
+
+            :returns: Dictionary of vertices within chains and tuples of the
+            chain (including the vertex it ends at) and the vertex's index.
+        """
+        graph = self._index()
+        succ_start, succ = graph.succ_start, graph.succ
+        pred_start, pred = graph.pred_start, graph.pred
+
+        def linear(i):
+            return (
+                succ_start[i + 1] - succ_start[i] == 1 and
+                pred_start[i + 1] - pred_start[i] == 1 and
+                succ[succ_start[i]] != i and pred[pred_start[i]] != i
+            )
+
+        chains = {}
+        for i in range(len(graph.vertices)):
+            if not linear(i) or linear(pred[pred_start[i]]):
+                continue
+            chain = [i]
+            while linear(chain[-1]):
+                chain.append(succ[succ_start[chain[-1]]])
+            chain = [graph.vertices[j] for j in chain]
+            for j, v in enumerate(chain[:-1]):
+                chains[v] = chain, j
+
+        return chains
 
     def split(self):
         """ Splits graph into a number of connected graphs. """
-        edges = {}
+        index = {v: i for i, v in enumerate(self._v)}
+        components = _DisjointSet(len(index))
+        edges = self.edges
 
-        for new, edge in enumerate(self.edges):
-            for e in edges:
-                if e[0] in edge or e[1] in edge:
-                    edges.update({f: new for f, index in edges.items()
-                                  if index == edges[e]})
-            edges[edge] = new
+        for u, v in edges:
+            components.union(index[u], index[v])
 
         groups = collections.defaultdict(list)
-        for e, i in edges.items():
-            groups[i].append(e)
+        for e in edges:
+            groups[components.find(index[e[0]])].append(e)
 
         connected = [Graph(s, sort=self._sort) for s in groups.values()]
         isolated = [Graph(singles=[v], sort=self._sort) for v in self.isolated]
@@ -1235,41 +1653,50 @@ class Graph:
         if t is not None and t not in self:
             raise KeyError(v)
 
-        paths = {}
-        queue = collections.deque()
+        if not forward:
+            return self._search_preceding(v, t)
 
-        # Add all immediately adjacent paths to queue
-        if forward:
-            adjacent = sorted(self.following(v), key=self._sort)
-            queue.extendleft(Path([v, w]) for w in adjacent)
-        else:
-            adjacent = sorted(self.preceding(v), key=self._sort)
-            queue.extendleft(Path([u, v]) for u in adjacent)
+        tree = self.search_tree(v, t)
 
-        while queue:
-            p = queue.pop()
-            u = p[-1]
-            if u in paths:
-                # A shorter path was already found
-                continue
+        return dict(tree) if t is None else {t: tree[t]}
 
-            paths[u] = p
-            if t is not None and u == t:
-                break
-            # Add all adjacent paths to queue
-            if u != v and forward:
-                adjacent = sorted(self.following(u), key=self._sort)
-                queue.extendleft(p.append_with(w) for w in adjacent)
-            elif u != v:
-                adjacent = sorted(self.preceding(u), key=self._sort)
-                queue.extendleft(p.prepend_with(w) for w in adjacent)
-
-        # Find all vertices not covered by BFS
+    def _search_preceding(self, v, t=None):
+        """ Searches paths backwards from vertex v. """
+        graph = self._index()
+        i = graph.index[v]
+        paths = {}
+        if graph.pred_start[i] < graph.pred_start[i + 1]:
+            # Paths searched backwards always end at v so only the edge from
+            # the first preceding vertex is found
+            first = graph.vertices[graph.pred[graph.pred_start[i]]]
+            paths[v] = Path([first, v])
+
+        # Find all vertices not covered by search
         for u in self.vertices - paths.keys():
             paths[u] = Path()
 
         return paths if t is None else {t: paths[t]}
 
+    def search_tree(self, v, t=None):
+        """ Does BFS on graph to find shortest paths from vertex v to all other
+            vertices (including itself) without creating every path.
+
+            If target vertex `t` is not None, the search stops once the
+            shortest path starting at `v` and ending at `t` is found.
+
+            :returns: PathTree object mapping vertices to paths.
+        """
+        if v not in self:
+            raise KeyError(v)
+        if t is not None and t not in self:
+            raise KeyError(v)
+
+        graph = self._index()
+        root = graph.index[v]
+        target = graph.index[t] if t is not None else None
+
+        return PathTree(graph, root, *graph.search(root, target))
+
     def shortest_path(self, v1, v2):
         """ Finds the shortest path between a pair of vertices in the graph
             recursively.
@@ -1293,18 +1720,53 @@ class Graph:
             Longest paths are sorted by their vertices as to give a consistent
             result.
         """
-        paths = []
+        sort = self._sort
+        chains = self._chains()
+        exits = {c[-1] for c, _ in chains.values()}
+        trees = {}
+        longest = Path()
+
+        def compare(path):
+            nonlocal longest
+            if len(path) > len(longest):
+                longest = path
+                return
+            # Compare rankings of vertices in paths of the same length
+            for u, v in zip(path, longest):
+                key_u, key_v = sort(u), sort(v)
+                if key_u != key_v:
+                    if key_u < key_v:
+                        longest = path
+                    return
 
         for v in sorted(self):
-            paths.extend(self.search_paths(v).values())
+            if v not in chains:
+                tree = self.search_tree(v)
+                if v in exits:
+                    trees[v] = tree
+                for u in tree.reached_from(len(longest)):
+                    if tree.length(u) >= len(longest):
+                        compare(tree[u])
+                continue
 
-        if paths:
-            max_len = max(len(p) for p in paths)
-            longest_paths = sorted((p for p in paths if len(p) == max_len),
-                                   key=self.path_sort)
-            return longest_paths[0]
-        else:
-            return Path()
+            # Paths from a chain vertex follow the chain to the next vertex
+            # with multiple edges and continue with paths from that vertex
+            chain, i = chains[v]
+            head, exit_ = chain[i:-1], chain[-1]
+            if exit_ not in trees:
+                trees[exit_] = self.search_tree(exit_)
+            tree = trees[exit_]
+
+            for j in range(2, len(head) + 2):
+                if j >= len(longest):
+                    compare(Path(chain[i:i + j]))
+            on_chain = set(head[1:]) | {exit_}
+            for u in tree.reached_from(len(longest) - len(head)):
+                if u not in on_chain and \
+                        tree.length(u) + len(head) >= len(longest):
+                    compare(Path(head + list(tree[u])))
+
+        return longest
 
     def analyse(self):
         """ Finds all distinct paths for this graph and the topological order
@@ -1332,14 +1794,16 @@ class Graph:
         """
         return self.analyse()[1]
 
-    def draw(self, max_columns=None):
+    def draw(self, max_columns=None, time_limit=None):
         """ Lays out graph using sequence.
 
             :param max_columns: Maximum number of columns. If any row exceeds
             this maximum no layout will be returned.
+            :param time_limit: Time in seconds to stop ordering lines, returning
+            an approximate layout.
             :returns: Layout object with layout drawn.
         """
-        return Layout(self, max_columns=max_columns)
+        return Layout(self, max_columns=max_columns, time_limit=time_limit)
 
 
 def service_graph_stops(service_id, direction):
@@ -1402,16 +1866,401 @@ def service_graph_stops(service_id, direction):
         .group_by(models.StopPoint.atco_code, models.Locality.code)
     )
 
-    stops = {}
+    result = adj_stops.all()
+    stops = {s.StopPoint.atco_code: s.StopPoint for s in result}
+    graph = _create_graph(
+        (s.StopPoint.atco_code, s.journeys, s.sequence, s.next_stops)
+        for s in result
+    )
+
+    return graph, stops
+
+
+def _create_graph(stops):
+    """ Creates graph from stops with the number of journeys, their sequence
+        and the stops that follow them, ranked by number of journeys and
+        sequence.
+    """
     ranking = {}
     edges = []
-    for s in adj_stops.all():
-        stop = s.StopPoint
-        stops[stop.atco_code] = stop
-        ranking[stop.atco_code] = -s.journeys, s.sequence, stop.atco_code
-        edges.extend((stop.atco_code, n) for n in s.next_stops)
+    for code, journeys, sequence, next_stops in stops:
+        ranking[code] = -journeys, sequence, code
+        edges.extend((code, n) for n in next_stops)
+
+    return Graph(edges, sort=ranking.get)
+
+
+def _select_service_graphs():
+    """ Selects stops for every service and direction with the number of
+        journeys, their sequence and all following stops, as used by
+        `service_graph_stops()`.
+
+        Core expressions are used as the data is queried during population.
+    """
+    pattern = models.JourneyPattern.__table__
+    link = models.JourneyLink.__table__
+    journey = models.Journey.__table__
+    stop_point = models.StopPoint.__table__
+    locality = models.Locality.__table__
+
+    stop_refs = (
+        db.select([
+            pattern.c.service_ref,
+            pattern.c.direction,
+            pattern.c.id.label("pattern_id"),
+            link.c.sequence,
+            link.c.stop_point_ref.label("stop_ref"),
+            db.func.count(journey.c.id).label("journeys")
+        ])
+        .select_from(
+            pattern
+            .join(link, pattern.c.id == link.c.pattern_ref)
+            .join(journey, pattern.c.id == journey.c.pattern_ref)
+            .join(stop_point, link.c.stop_point_ref == stop_point.c.atco_code)
+        )
+        .where(stop_point.c.active)
+        .group_by(pattern.c.id, link.c.sequence, link.c.stop_point_ref)
+        .cte("stop_refs")
+    )
+    stop_journeys = (
+        db.select([
+            stop_refs.c.service_ref,
+            stop_refs.c.direction,
+            stop_refs.c.stop_ref,
+            db.func.max(stop_refs.c.journeys).label("max_journeys")
+        ])
+        .group_by(stop_refs.c.service_ref, stop_refs.c.direction,
+                  stop_refs.c.stop_ref)
+        .alias("stop_journeys")
+    )
+    pairs = (
+        db.select([
+            stop_refs.c.service_ref,
+            stop_refs.c.direction,
+            stop_refs.c.stop_ref.label("current"),
+            stop_refs.c.sequence,
+            db.func.lead(stop_refs.c.stop_ref)
+            .over(partition_by=stop_refs.c.pattern_id,
+                  order_by=stop_refs.c.sequence).label("next")
+        ])
+        .alias("pairs")
+    )
+
+    return (
+        db.select([
+            pairs.c.service_ref,
+            pairs.c.direction,
+            stop_point.c.atco_code,
+            db.func.max(stop_journeys.c.max_journeys).label("journeys"),
+            db.func.min(pairs.c.sequence).label("sequence"),
+            db.func.array_remove(db.func.array_agg(db.distinct(pairs.c.next)),
+                                 None).label("next_stops")
+        ])
+        .select_from(
+            stop_point
+            .join(locality, stop_point.c.locality_ref == locality.c.code)
+            .join(pairs, pairs.c.current == stop_point.c.atco_code)
+            .join(stop_journeys,
+                  (pairs.c.current == stop_journeys.c.stop_ref) &
+                  (pairs.c.service_ref == stop_journeys.c.service_ref) &
+                  (pairs.c.direction == stop_journeys.c.direction))
+        )
+        .group_by(pairs.c.service_ref, pairs.c.direction,
+                  stop_point.c.atco_code)
+        .order_by(pairs.c.service_ref, pairs.c.direction)
+    )
+
+
+def _graph_fingerprint(graph, max_columns):
+    """ Creates a canonical key for a graph from its edges with vertices
+        replaced by their rank using the graph's sort function, such that
+        graphs with the same topology and ordering share layouts.
+
+        Graphs with cycles are not given keys as the cycles picked while
+        drawing depend on the order of vertices within sets, such that a
+        relabelled layout may not match the layout drawn from the graph.
+
+        :returns: Tuple of the key and list of vertices ordered by rank, or
+        None if the ranking is not unique for each vertex or the graph has
+        cycles.
+    """
+    sort = graph.sort
+    ranked = sorted(graph, key=sort)
+    keys = [sort(v) for v in ranked]
+    if any(a == b for a, b in zip(keys, keys[1:])):
+        return None
+
+    components = _strong_components(graph)
+    if (len(set(components.values())) < len(components) or
+            any(u == v for u, v in graph.edges)):
+        return None
+
+    rank = {v: i for i, v in enumerate(ranked)}
+    edges = sorted((rank[u], rank[v]) for u, v in graph.edges)
+    data = repr((_LAYOUT_CACHE_VERSION, max_columns, len(ranked), edges))
+    key = hashlib.blake2b(data.encode(), digest_size=20).hexdigest()
+
+    return key, ranked
+
+
+def _relabel_layout(data, label):
+    """ Replaces vertices in sequence, paths and layout data using a function.
+        Empty rows in the sequence or layout denoted by None are kept.
+    """
+    sequence, paths, layout = data
+
+    def _label(v):
+        return label(v) if v is not None else None
+
+    return (
+        [_label(v) for v in sequence],
+        [[_label(v) for v in p] for p in paths],
+        ([[_label(v), c, [list(q) for q in p]] for v, c, p in layout]
+         if layout is not None else None)
+    )
+
+
+def _draw_layout(graph, max_columns, time_limit=None):
+    paths, sequence = graph.analyse()
+    try:
+        layout = graph.draw(max_columns, time_limit)
+    except MaxColumnError:
+        layout, approximate = None, False
+    else:
+        layout, approximate = layout.serialize(), layout.approximate
+
+    return list(sequence), [list(p) for p in paths], layout, approximate
+
+
+def _layout_data(graph, max_columns=MAX_COLUMNS, time_limit=None):
+    """ Analyses and draws graph, reusing results from graphs with the same
+        topology and ranking held in the layout cache.
+
+        :param time_limit: Time in seconds to stop ordering lines. Approximate
+        layouts are not cached.
+        :returns: Tuple of the sequence, paths as lists of vertices, the
+        serialized layout, or None if the layout would exceed the maximum
+        number of columns, and whether the layout is approximate. The sequence
+        is copied after drawing as the layout may add a row for cycles before
+        the first vertex.
+    """
+    fingerprint = _graph_fingerprint(graph, max_columns)
+    if fingerprint is None:
+        return _draw_layout(graph, max_columns, time_limit)
+
+    key, ranked = fingerprint
+    cached = _layout_cache.get(key)
+    if cached is not None:
+        return (*_relabel_layout(cached, ranked.__getitem__), False)
 
-    return Graph(edges, sort=ranking.get), stops
+    *data, approximate = _draw_layout(graph, max_columns, time_limit)
+    if not approximate:
+        rank = {v: i for i, v in enumerate(ranked)}
+        _layout_cache.set(key, _relabel_layout(data, rank.__getitem__))
+
+    return (*data, approximate)
+
+
+def _compute_layout(item):
+    """ Creates a row of layout data for a service and direction from its
+        stops. Used as a worker function for `compute_layouts()`.
+    """
+    (service_id, direction), stops = item
+    sequence, paths, layout, _ = _layout_data(_create_graph(stops))
+
+    return {
+        "service_ref": service_id,
+        "direction": direction,
+        "sequence": sequence,
+        "paths": paths,
+        "layout": layout
+    }
+
+
+def compute_layouts(connection, jobs=1):
+    """ Queries stops for all services in bulk and analyses and draws their
+        graphs, over a pool of processes if more than one job is specified.
+
+        :param connection: Connection to query stops with.
+        :param jobs: Number of processes to use. If None, the number of CPUs
+        is used.
+        :returns: List of rows with service, direction, sequence, paths and
+        layout.
+    """
+    logger.info("Querying stops for all services to create layouts")
+    result = connection.execute(_select_service_graphs())
+    groups = [
+        (key, [(s.atco_code, s.journeys, s.sequence, s.next_stops)
+               for s in stops])
+        for key, stops in itertools.groupby(
+            result, key=lambda r: (r.service_ref, r.direction)
+        )
+    ]
+    total = len(groups)
+    step = max(total // 10, 1)
+
+    def _log_progress(rows):
+        for i, row in enumerate(rows, 1):
+            if i % step == 0 or i == total:
+                logger.info(f"Created {i} of {total} service layouts")
+            yield row
+
+    if jobs == 1 or total <= 1:
+        logger.info(f"Creating {total} service layouts")
+        return list(_log_progress(map(_compute_layout, groups)))
+
+    processes = jobs or os.cpu_count()
+    logger.info(f"Creating {total} service layouts with {processes} "
+                f"processes")
+    with multiprocessing.Pool(processes) as pool:
+        chunk_size = max(min(total // (4 * processes), 64), 1)
+        rows = pool.imap_unordered(_compute_layout, groups, chunk_size)
+        return list(_log_progress(rows))
+
+
+def _layout_csv_row(row):
+    """ Converts a row of layout data for use with the COPY command. """
+    sequence = ",".join(
+        "NULL" if v is None else
+        '"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for v in row["sequence"]
+    )
+
+    return {
+        "service_ref": row["service_ref"],
+        "direction": row["direction"],
+        "sequence": "{" + sequence + "}",
+        "paths": json.dumps(row["paths"]),
+        "layout": json.dumps(row["layout"]) if row["layout"] is not None
+        else None
+    }
+
+
+def copy_layouts(connection, table, jobs=1):
+    """ Computes layouts for all services and copies them to a table.
+
+        :param connection: Connection to query stops and copy data with.
+        :param table: Table with same columns as the service layout table.
+        :param jobs: Number of processes to use. If None, the number of CPUs
+        is used.
+    """
+    rows = compute_layouts(connection, jobs)
+    logger.info(f"Copying {len(rows)} service layouts to {table.name!r}")
+    populate_utils.copy_entries(connection, table, list(map(_layout_csv_row, rows)))
+
+
+@models.data.register_model(models.ServiceLayout)
+def insert_service_layouts(connection):
+    """ Analyses and draws graphs for all services and directions. """
+    temp_layouts = db.Table(
+        "temp_service_layout",
+        db.MetaData(),
+        db.Column("service_ref", db.Integer, autoincrement=False),
+        db.Column("direction", db.Boolean),
+        db.Column("sequence", pg.ARRAY(db.Text, dimensions=1)),
+        db.Column("paths", pg.JSONB),
+        db.Column("layout", pg.JSONB),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP"
+    )
+    temp_layouts.create(connection)
+    copy_layouts(connection, temp_layouts,
+                 current_app.config.get("POPULATE_JOBS", 1) or None)
+
+    return [db.select([temp_layouts])]
+
+
+def refresh_layouts(jobs=None):
+    """ Replaces all service layouts with newly computed layouts.
+
+        :param jobs: Number of processes to use. If None, the number of CPUs
+        is used.
+    """
+    table = models.ServiceLayout.__table__
+    with db.engine.begin() as connection:
+        populate_utils.acquire_table_lock(connection, table)
+        connection.execute(table.delete())
+        copy_layouts(connection, table, jobs)
+
+
+def service_layout(service_id, direction, max_columns=MAX_COLUMNS,
+                   time_limit=None):
+    """ Gets sequence, paths and layout for a service, using the precomputed
+        layout if one exists.
+
+        :param service_id: Service ID.
+        :param direction: Groups journey patterns by direction - False for
+        outbound and True for inbound.
+        :param max_columns: Maximum columns before giving up on drawing graph.
+        :param time_limit: Time in seconds to stop ordering lines if the layout
+        has to be drawn.
+        :returns: Tuple of sequence, paths as lists of vertices, the serialized
+        layout (None if the graph can't be drawn), whether the layout is
+        approximate and a dict of stop models with ATCO codes as keys.
+    """
+    precomputed = None
+    if max_columns == MAX_COLUMNS:
+        precomputed = models.ServiceLayout.query.get((service_id, direction))
+
+    if precomputed is None:
+        graph, stops = service_graph_stops(service_id, direction)
+        data = _layout_data(graph, max_columns, time_limit)
+        return (*data, stops)
+
+    return (
+        precomputed.sequence,
+        precomputed.paths,
+        precomputed.layout,
+        False,
+        _query_stops(precomputed.sequence)
+    )
+
+
+def _query_stops(sequence):
+    """ Gets dict of stop models with ATCO codes as keys for vertices in a
+        sequence, skipping empty rows.
+    """
+    stops = (
+        models.StopPoint.query
+        .options(db.contains_eager(models.StopPoint.locality))
+        .join(models.StopPoint.locality)
+        .filter(models.StopPoint.atco_code.in_(
+            [v for v in sequence if v is not None]
+        ))
+        .all()
+    )
+
+    return {s.atco_code: s for s in stops}
+
+
+def service_sequence(service_id, direction):
+    """ Gets sequence of stops for a service, using the precomputed layout if
+        one exists. Otherwise the sequence is found from the graph without
+        drawing the layout.
+
+        :param service_id: Service ID.
+        :param direction: Groups journey patterns by direction - False for
+        outbound and True for inbound.
+        :returns: Tuple of list of ATCO codes without empty rows and a dict of
+        stop models with ATCO codes as keys.
+    """
+    precomputed = models.ServiceLayout.query.get((service_id, direction))
+    if precomputed is None:
+        graph, stops = service_graph_stops(service_id, direction)
+        return list(graph.sequence()), stops
+
+    sequence = [v for v in precomputed.sequence if v is not None]
+
+    return sequence, _query_stops(sequence)
+
+
+def layout_time_limit():
+    """ Time limit in seconds for drawing layouts within a request, set by
+        ``LAYOUT_TIME_LIMIT`` in milliseconds.
+    """
+    limit = current_app.config.get("LAYOUT_TIME_LIMIT")
+
+    return limit / 1000 if limit is not None and limit >= 0 else None
 
 
 def service_graph(service_id, direction):
@@ -1484,12 +2333,9 @@ def service_json(service_code, reverse, max_columns=MAX_COLUMNS):
         "destination": s.destination
     } for s in service.similar(reverse_, 0.5)]
 
-    graph, stops = service_graph_stops(service.id, reverse_)
-    paths, sequence = graph.analyse()
-    try:
-        layout = graph.draw(max_columns).serialize()
-    except MaxColumnError:
-        layout = None
+    sequence, paths, layout, approximate, stops = service_layout(
+        service.id, reverse_, max_columns, layout_time_limit()
+    )
 
     # Serialise data
     paths = {
@@ -1516,6 +2362,7 @@ def service_json(service_code, reverse, max_columns=MAX_COLUMNS):
         "sequence": sequence,
         "paths": paths,
         "layout": layout,
+        "layoutApproximate": approximate,
         "other": other_services
     }
 
@@ -1,12 +1,187 @@
+from concurrent import futures
+import functools
+import threading
+import time
+
 from flask import current_app
+from requests import RequestException
 
+from nextbus import cache
+import nextbus.live.circuit
+import nextbus.live.quota
 import nextbus.live.tapi
 import nextbus.live.timetabled
 
 
-def get_times(atco_code, use_live):
-    """ Get bus times at this stop point. """
-    if use_live and current_app.config.get("TRANSPORT_API_ACTIVE"):
-        return tapi.get_nextbus_times(atco_code)
+# Times for each stop shared by requests within the time to live
+_times_cache = cache.Cache("live", maxsize=1024)
+
+# Circuit breaker and quota for live data in this process, created from the
+# config
+_breaker = None
+_quota = None
+_lock = threading.Lock()
+
+
+def get_breaker():
+    """ Gets the circuit breaker for requesting live data. """
+    global _breaker
+
+    with _lock:
+        if _breaker is None:
+            config = current_app.config
+            slow = config.get("LIVE_BREAKER_SLOW")
+            _breaker = circuit.CircuitBreaker(
+                "tapi",
+                failures=config.get("LIVE_BREAKER_FAILURES") or 5,
+                window=config.get("LIVE_BREAKER_WINDOW") or 60,
+                slow=slow / 1000 if slow else None,
+                reset=config.get("LIVE_BREAKER_RESET") or 30,
+            )
+
+        return _breaker
+
+
+def get_quota():
+    """ Gets the quota of live data requests for this process. """
+    global _quota
+
+    with _lock:
+        if _quota is None:
+            block = current_app.config.get("TRANSPORT_API_QUOTA_BLOCK") or 1
+            _quota = quota.Quota(block)
+
+        return _quota
+
+
+def _within_limit():
+    """ Checks whether live times can be requested within the daily limit,
+        counting the request.
+    """
+    return get_quota().take(current_app.config.get("TRANSPORT_API_LIMIT"))
+
+
+def _timed_nextbus_times(atco_code):
+    """ Requests live times, returning times and the duration in seconds. """
+    start = time.monotonic()
+    times = tapi.get_nextbus_times(atco_code)
+
+    return times, time.monotonic() - start
+
+
+def _with_app_context(app, func, *args):
+    """ Calls function within an app context, such that it can be called from
+        another thread.
+    """
+    with app.app_context():
+        return func(*args)
+
+
+def _request_live_times(atco_codes):
+    """ Requests live times for stops concurrently, as far as the circuit
+        breaker and daily limit allow.
+
+        :returns: Dictionary with ATCO codes as keys, excluding stops where
+        live times were not requested or the request failed.
+    """
+    breaker = get_breaker()
+    allowed = []
+    for code in atco_codes:
+        if not breaker.allow():
+            break
+        if not _within_limit():
+            breaker.release()
+            break
+        allowed.append(code)
+
+    if len(allowed) > 1:
+        app = current_app._get_current_object()
+        workers = current_app.config.get("LIVE_BATCH_WORKERS") or 1
+        with futures.ThreadPoolExecutor(min(len(allowed), workers)) as pool:
+            calls = [
+                pool.submit(_with_app_context, app, _timed_nextbus_times,
+                            code).result
+                for code in allowed
+            ]
     else:
-        return timetabled.get_timetabled_times(atco_code)
+        calls = [functools.partial(_timed_nextbus_times, code)
+                 for code in allowed]
+
+    live_times = {}
+    for code, call in zip(allowed, calls):
+        try:
+            times, duration = call()
+        except (RequestException, ValueError):
+            breaker.failure()
+            current_app.logger.warning(
+                f"Error occurred when retrieving live times for {code!r}; "
+                f"using timetabled times instead",
+                exc_info=True
+            )
+            continue
+        except BaseException:
+            breaker.failure()
+            raise
+        breaker.success(duration)
+        live_times[code] = times
+
+    return live_times
+
+
+def _request_times(atco_code):
+    if current_app.config.get("TRANSPORT_API_ACTIVE"):
+        times = _request_live_times([atco_code]).get(atco_code)
+        if times is not None:
+            return times
+
+    return timetabled.get_timetabled_times(atco_code)
+
+
+def get_times(atco_code):
+    """ Get bus times at this stop point.
+
+        Times are shared by all requests for the same stop within
+        LIVE_CACHE_TTL seconds, such that only one request is made for live
+        times or the timetable.
+    """
+    ttl = current_app.config.get("LIVE_CACHE_TTL")
+    if not ttl or ttl < 0:
+        return _request_times(atco_code)
+
+    return _times_cache.get_or_set(atco_code,
+                                   lambda: _request_times(atco_code), ttl)
+
+
+def get_times_at_stops(atco_codes):
+    """ Get bus times at several stop points.
+
+        Times already shared by other requests are reused. Live times for the
+        rest are requested concurrently, and timetabled times are found with a
+        single query for stops without live times.
+
+        :returns: Dictionary with ATCO codes as keys.
+    """
+    ttl = current_app.config.get("LIVE_CACHE_TTL")
+    shared = ttl and ttl > 0
+
+    times = {}
+    missing = []
+    for code in atco_codes:
+        value = _times_cache.get(code) if shared else None
+        if value is not None:
+            times[code] = value
+        else:
+            missing.append(code)
+
+    if missing and current_app.config.get("TRANSPORT_API_ACTIVE"):
+        times.update(_request_live_times(missing))
+
+    remaining = [code for code in missing if code not in times]
+    if remaining:
+        times.update(timetabled.get_timetabled_times_at_stops(remaining))
+
+    if shared:
+        for code in missing:
+            _times_cache.set(code, times[code], ttl)
+
+    return {code: times[code] for code in atco_codes}
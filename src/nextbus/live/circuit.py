@@ -0,0 +1,160 @@
+"""
+Circuit breaker to stop requesting live data while the API is failing.
+"""
+import collections
+import threading
+import time
+
+from nextbus.logger import app_logger
+
+
+logger = app_logger.getChild("circuit")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """ Stops calls to a service after a number of failed or slow calls within
+        a window of time. After a delay the breaker is half open and allows a
+        single call to probe the service, closing again if it succeeds.
+
+        State is kept for each process.
+
+        :param name: Name of the service, used for logging.
+        :param failures: Number of failures within the window to open the
+        breaker.
+        :param window: Seconds failures are counted within.
+        :param slow: Calls taking longer than this number of seconds are
+        counted as failures. Ignored if None.
+        :param reset: Seconds to wait while open before probing the service.
+        :param clock: Function returning time in seconds.
+    """
+    def __init__(self, name, failures=5, window=60, slow=None, reset=30,
+                 clock=time.monotonic):
+        if failures < 1:
+            raise ValueError("Number of failures must be at least 1.")
+
+        self.name = name
+        self.failures = failures
+        self.window = window
+        self.slow = slow
+        self.reset = reset
+        self.counts = collections.Counter()
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failed = collections.deque()
+        self._opened = None
+        self._probing = False
+
+    def __repr__(self):
+        return f"<CircuitBreaker({self.name!r}, {self.state!r})>"
+
+    @property
+    def state(self):
+        """ Current state: closed, open or half-open. """
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if (self._state == OPEN and
+                self._clock() - self._opened >= self.reset):
+            logger.info(f"Circuit for {self.name!r} half open")
+            self._state = HALF_OPEN
+            self._probing = False
+
+        return self._state
+
+    def _open(self, now):
+        logger.warning(f"Circuit for {self.name!r} opened after failures")
+        self._state = OPEN
+        self._opened = now
+        self._probing = False
+        self._failed.clear()
+        self.counts["opened"] += 1
+
+    def _close(self):
+        logger.info(f"Circuit for {self.name!r} closed")
+        self._state = CLOSED
+        self._opened = None
+        self._probing = False
+        self._failed.clear()
+
+    def _expire(self, now):
+        while self._failed and now - self._failed[0] > self.window:
+            self._failed.popleft()
+
+    def _record_failure(self):
+        now = self._clock()
+        state = self._current_state()
+        if state == HALF_OPEN:
+            self._open(now)
+        elif state == CLOSED:
+            self._failed.append(now)
+            self._expire(now)
+            if len(self._failed) >= self.failures:
+                self._open(now)
+
+    def allow(self):
+        """ Checks whether a call can be made, taking the single probe call if
+            half open. The result of the call must be recorded with
+            `success()` or `failure()`, or `release()` if not made.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                self.counts["allowed"] += 1
+                return True
+            elif state == HALF_OPEN and not self._probing:
+                self._probing = True
+                self.counts["probes"] += 1
+                return True
+            else:
+                self.counts["rejected"] += 1
+                return False
+
+    def release(self):
+        """ Releases a call allowed but not made, such that another call can
+            probe the service if half open.
+        """
+        with self._lock:
+            self._probing = False
+
+    def success(self, duration=None):
+        """ Records a successful call, counting it as a failure if slower than
+            the limit.
+
+            :param duration: Time taken by the call in seconds.
+        """
+        with self._lock:
+            if (self.slow is not None and duration is not None and
+                    duration > self.slow):
+                self.counts["slow"] += 1
+                self._record_failure()
+                return
+
+            self.counts["successes"] += 1
+            if self._current_state() == HALF_OPEN:
+                self._close()
+
+    def failure(self):
+        """ Records a failed call. """
+        with self._lock:
+            self.counts["failures"] += 1
+            self._record_failure()
+
+    def to_json(self):
+        """ Serializes state and counts of calls since starting as JSON. """
+        with self._lock:
+            state = self._current_state()
+            self._expire(self._clock())
+
+            return {
+                "name": self.name,
+                "state": state,
+                "recentFailures": len(self._failed),
+                "counts": dict(self.counts),
+            }
@@ -0,0 +1,82 @@
+"""
+Daily quota of live data requests shared by workers.
+"""
+import datetime
+import threading
+
+from nextbus import models
+
+
+class Quota:
+    """ Hands out calls within the daily limit from blocks reserved in the
+        request log, such that the log is updated once for each block instead
+        of for every call.
+
+        Calls reserved by a worker but not used by the end of the day are lost,
+        so fewer calls than the limit may be made but the limit is never
+        exceeded, other than by calls from a block reserved just before 00:00
+        UTC being used afterwards.
+
+        If there is no limit, calls are recorded in the log after they are
+        made instead, once for each block.
+
+        :param block: Number of calls to reserve at once.
+    """
+    def __init__(self, block=50):
+        if block < 1:
+            raise ValueError("Block of calls must be at least 1.")
+
+        self.block = block
+        self._lock = threading.Lock()
+        self._date = None
+        self._remaining = 0
+        self._exhausted = False
+        self._unrecorded = 0
+
+    def __repr__(self):
+        return f"<Quota({self.block!r}, {self._remaining!r} remaining)>"
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.now(datetime.timezone.utc).date()
+
+    def take(self, limit):
+        """ Takes a call, reserving another block if none are left.
+
+            :param limit: The limit on number of calls each day starting at
+            00:00 UTC. Ignored if is None or negative.
+            :returns: True if the call is within the limit.
+        """
+        if limit is None or limit < 0:
+            self._record()
+            return True
+
+        today = self._today()
+        with self._lock:
+            if self._date != today:
+                self._date = today
+                self._remaining = 0
+                self._exhausted = False
+
+            if not self._remaining and not self._exhausted:
+                self._remaining = models.RequestLog.reserve(limit, self.block)
+                # Don't try again today once no calls are left
+                self._exhausted = not self._remaining
+
+            if not self._remaining:
+                return False
+
+            self._remaining -= 1
+            return True
+
+    def _record(self):
+        """ Counts a call made without a limit, adding calls to the log once a
+            block has been made.
+        """
+        with self._lock:
+            self._unrecorded += 1
+            if self._unrecorded < self.block:
+                return
+            calls, self._unrecorded = self._unrecorded, 0
+
+        models.RequestLog.record(calls)
@@ -1,16 +1,94 @@
 """
 Interacts with Transport API to retrieve live bus times data.
 """
+import os
+import threading
+
 import dateutil.parser
 import dateutil.tz
 import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app
+from urllib3.util.retry import Retry
 
 GB_TZ = dateutil.tz.gettz("Europe/London")
 
 URL_API = r"https://transportapi.com/v3/uk/bus/stop/{code}/live.json"
 URL_FCC = r"http://fcc.transportapi.com/v3/uk/bus/stop/{code}/live.json"
 
+# Seconds to wait before retrying, doubled for each retry after the first
+RETRY_BACKOFF = 0.2
+# Gateway errors and unavailable service are transient; other errors are not
+# expected to succeed when repeated
+RETRY_STATUSES = (502, 503, 504)
+
+# Session for each process, as connection pools are not shared after forking
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _create_session():
+    """ Creates session with a connection pool and retries as configured.
+
+        Connection errors and server errors are retried, but read timeouts are
+        not such that a slow response holds a worker for the read timeout at
+        most once.
+    """
+    retries = current_app.config.get("TRANSPORT_API_RETRIES") or 0
+    pool_size = current_app.config.get("TRANSPORT_API_POOL_SIZE") or 10
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=False,
+        status=retries,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def get_session():
+    """ Gets the session for this process, creating it if necessary. """
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = _create_session()
+            _session_pid = os.getpid()
+
+        return _session
+
+
+def close_session():
+    """ Closes the session for this process and its pooled connections. """
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def _timeout():
+    """ Gets tuple of connect and read timeouts in seconds from milliseconds
+        in the config, or None for either if not set.
+    """
+    connect = current_app.config.get("TRANSPORT_API_CONNECT_TIMEOUT")
+    read = current_app.config.get("TRANSPORT_API_READ_TIMEOUT")
+
+    return (connect / 1000 if connect else None,
+            read / 1000 if read else None)
+
 
 def get_live_data(atco_code, nextbuses=True, group=True, limit=6):
     """ Retrieves data from the NextBuses API via Transport API. If
@@ -49,7 +127,8 @@ def get_live_data(atco_code, nextbuses=True, group=True, limit=6):
     current_app.logger.debug(
         f"Requesting live data for ATCO code {atco_code}"
     )
-    response = requests.get(url.format(code=atco_code), params=parameters)
+    response = get_session().get(url.format(code=atco_code),
+                                 params=parameters, timeout=_timeout())
     response.raise_for_status()
     try:
         data = response.json()
@@ -10,15 +10,15 @@ from nextbus import timetable
 GB_TZ = dateutil.tz.gettz("Europe/London")
 
 
-def get_timetabled_times(atco_code, timestamp=None):
-    """ Get all services stopping at specified stop point in the next hour. """
+def _timestamp(timestamp=None):
     if timestamp is None:
-        ts = datetime.datetime.now(datetime.timezone.utc)
+        return datetime.datetime.now(datetime.timezone.utc)
     else:
-        ts = timestamp
+        return timestamp
 
-    result = timetable.get_next_services(atco_code, ts)
 
+def _times_json(atco_code, ts, result):
+    """ Groups services stopping at a stop point by line and operator. """
     services = []
     for row in result:
         # Group services by line and operator
@@ -56,3 +56,24 @@ def get_timetabled_times(atco_code, timestamp=None):
         "localTime": ts.astimezone(GB_TZ).strftime("%H:%M"),
         "services": services
     }
+
+
+def get_timetabled_times(atco_code, timestamp=None):
+    """ Get all services stopping at specified stop point in the next hour. """
+    ts = _timestamp(timestamp)
+    result = timetable.get_next_services(atco_code, ts)
+
+    return _times_json(atco_code, ts, result)
+
+
+def get_timetabled_times_at_stops(atco_codes, timestamp=None):
+    """ Get all services stopping at each of the specified stop points in the
+        next hour with a single query.
+
+        :returns: Dictionary with ATCO codes as keys.
+    """
+    ts = _timestamp(timestamp)
+    results = timetable.get_next_services_at_stops(atco_codes, ts)
+
+    return {code: _times_json(code, ts, result)
+            for code, result in results.items()}
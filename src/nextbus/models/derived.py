@@ -1,8 +1,10 @@
 """
 Materialized views for the nextbus package.
 """
+import datetime
 import functools
 
+import flask
 from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.types import UserDefinedType
 
@@ -10,7 +12,7 @@ from nextbus import db
 from nextbus.models import utils
 from nextbus.models.tables import (
     Region, AdminArea, District, Locality, StopArea, StopPoint,
-    JourneyPattern, JourneyLink, Service, Operator, LocalOperator
+    JourneyPattern, JourneyLink, Journey, Service, Operator, LocalOperator
 )
 
 
@@ -572,3 +574,134 @@ def insert_service_pairs(connection):
         ])
         .where((la.c.count > 0) & (lb.c.count > 0) & (lc.c.count > 0))
     ]
+
+
+class ServiceLayout(db.Model):
+    """ Precomputed sequences, paths and diagram layouts for services in each
+        direction, created from graphs of stops during population.
+    """
+    __tablename__ = "service_layout"
+
+    service_ref = db.Column(db.Integer,
+                            db.ForeignKey("service.id", ondelete="CASCADE"),
+                            primary_key=True, autoincrement=False)
+    direction = db.Column(db.Boolean, primary_key=True)
+    sequence = db.Column(pg.ARRAY(db.Text, dimensions=1), nullable=False)
+    paths = db.Column(pg.JSONB, nullable=False)
+    layout = db.Column(pg.JSONB, nullable=True)
+
+
+class JourneyCalendar(db.Model):
+    """ Dates each journey runs on over a number of days from the start date,
+        as bit strings with the first bit for the start date.
+    """
+    __tablename__ = "journey_calendar"
+
+    journey_ref = db.Column(db.Integer,
+                            db.ForeignKey("journey.id", ondelete="CASCADE"),
+                            primary_key=True, autoincrement=False)
+    date_start = db.Column(db.Date, nullable=False)
+    dates = db.Column(pg.BIT(varying=True), nullable=False)
+
+
+class StopDeparture(db.Model):
+    """ Departures for every journey at each stop with the local time of day,
+        used to find journeys leaving stops within a time range.
+    """
+    __tablename__ = "stop_departure"
+
+    journey_ref = db.Column(db.Integer,
+                            db.ForeignKey("journey.id", ondelete="CASCADE"),
+                            primary_key=True, autoincrement=False)
+    sequence = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    stop_point_ref = db.Column(db.VARCHAR(12), nullable=False)
+    time = db.Column(db.Time, nullable=False)
+    t_offset = db.Column(db.Interval, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_stop_departure_stop_point_ref_time", "stop_point_ref",
+                 "time"),
+    )
+
+
+@utils.data.register_model(StopDeparture)
+def insert_stop_departures(connection):
+    """ Uses journey data to find departures at every stop. """
+    data = Journey.record_set()
+    journey = Journey.__table__
+
+    return [
+        db.select([
+            journey.c.id,
+            data.c.sequence,
+            data.c.stop_point_ref,
+            # Adding intervals to times wraps around midnight
+            db.cast(journey.c.departure + data.c.depart, db.Time),
+            data.c.depart
+        ])
+        .select_from(journey.join(data, db.true()))
+        .where(
+            data.c.stopping &
+            data.c.stop_point_ref.isnot(None) &
+            data.c.depart.isnot(None)
+        )
+    ]
+
+
+class JourneyFrequency(db.Model):
+    """ Bands of journeys on the same pattern with identical days, calendars
+        and running times departing at a constant headway.
+    """
+    __tablename__ = "journey_frequency"
+
+    # First journey in band
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    pattern_ref = db.Column(
+        db.Integer,
+        db.ForeignKey("journey_pattern.id", ondelete="CASCADE"),
+        nullable=False, index=True
+    )
+    time_start = db.Column(db.Time, nullable=False)
+    time_end = db.Column(db.Time, nullable=False)
+    headway = db.Column(db.Interval, nullable=False)
+    journeys = db.Column(pg.ARRAY(db.Integer, dimensions=1), nullable=False)
+
+
+class DataVersion(db.Model):
+    """ Time derived models were last refreshed, used to invalidate caches
+        created from this data.
+    """
+    __tablename__ = "data_version"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    refreshed = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    @classmethod
+    def current(cls):
+        """ Gets the current version as a string of digits, or None if data
+            has not been refreshed.
+
+            The version only changes with population, so it is queried once
+            for each request and kept for the rest of the request.
+        """
+        if flask.has_request_context() and "data_version" in flask.g:
+            return flask.g.data_version
+
+        refreshed = db.session.query(cls.refreshed).scalar()
+        if refreshed is None:
+            version = None
+        else:
+            version = refreshed.astimezone(datetime.timezone.utc).strftime(
+                "%Y%m%d%H%M%S%f"
+            )
+
+        if flask.has_request_context():
+            flask.g.data_version = version
+
+        return version
+
+
+@utils.data.register_model(DataVersion)
+def insert_data_version(connection):
+    """ Sets the version to the time of this refresh. """
+    return [db.select([db.literal_column("1"), db.func.now()])]
@@ -11,6 +11,10 @@ from nextbus.models import utils
 MIN_GROUPED = 72
 MAX_DIST = 500
 
+# Flags for each stop in journey data
+TIMING_POINT = 1
+STOPPING = 2
+
 # Aliases for tables or views not yet defined
 _stop_point = db.table("stop_point", db.column("atco_code"),
                        db.column("stop_area_ref"), db.column("active"))
@@ -1028,7 +1032,6 @@ class Journey(db.Model):
         nullable=True, index=True
     )
     departure = db.Column(db.Time, nullable=False)
-    # Add frequency?
     # Use bitwise operators for ISO day of week (1-7) and week of month (0-4)
     days = db.Column(db.SmallInteger, db.CheckConstraint("days < 256"),
                      nullable=False)
@@ -1040,7 +1043,18 @@ class Journey(db.Model):
     note_code = db.Column(db.Text)
     note_text = db.Column(db.Text)
 
-    data = db.deferred(db.Column(pg.JSONB, nullable=True))
+    # Parallel arrays for stops in journey, with arrival and departure times as
+    # seconds after journey departure
+    stop_refs = db.deferred(db.Column(pg.ARRAY(db.Text, dimensions=1)),
+                            group="data")
+    sequences = db.deferred(db.Column(pg.ARRAY(db.Integer, dimensions=1)),
+                            group="data")
+    flags = db.deferred(db.Column(pg.ARRAY(db.SmallInteger, dimensions=1)),
+                        group="data")
+    arrive = db.deferred(db.Column(pg.ARRAY(db.Integer, dimensions=1)),
+                         group="data")
+    depart = db.deferred(db.Column(pg.ARRAY(db.Integer, dimensions=1)),
+                         group="data")
 
     include_holiday_dates = db.relationship(
         "BankHolidayDate",
@@ -1062,24 +1076,41 @@ class Journey(db.Model):
                                    lazy="raise")
 
     @classmethod
-    def record_set(cls, column=None):
-        """ Get the defined record set from the JSON data in the links column.
+    def record_set(cls):
+        """ Get the record set of stops from the journey data arrays, to be
+            joined laterally with the journey table.
         """
-        return (
-            db.func.jsonb_to_recordset(column or cls.data)
+        links = (
+            db.func.unnest(cls.stop_refs, cls.sequences, cls.flags, cls.arrive,
+                           cls.depart)
             .table_valued(
                 db.column("stop_point_ref", db.Text),
-                db.column("timing_point", db.Boolean),
-                db.column("stopping", db.Boolean),
                 db.column("sequence", db.Integer),
-                db.column("arrive", db.Interval),
-                db.column("depart", db.Interval)
+                db.column("flags", db.SmallInteger),
+                db.column("arrive", db.Integer),
+                db.column("depart", db.Integer)
             )
-            .render_derived("data", with_types=True)
+            .render_derived("links")
+        )
+        second = db.cast(db.literal_column("'1 second'"), db.Interval)
+        zero = db.literal_column("0")
+
+        return (
+            db.select([
+                links.c.stop_point_ref,
+                (links.c.flags.op("&")(TIMING_POINT) > zero)
+                .label("timing_point"),
+                (links.c.flags.op("&")(STOPPING) > zero).label("stopping"),
+                links.c.sequence,
+                (links.c.arrive * second).label("arrive"),
+                (links.c.depart * second).label("depart"),
+            ])
+            .lateral("data")
         )
 
 
-@utils.data.register_columns(Journey, "data")
+@utils.data.register_columns(Journey, "stop_refs", "sequences", "flags",
+                             "arrive", "depart")
 def insert_journey_data(connection):
     # Split the queries into each region
     result = connection.execute(db.select([Region.code])).all()
@@ -1174,23 +1205,30 @@ def _create_journey_data_query(region):
         .cte("times")
     )
 
-    # Take the record set from the CTE and build a JSON array of objects
-    build_object = db.func.jsonb_build_object(
-        "stop_point_ref",
-        times.c.stop_point_ref,
-        "timing_point",
-        times.c.timing_point,
-        "stopping",
-        times.c.stopping,
-        "sequence",
-        times.c.sequence,
-        "arrive",
-        times.c.arrive,
-        "depart",
-        times.c.depart
+    # Aggregate the record set from the CTE into arrays ordered by sequence
+    def array_agg(column):
+        return pg.array_agg(pg.aggregate_order_by(column, times.c.sequence))
+
+    def seconds(column):
+        return db.cast(db.extract("EPOCH", column), db.Integer)
+
+    flags = db.cast(
+        db.case([(times.c.timing_point, TIMING_POINT)], else_=0) +
+        db.case([(times.c.stopping, STOPPING)], else_=0),
+        db.SmallInteger
+    )
+
+    return (
+        db.select([
+            times.c.id,
+            array_agg(times.c.stop_point_ref).label("stop_refs"),
+            array_agg(times.c.sequence).label("sequences"),
+            array_agg(flags).label("flags"),
+            array_agg(seconds(times.c.arrive)).label("arrive"),
+            array_agg(seconds(times.c.depart)).label("depart"),
+        ])
+        .group_by(times.c.id)
     )
-    array = db.func.jsonb_agg(build_object).label("data")
-    return db.select([times.c.id, array]).group_by(times.c.id)
 
 
 class Organisation(db.Model):
@@ -1278,28 +1316,49 @@ class RequestLog(db.Model):
     call_count = db.Column(db.Integer, nullable=False)
 
     @classmethod
-    def call(cls, limit):
-        """ Request a call, checking whether it was within the daily limit.
-            :param limit: The limit on number of calls each day starting at
-            00:00 UTC. Ignored if is None or negative.
+    def _calls_today(cls):
+        """ Creates expression for the number of calls made today, or 0 if the
+            last call was made on an earlier day.
         """
         tz = db.bindparam("utc", "UTC")
-        one = db.literal_column("1")
         today = db.func.date(db.func.timezone(tz, db.func.now()))
         date_last_called = db.func.date(db.func.timezone(tz, cls.last_called))
 
-        statement = (
-            db.update(cls)
-            .values(
-                last_called=db.func.now(),
-                call_count=db.case(
-                    (date_last_called < today, one),
-                    else_=cls.call_count + one,
-                ),
+        return db.case(
+            (date_last_called < today, db.literal_column("0")),
+            else_=cls.call_count,
+        )
+
+    @classmethod
+    def _count_calls(cls, calls, limit=None):
+        """ Creates statement adding a number of calls to the count for today,
+            returning the new count. If a limit is set, only calls within the
+            limit are added.
+        """
+        p_calls = db.literal_column(str(int(calls)))
+        count = cls._calls_today()
+        if limit is not None:
+            p_limit = db.literal_column(str(int(limit)))
+            added = db.func.least(
+                p_calls,
+                db.func.greatest(p_limit - count, db.literal_column("0")),
             )
+        else:
+            added = p_calls
+
+        return (
+            db.update(cls)
+            .values(last_called=db.func.now(), call_count=count + added)
             .returning(cls.call_count)
         )
-        count = db.session.execute(statement).scalar()
+
+    @classmethod
+    def call(cls, limit):
+        """ Request a call, checking whether it was within the daily limit.
+            :param limit: The limit on number of calls each day starting at
+            00:00 UTC. Ignored if is None or negative.
+        """
+        count = db.session.execute(cls._count_calls(1)).scalar()
 
         if limit is None or limit < 0:
             utils.logger.debug(f"Request limit {limit!r} ignored")
@@ -1311,6 +1370,43 @@ class RequestLog(db.Model):
             utils.logger.warning(f"Request limit exceeded: {count} > {limit}")
             return False
 
+    @classmethod
+    def reserve(cls, limit, calls):
+        """ Reserves a block of calls within the daily limit, in a separate
+            transaction from the session.
+
+            :param limit: The limit on number of calls each day starting at
+            00:00 UTC. Ignored if is None or negative, in which case nothing
+            is reserved and calls made should be added with `record()`.
+            :param calls: Number of calls to reserve.
+            :returns: Number of calls reserved within the limit.
+        """
+        if limit is None or limit < 0:
+            utils.logger.debug(f"Request limit {limit!r} ignored")
+            return calls
+
+        with db.engine.begin() as connection:
+            # Lock the row such that the count before adding is known
+            count = connection.execute(
+                db.select([cls._calls_today()]).with_for_update()
+            ).scalar()
+            new_count = connection.execute(
+                cls._count_calls(calls, limit)
+            ).scalar()
+        reserved = new_count - count
+        utils.logger.debug(f"Reserved {reserved} of {calls} requests")
+
+        return reserved
+
+    @classmethod
+    def record(cls, calls):
+        """ Adds a number of calls already made to the count for today, in a
+            separate transaction from the session.
+        """
+        with db.engine.begin() as connection:
+            connection.execute(cls._count_calls(calls))
+        utils.logger.debug(f"Recorded {calls} requests")
+
 
 @db.event.listens_for(RequestLog.__table__, "after_create")
 def _insert_single_row(target, connection, **kw):
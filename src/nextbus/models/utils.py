@@ -119,7 +119,19 @@ class _ModelData:
         return register
 
     def refresh(self, connection):
-        """ Refresh all registered models and columns. """
+        """ Refresh all registered models and columns.
+
+            Columns are refreshed first so derived models can use them, eg
+            stop departures from journey data.
+        """
+        for model, keys, columns, func in self._columns:
+            table = model.__table__
+            for inner in func(connection):
+                logger.info(f"Updating columns {columns!r} for model {model!r}")
+                values = {c: inner.columns[c] for c in columns}
+                where = db.and_(*(table.c[k] == inner.c[k] for k in keys))
+                connection.execute(table.update().values(**values).where(where))
+
         for model, func in self._models:
             columns = [c.key for c in model.__table__.columns]
 
@@ -132,13 +144,5 @@ class _ModelData:
                     model.__table__.insert().from_select(columns, statement)
                 )
 
-        for model, keys, columns, func in self._columns:
-            table = model.__table__
-            for inner in func(connection):
-                logger.info(f"Updating columns {columns!r} for model {model!r}")
-                values = {c: inner.columns[c] for c in columns}
-                where = db.and_(*(table.c[k] == inner.c[k] for k in keys))
-                connection.execute(table.update().values(**values).where(where))
-
 
 data = _ModelData()
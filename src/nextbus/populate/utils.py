@@ -262,7 +262,7 @@ def _copy_executor(table, null_value):
     return execute_copy
 
 
-def _copy(connection, table, entries):
+def copy_entries(connection, table, entries):
     """ Copies entries to a table using the COPY command via CSV files. """
     columns = [c.name for c in table.columns]
     null = "\\N"
@@ -350,7 +350,7 @@ def _populate_table(connection, metadata, model, entries, overwrite=False,
         logger.debug(f"Copying {len(entries)} rows to table {table.name} via "
                      f"{temp_table.name}")
         # Add entries to temporary table using COPY
-        _copy(connection, temp_table, entries)
+        copy_entries(connection, temp_table, entries)
         # Insert entries from temporary table into main table avoiding conflicts
         insert = (
             postgresql.insert(table)
@@ -1,15 +1,18 @@
 """
 API resources for the nextbus website.
 """
-from flask import Blueprint, current_app, jsonify, session
+from flask import Blueprint, current_app, jsonify, request, session
 from flask.views import MethodView
-from requests import HTTPError
+from requests import RequestException
 
 from nextbus import db, graph, location, models, live
 
 
 api = Blueprint("api", __name__, template_folder="templates", url_prefix="/api")
 
+# Maximum number of stops live times can be requested for at once
+MAX_LIVE_STOPS = 20
+
 
 def _list_geojson(list_stops):
     """ Creates a list of stop data in GeoJSON format.
@@ -55,19 +58,11 @@ def stop_get_times(atco_code=None):
         )
         return bad_request(404, f"ATCO code {atco_code!r} does not exist.")
 
-    # Check whether live bus times can be requested
-    if current_app.config.get("TRANSPORT_API_ACTIVE"):
-        use_live = models.RequestLog.call(
-            current_app.config.get("TRANSPORT_API_LIMIT")
-        )
-        db.session.commit()
-    else:
-        use_live = False
-
     try:
-        times = live.get_times(atco_code, use_live)
-    except (HTTPError, ValueError):
-        # Error came up when accessing the external API or it can't be accessed
+        times = live.get_times(atco_code)
+    except (RequestException, ValueError):
+        # Error came up when accessing the external API, it can't be accessed
+        # or timed out
         current_app.logger.error(
             f"Error occurred when retrieving live times with data "
             f"{atco_code!r}.",
@@ -84,6 +79,64 @@ def stop_get_times(atco_code=None):
     return response
 
 
+@api.route("/live")
+def stops_get_times():
+    """ Requests and retrieves bus times for several stops with ATCO codes
+        separated by commas, eg `/api/live?stops=490000015G,490008638S`.
+    """
+    codes = request.args.get("stops", "").split(",")
+    # Remove empty and repeated codes while keeping order
+    codes = list(dict.fromkeys(c for c in codes if c))
+    if not codes:
+        return bad_request(400, "No ATCO codes given with 'stops'.")
+    if len(codes) > MAX_LIVE_STOPS:
+        return bad_request(
+            400, f"Times for up to {MAX_LIVE_STOPS} stops can be requested."
+        )
+
+    matching = (
+        db.session.query(models.StopPoint.atco_code)
+        .filter(models.StopPoint.atco_code.in_(codes))
+        .all()
+    )
+    found = {m.atco_code for m in matching}
+    not_found = [c for c in codes if c not in found]
+    if not found:
+        current_app.logger.warning(
+            f"API accessed with invalid ATCO codes {codes!r}."
+        )
+        return bad_request(404, f"ATCO codes {codes!r} do not exist.")
+
+    try:
+        times = live.get_times_at_stops([c for c in codes if c in found])
+    except (RequestException, ValueError):
+        current_app.logger.error(
+            f"Error occurred when retrieving live times with data "
+            f"{codes!r}.",
+            exc_info=True
+        )
+        return bad_request(503, "There was a problem with the external API.")
+
+    response = jsonify({"stops": times, "notFound": not_found})
+    # Set headers to ensure data is up to date
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    response.headers["X-Robots-Tag"] = "noindex"
+
+    return response
+
+
+@api.route("/status/live")
+def live_status():
+    """ Shows state of the circuit breaker for live data in this worker. """
+    response = jsonify(live.get_breaker().to_json())
+    response.cache_control.no_store = True
+    response.cache_control.max_age = 0
+    response.headers["X-Robots-Tag"] = "noindex"
+
+    return response
+
+
 @api.route("/tile/<coord>")
 def get_stops_tile(coord):
     """ Gets list of stops within a tile. """
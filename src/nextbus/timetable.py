@@ -1,11 +1,32 @@
 """
 Creating timetables for a service.
 """
+import array
+import bisect
 from collections import abc
+import datetime
 import functools
+import hashlib
+import itertools
 
-from nextbus import db, graph, models
+import dateutil.tz
+from flask import g, has_request_context
+from sqlalchemy.dialects import postgresql as pg
 
+from nextbus import cache, db, graph, models
+from nextbus.populate import utils as populate_utils
+
+
+# Number of days journey dates are found for, starting from the previous day
+CALENDAR_DAYS = 120
+# Fewest journeys at a constant headway to be shown as a frequency
+MIN_FREQUENCY_JOURNEYS = 4
+
+GB_TZ = dateutil.tz.gettz("Europe/London")
+
+
+# Timetables shared by dates with the same journeys
+_timetable_cache = cache.Cache("timetables", maxsize=256, store_size=4096)
 
 _ONE_HOUR = db.cast(db.literal_column("'1 hour'"), db.Interval)
 _GB_TZ = db.bindparam("gb", "Europe/London")
@@ -14,12 +35,12 @@ _TRUNCATE_MIN = db.bindparam("trunc_min", "minute")
 _FORMAT_TIME = db.bindparam("format_time", "HH24MI")
 
 
-def _bit_array_contains(array, col):
+def _bit_array_contains(bits, col):
     """ SQL expression for matching integer with a bit array, equivalent to
-        `(1 << col) & array > 0`.
+        `(1 << col) & bits > 0`.
     """
     return (
-        db.literal_column("1").op("<<")(col).op("&")(array) >
+        db.literal_column("1").op("<<")(col).op("&")(bits) >
         db.literal_column("0")
     )
 
@@ -189,12 +210,323 @@ def _filter_journey_dates(query, date):
     return query
 
 
-def _query_journeys(service_id, direction, date):
+def _select_journey_calendar(date_start=None, days=CALENDAR_DAYS):
+    """ Creates a query for the dates every journey runs on over a number of
+        days, as bit strings with the first bit for the starting date.
+
+        :param date_start: First date. If None, the previous day in GB is used.
+        :param days: Number of days.
+    """
+    if date_start is None:
+        today = db.cast(db.func.timezone(_GB_TZ, db.func.now()), db.Date)
+        p_date_start = today - db.literal_column("1")
+    else:
+        p_date_start = db.bindparam("date_start", date_start, type_=db.Date)
+
+    offsets = db.func.generate_series(0, days - 1).alias("offsets")
+    offset = db.column("offsets", db.Integer)
+
+    running = (
+        db.session.query(
+            models.Journey.id.label("journey_ref"),
+            offset.label("offset")
+        )
+        .select_from(models.JourneyPattern)
+        .join(models.JourneyPattern.journeys)
+        .join(offsets, db.true())
+        .group_by(models.Journey.id, offset)
+    )
+    running = _filter_journey_dates(running, p_date_start + offset)
+    running = running.subquery("running")
+
+    # Set bit for each date, with the first date as the leftmost bit
+    bit = (
+        db.cast(db.literal_column("1"), pg.BIT(days))
+        .op("<<")(days - 1 - running.c.offset)
+    )
+    no_dates = db.cast(db.literal_column("0"), pg.BIT(days))
+    journey = models.Journey.__table__
+
+    return (
+        db.select([
+            journey.c.id.label("journey_ref"),
+            p_date_start.label("date_start"),
+            db.func.coalesce(db.func.bit_or(bit), no_dates).label("dates")
+        ])
+        .select_from(
+            journey.outerjoin(running, journey.c.id == running.c.journey_ref)
+        )
+        .group_by(journey.c.id)
+    )
+
+
+@models.data.register_model(models.JourneyCalendar)
+def insert_journey_calendar(connection):
+    """ Finds dates journeys run on over the next few months. """
+    return [_select_journey_calendar()]
+
+
+def _select_journey_signatures():
+    """ Creates a query for journeys with digests of their patterns, calendars,
+        notes and running times such that journeys with the same digest only
+        differ by departure time.
+
+        Core expressions are required, because the session has not been set up
+        yet for population.
+    """
+    journey = models.Journey.__table__
+    calendar = models.JourneyCalendar.__table__
+    special = models.SpecialPeriod.__table__
+    organisations = models.Organisations.__table__
+
+    special_period = db.func.concat_ws(",", special.c.date_start,
+                                       special.c.date_end,
+                                       special.c.operational)
+    special_periods = (
+        db.select([
+            special.c.journey_ref,
+            db.func.array_agg(
+                pg.aggregate_order_by(special_period, special_period)
+            ).label("periods")
+        ])
+        .group_by(special.c.journey_ref)
+        .alias("special_periods")
+    )
+    organisation = db.func.concat_ws(",", organisations.c.org_ref,
+                                     organisations.c.operational,
+                                     organisations.c.working)
+    journey_organisations = (
+        db.select([
+            organisations.c.journey_ref,
+            db.func.array_agg(
+                pg.aggregate_order_by(organisation, organisation)
+            ).label("organisations")
+        ])
+        .group_by(organisations.c.journey_ref)
+        .alias("journey_organisations")
+    )
+
+    signature = db.func.md5(db.func.concat_ws(
+        "|",
+        journey.c.pattern_ref,
+        journey.c.days,
+        journey.c.weeks,
+        journey.c.include_holidays,
+        journey.c.exclude_holidays,
+        journey.c.note_code,
+        journey.c.note_text,
+        journey.c.stop_refs,
+        journey.c.sequences,
+        journey.c.flags,
+        journey.c.arrive,
+        journey.c.depart,
+        calendar.c.dates,
+        special_periods.c.periods,
+        journey_organisations.c.organisations
+    ))
+
+    return (
+        db.select([
+            journey.c.id,
+            journey.c.pattern_ref,
+            journey.c.departure,
+            signature.label("signature")
+        ])
+        .select_from(
+            journey
+            .outerjoin(calendar, journey.c.id == calendar.c.journey_ref)
+            .outerjoin(special_periods,
+                       journey.c.id == special_periods.c.journey_ref)
+            .outerjoin(journey_organisations,
+                       journey.c.id == journey_organisations.c.journey_ref)
+        )
+        .order_by(db.literal_column("signature"), journey.c.departure,
+                  journey.c.id)
+    )
+
+
+def _seconds(time):
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def _find_frequencies(journeys, min_journeys=MIN_FREQUENCY_JOURNEYS):
+    """ Finds runs of journeys departing at a constant headway.
+
+        :param journeys: List of journey IDs and departure times, ordered by
+        departure, for journeys which only differ by departure time.
+        :param min_journeys: Fewest journeys in a run.
+        :returns: List of runs as lists of journey IDs and departure times.
+    """
+    runs = []
+    run = []
+    headway = None
+
+    for journey in journeys:
+        if run:
+            interval = _seconds(journey[1]) - _seconds(run[-1][1])
+        else:
+            interval = None
+
+        if interval is not None and interval > 0 and (
+            len(run) == 1 or interval == headway
+        ):
+            run.append(journey)
+            headway = interval
+            continue
+
+        if len(run) >= min_journeys:
+            runs.append(run)
+            run = [journey]
+        elif interval is not None and interval > 0:
+            # Start a new run from the last journey with the new headway
+            run = [run[-1], journey]
+        else:
+            run = [journey]
+        headway = interval if len(run) > 1 else None
+
+    if len(run) >= min_journeys:
+        runs.append(run)
+
+    return runs
+
+
+def _frequency_csv_row(pattern_ref, run):
+    """ Converts a run of journeys for use with the COPY command. """
+    first, second, last = run[0], run[1], run[-1]
+    headway = _seconds(second[1]) - _seconds(first[1])
+
+    return {
+        "id": first[0],
+        "pattern_ref": pattern_ref,
+        "time_start": first[1].isoformat(),
+        "time_end": last[1].isoformat(),
+        "headway": f"{headway} seconds",
+        "journeys": "{" + ",".join(str(j) for j, _ in run) + "}",
+    }
+
+
+@models.data.register_model(models.JourneyFrequency)
+def insert_journey_frequencies(connection):
+    """ Finds journeys with the same patterns, calendars and running times
+        departing at a constant headway and stores them as frequency bands.
+    """
+    temp_frequencies = db.Table(
+        "temp_journey_frequency",
+        db.MetaData(),
+        db.Column("id", db.Integer, autoincrement=False),
+        db.Column("pattern_ref", db.Integer),
+        db.Column("time_start", db.Time),
+        db.Column("time_end", db.Time),
+        db.Column("headway", db.Interval),
+        db.Column("journeys", pg.ARRAY(db.Integer, dimensions=1)),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP"
+    )
+    temp_frequencies.create(connection)
+
+    result = connection.execute(_select_journey_signatures())
+    entries = []
+    for _, group in itertools.groupby(result, lambda r: r.signature):
+        group = list(group)
+        journeys = [(r.id, r.departure) for r in group]
+        for run in _find_frequencies(journeys):
+            entries.append(_frequency_csv_row(group[0].pattern_ref, run))
+
+    populate_utils.copy_entries(connection, temp_frequencies, entries)
+
+    return [db.select([temp_frequencies])]
+
+
+def _query_frequencies(service_id, direction):
+    """ Creates query for journey frequency bands for a service and direction.
+    """
+    return (
+        db.session.query(models.JourneyFrequency.journeys,
+                         models.JourneyFrequency.headway)
+        .join(models.JourneyPattern,
+              models.JourneyPattern.id == models.JourneyFrequency.pattern_ref)
+        .filter(models.JourneyPattern.service_ref == service_id,
+                models.JourneyPattern.direction == direction)
+    )
+
+
+def _calendar_range():
+    """ Gets first and last dates in the journey calendar, or None if the
+        calendar is empty.
+
+        The calendar only changes with population, so the range is queried
+        once for each request and kept for the rest of the request.
+    """
+    if has_request_context() and "calendar_range" in g:
+        return g.calendar_range
+
+    range_ = _query_calendar_range()
+    if has_request_context():
+        g.calendar_range = range_
+
+    return range_
+
+
+def _query_calendar_range():
+    row = (
+        db.session.query(
+            models.JourneyCalendar.date_start,
+            db.func.length(models.JourneyCalendar.dates).label("days")
+        )
+        .limit(1)
+        .one_or_none()
+    )
+    if row is None:
+        return None
+
+    return row.date_start, row.date_start + datetime.timedelta(row.days - 1)
+
+
+def _in_calendar(first, last=None):
+    """ Checks if dates between first and last inclusive are all within the
+        journey calendar.
+    """
+    range_ = _calendar_range()
+    if range_ is None:
+        return False
+
+    return range_[0] <= first and (last or first) <= range_[1]
+
+
+def _filter_journey_calendar(query, date):
+    """ Join the journey calendar to filter journeys by valid dates, replacing
+        `_filter_journey_dates()` if the date is within the calendar.
+
+        It is assumed the Journey model is in the FROM clause or joined.
+    """
+    calendar = models.JourneyCalendar
+    offset = date - calendar.date_start
+
+    return (
+        query
+        .join(calendar, calendar.journey_ref == models.Journey.id)
+        .filter(
+            db.func.substring(calendar.dates, offset + 1, 1) ==
+            db.literal_column("B'1'")
+        )
+    )
+
+
+def _query_journeys(service_id, direction, date, time_start=None,
+                    time_end=None, after=None, limit=None):
     """ Creates query to find all IDs for journeys that run on a particular day.
 
         Journeys are included and excluded them by matching with special dates,
         bank holidays, date ranges associated with organisations, weeks of month
         and days of week.
+
+        :param time_start: Include journeys departing at or after this local
+        time.
+        :param time_end: Include journeys departing before this local time.
+        :param after: Tuple of local departure time and journey ID. Only
+        journeys after this, ordered by departure time and ID, are included.
+        :param limit: Include this number of journeys ordered by departure time
+        and ID, with both departures kept if repeated when clocks go back.
     """
     # Set as parameters for SQL query - reduces repetition of dates
     p_service_id = db.bindparam("service", service_id)
@@ -228,17 +560,100 @@ def _query_journeys(service_id, direction, date):
         .group_by(models.Journey.id, departure)
     )
 
+    if time_start is not None:
+        p_time_start = db.bindparam("time_start", time_start, type_=db.Time)
+        journeys = journeys.filter(models.Journey.departure >= p_time_start)
+    if time_end is not None:
+        p_time_end = db.bindparam("time_end", time_end, type_=db.Time)
+        journeys = journeys.filter(models.Journey.departure < p_time_end)
+    if after is not None:
+        p_after_time = db.bindparam("after_time", after[0], type_=db.Time)
+        p_after_id = db.bindparam("after_id", after[1], type_=db.Integer)
+        journeys = journeys.filter(
+            db.tuple_(models.Journey.departure, models.Journey.id) >
+            db.tuple_(p_after_time, p_after_id)
+        )
+
     # Add filters for departure dates
-    journeys = _filter_journey_dates(journeys, p_date)
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    if _in_calendar(date):
+        journeys = _filter_journey_calendar(journeys, p_date)
+    else:
+        journeys = _filter_journey_dates(journeys, p_date)
+
+    if limit is not None:
+        # Rank journeys after grouping so repeated departures share a rank
+        rank = db.func.dense_rank().over(
+            order_by=(models.Journey.departure, models.Journey.id)
+        )
+        ranked = journeys.add_columns(rank.label("rank")).subquery("ranked")
+        p_limit = db.bindparam("limit", limit, type_=db.Integer)
+        journeys = (
+            db.session.query(ranked.c.journey_id, ranked.c.departure)
+            .filter(ranked.c.rank <= p_limit)
+        )
 
     return journeys
 
 
-def _query_timetable(service_id, direction, date):
-    """ Creates a timetable for a service in a set direction on a specific day.
+def _query_journeys_range(service_id, direction, date_start, date_end):
+    """ Creates query to find all IDs for journeys that run on each day within
+        a range of dates inclusive, with the date for each journey.
+    """
+    if date_start > date_end:
+        raise ValueError(f"Start date {date_start!r} must not be after end "
+                         f"date {date_end!r}")
+
+    p_service_id = db.bindparam("service", service_id)
+    p_direction = db.bindparam("direction", direction)
+    p_date_start = db.bindparam("date_start", date_start, type_=db.Date)
+
+    offsets = (
+        db.func.generate_series(0, (date_end - date_start).days)
+        .alias("offsets")
+    )
+    offset = db.column("offsets", db.Integer)
+    date = p_date_start + offset
+
+    departures = _get_departure_range(date + models.Journey.departure,
+                                      "departures")
+    departure = db.column("departures")
+
+    # Find all journeys and their departures for each date
+    journeys = (
+        db.session.query(
+            date.label("date"),
+            models.Journey.id.label("journey_id"),
+            departure.label("departure")
+        )
+        .select_from(models.JourneyPattern)
+        .join(models.JourneyPattern.journeys)
+        .join(offsets, db.true())
+        .join(departures, db.true())
+        .filter(
+            models.JourneyPattern.service_ref == p_service_id,
+            models.JourneyPattern.direction.is_(p_direction),
+            db.extract("HOUR", db.func.timezone(_GB_TZ, departure)) ==
+            db.extract("HOUR", models.Journey.departure),
+        )
+        .group_by(offset, models.Journey.id, departure)
+    )
+
+    if _in_calendar(date_start, date_end):
+        journeys = _filter_journey_calendar(journeys, date)
+    else:
+        journeys = _filter_journey_dates(journeys, date)
+
+    return journeys
+
+
+def _select_timetable(journeys, *columns):
+    """ Creates timetable query from a CTE of journeys and departures, with
+        additional columns from the CTE to be selected and ordered by first.
     """
-    journeys = _query_journeys(service_id, direction, date).cte("times")
-    # Join JSON record set on 'true' as SQLAlchemy does not support cross joins.
+    # Join record set laterally on 'true' as SQLAlchemy does not support cross
+    # joins.
     data = models.Journey.record_set()
 
     arrive = journeys.c.departure + data.c.arrive
@@ -246,6 +661,7 @@ def _query_timetable(service_id, direction, date):
 
     query = (
         db.session.query(
+            *columns,
             journeys.c.journey_id,
             journeys.c.departure,
             models.LocalOperator.code.label("local_operator_code"),
@@ -267,43 +683,113 @@ def _query_timetable(service_id, direction, date):
         .join(models.LocalOperator.operator)
         .join(data, db.true())
         .filter(data.c.stop_point_ref.isnot(None), data.c.stopping)
-        .order_by(journeys.c.departure, journeys.c.journey_id, data.c.sequence)
+        .order_by(*columns, journeys.c.departure, journeys.c.journey_id,
+                  data.c.sequence)
     )
 
     return query
 
 
-def _query_journeys_at_stop(atco_code):
-    """ Creates query for journeys stopping at a specified stop point. """
-    p_atco_code = db.bindparam("atco_code", atco_code)
+def _query_timetable(service_id, direction, date, **window):
+    """ Creates a timetable for a service in a set direction on a specific day.
 
-    data = models.Journey.record_set()
+        Keyword arguments for the time window and limit are passed to
+        `_query_journeys()`.
+    """
+    journeys = _query_journeys(service_id, direction, date, **window)
+    journeys = journeys.cte("times")
+
+    return _select_timetable(journeys)
+
+
+def _query_timetable_range(service_id, direction, date_start, date_end):
+    """ Creates timetables for a service in a set direction for each day within
+        a range of dates inclusive, ordered by date.
+    """
+    journeys = (
+        _query_journeys_range(service_id, direction, date_start, date_end)
+        .cte("times")
+    )
+
+    return _select_timetable(journeys, journeys.c.date)
+
+
+def _departure_time_range(timestamp=None, interval=None):
+    """ Gets range of local times of day for departures from a stop, or None if
+        the range covers the whole day.
+
+        An hour either side is included to account for changes in daylight
+        saving time; the exact times are checked afterwards.
+    """
+    if interval is None:
+        interval = datetime.timedelta(hours=1)
+    # Range over 22 hours with an hour either side covers all times of day
+    if interval >= datetime.timedelta(hours=22):
+        return None
+
+    if timestamp is None:
+        local = datetime.datetime.now(GB_TZ)
+    elif timestamp.tzinfo is None:
+        local = timestamp
+    else:
+        local = timestamp.astimezone(GB_TZ)
+
+    one_hour = datetime.timedelta(hours=1)
+    return (local - one_hour).time(), (local + interval + one_hour).time()
+
+
+def _query_departures_at_stops(atco_codes, timestamp=None, interval=None):
+    """ Creates query for journeys stopping at specified stop points, using the
+        stop departures table to find journeys leaving within a range of times.
+    """
+    p_atco_codes = db.bindparam("atco_codes", list(atco_codes),
+                                expanding=True)
+
+    departure = models.StopDeparture
     query = (
         db.session.query(
-            models.Journey.id,
+            departure.journey_ref.label("id"),
+            departure.stop_point_ref,
             models.Journey.departure,
-            data.c.depart.label("t_offset"),
+            departure.t_offset,
         )
-        .select_from(models.Journey)
-        .join(models.Journey.pattern)
-        .join(models.JourneyPattern.links)
-        .join(
-            data,
-            db.and_(
-                data.c.stopping,
-                data.c.depart.isnot(None),
-                models.JourneyLink.sequence == data.c.sequence,
-            )
-        )
-        .filter(models.JourneyLink.stop_point_ref == p_atco_code)
+        .select_from(departure)
+        .join(models.Journey, departure.journey_ref == models.Journey.id)
+        .filter(departure.stop_point_ref.in_(p_atco_codes))
     )
 
+    range_ = _departure_time_range(timestamp, interval)
+    if range_ is None:
+        return query
+
+    start, end = range_
+    p_start = db.bindparam("time_start", start)
+    p_end = db.bindparam("time_end", end)
+    if start <= end:
+        query = query.filter(db.between(departure.time, p_start, p_end))
+    else:
+        # Range wraps around midnight
+        query = query.filter((departure.time >= p_start) |
+                             (departure.time <= p_end))
+
     return query
 
 
-def _query_next_services(atco_code, timestamp=None, interval=None):
-    """ Creates query for getting all services stopping at this stop point in an
-        interval.
+def _local_date(timestamp=None):
+    """ Gets date in GB for a timestamp, assuming timestamps without time zones
+        are already local.
+    """
+    if timestamp is None:
+        return datetime.datetime.now(GB_TZ).date()
+    elif timestamp.tzinfo is None:
+        return timestamp.date()
+    else:
+        return timestamp.astimezone(GB_TZ).date()
+
+
+def _query_next_services(atco_codes, timestamp=None, interval=None):
+    """ Creates query for getting all services stopping at these stop points in
+        an interval.
     """
     if timestamp is None:
         p_timestamp = db.func.now()
@@ -319,7 +805,10 @@ def _query_next_services(atco_code, timestamp=None, interval=None):
         param = db.bindparam("interval", interval)
         p_interval = db.cast(param, db.Interval)
 
-    journey_match = _query_journeys_at_stop(atco_code).cte("journey_match")
+    journey_match = (
+        _query_departures_at_stops(atco_codes, timestamp, interval)
+        .cte("journey_match")
+    )
 
     time_start = p_timestamp - journey_match.c.t_offset
     time_end = time_start + p_interval
@@ -342,6 +831,7 @@ def _query_next_services(atco_code, timestamp=None, interval=None):
     journey_departure = (
         db.session.query(
             journey_match.c.id,
+            journey_match.c.stop_point_ref,
             journey_match.c.t_offset,
             times.c.utc_start,
             times.c.utc_end,
@@ -379,9 +869,19 @@ def _query_next_services(atco_code, timestamp=None, interval=None):
     )
     utc_departure = db.column("utc_departure")
 
-    journey_filter = _filter_journey_dates(
+    # Journeys may have started the previous day or end the next day
+    local_date = _local_date(timestamp)
+    days = interval.days if isinstance(interval, datetime.timedelta) else 0
+    if _in_calendar(local_date - datetime.timedelta(1),
+                    local_date + datetime.timedelta(days + 1)):
+        filter_dates = _filter_journey_calendar
+    else:
+        filter_dates = _filter_journey_dates
+
+    journey_filter = filter_dates(
         db.session.query(
             journey_departure.c.id,
+            journey_departure.c.stop_point_ref,
             (utc_departure + journey_departure.c.t_offset).label("expected")
         )
         .select_from(journey_departure)
@@ -397,6 +897,7 @@ def _query_next_services(atco_code, timestamp=None, interval=None):
         .join(models.Journey.pattern)
         .group_by(
             journey_departure.c.id,
+            journey_departure.c.stop_point_ref,
             journey_departure.c.t_offset,
             utc_departure
         ),
@@ -405,6 +906,7 @@ def _query_next_services(atco_code, timestamp=None, interval=None):
 
     query = (
         db.session.query(
+            journey_filter.c.stop_point_ref.label("atco_code"),
             models.Service.line.label("line"),
             models.JourneyPattern.origin.label("origin"),
             models.JourneyPattern.destination.label("destination"),
@@ -427,10 +929,110 @@ def _query_next_services(atco_code, timestamp=None, interval=None):
 def get_next_services(atco_code, timestamp=None, interval=None):
     """ Get all services stopping at this stop point in an interval.
     """
-    query = _query_next_services(atco_code, timestamp, interval)
+    query = _query_next_services([atco_code], timestamp, interval)
     return query.all()
 
 
+def get_next_services_at_stops(atco_codes, timestamp=None, interval=None):
+    """ Get all services stopping at each of these stop points in an interval
+        with a single query.
+
+        :returns: Dictionary with ATCO codes as keys and lists of services as
+        values.
+    """
+    services = {code: [] for code in atco_codes}
+    if not services:
+        return services
+
+    query = _query_next_services(atco_codes, timestamp, interval)
+    for row in query.all():
+        services[row.atco_code].append(row)
+
+    return services
+
+
+def _compare_times(times_a, times_b):
+    """ Compares two journeys based on UTC arrival/departure times at the first
+        shared stop in sequence, using lists of positions and times from
+        `Timetable._index_times()`.
+    """
+    i = j = 0
+    while i < len(times_a) and j < len(times_b):
+        position_a, time_a = times_a[i]
+        position_b, time_b = times_b[j]
+        if position_a < position_b:
+            i += 1
+        elif position_a > position_b:
+            j += 1
+        elif time_a > time_b:
+            return 1
+        elif time_a < time_b:
+            return -1
+        else:
+            i += 1
+            j += 1
+
+    return 0
+
+
+def _timetable_date_key(service_id, direction, date, version, window=None,
+                        frequencies=False):
+    """ Creates key for a timetable on a date starting with the data version,
+        and with the time window and limit if any are set.
+
+        :param frequencies: Whether journeys at constant headways are collapsed
+        into frequencies.
+    """
+    key = f"{version}-{service_id}-{int(direction)}-{date:%Y%m%d}"
+    if frequencies:
+        key += "-f"
+    if window and any(v is not None for v in window.values()):
+        digest = hashlib.sha1(repr(sorted(window.items())).encode())
+        key += f"-{digest.hexdigest()}"
+
+    return key
+
+
+def _timetable_key(service_id, direction, date, sequence, journeys,
+                   version, frequencies=False):
+    """ Creates key for a timetable starting with the data version from the
+        journeys running on a date, such that dates with the same journeys
+        departing at the same times share timetables.
+
+        Departures are compared as UTC times from the start of the date, and
+        the offsets at the start and end of the period journeys may run over
+        are included in case the time zone changes.
+
+        :param frequencies: Whether journeys at constant headways are collapsed
+        into frequencies.
+    """
+    start = datetime.datetime.combine(date, datetime.time(),
+                                      datetime.timezone.utc)
+    end = start + datetime.timedelta(days=2)
+
+    digest = hashlib.sha1()
+    digest.update(",".join(sequence).encode())
+    for journey_id, departure in sorted(journeys):
+        seconds = int((departure - start).total_seconds())
+        digest.update(f";{journey_id}:{seconds}".encode())
+    for offset in [start.astimezone(GB_TZ).utcoffset(),
+                   end.astimezone(GB_TZ).utcoffset()]:
+        digest.update(f";{int(offset.total_seconds())}".encode())
+
+    key = f"{version}-{service_id}-{int(direction)}-{digest.hexdigest()}"
+    if frequencies:
+        key += "-f"
+
+    return key
+
+
+def prune_cache():
+    """ Removes timetables cached from earlier versions of data. """
+    version = models.DataVersion.current()
+    if version is not None:
+        _timetable_cache.prune(lambda key: key.startswith(f"{version}-"))
+
+
 class TimetableStop:
     """ Represents a cell in the timetable with arrival, departure and timing
         status.
@@ -466,145 +1068,113 @@ class TimetableStop:
     def __ne__(self, other):
         return not self.__eq__(other)
 
-    @classmethod
-    def from_row(cls, row):
-        """ Creates TimetableStop instance from row returned from query. """
-        return cls(
-            row.stop_point_ref,
-            row.arrive,
-            row.depart,
-            row.timing_point,
-            row.utc_arrive,
-            row.utc_depart,
-        )
 
+def _to_minutes(time):
+    """ Converts time formatted as `HHMM` to minutes, or -1 if None. """
+    return int(time[:2]) * 60 + int(time[2:]) if time is not None else -1
 
-class TimetableJourney(abc.MutableSequence):
-    """ Journey for timetable, represented as one or more columns. """
-    __slots__ = ("_stops", "_first")
-
-    def __init__(self):
-        self._stops = []
-        self._first = None
-
-    def __repr__(self):
-        return f"<TimetableJourney({self.journey_id!r}, {self.departure!r})>"
-
-    def __len__(self):
-        return len(self._stops)
-
-    def __getitem__(self, index):
-        return self._stops[index]
-
-    def __setitem__(self, index, value):
-        self._check(value)
-        self._stops[index] = TimetableStop.from_row(value)
 
-    def __delitem__(self, index):
-        del self._stops[index]
-        if not self._stops:
-            self._first = None
+def _from_minutes(minutes):
+    """ Converts minutes to time formatted as `HHMM`, or None if negative. """
+    return f"{minutes // 60:02d}{minutes % 60:02d}" if minutes >= 0 else None
 
-    @property
-    def journey_id(self):
-        return self._first.journey_id if self._first is not None else None
 
-    @property
-    def departure(self):
-        return self._first.departure if self._first is not None else None
+class TimetableColumn:
+    """ Column in timetable for a journey, with arrays of row indices for each
+        stop and their times.
 
-    @property
-    def local_operator_code(self):
-        return self._first.local_operator_code if self._first is not None else None
+        Columns with a headway in minutes and no rows stand in for journeys
+        between the columns either side running at that frequency.
+    """
+    __slots__ = ("journey_id", "operator", "note", "headway", "rows", "arrive",
+                 "depart", "timing", "utc_arrive", "utc_depart")
+
+    def __init__(self, journey_id=None, operator=None, note=None,
+                 headway=None):
+        self.journey_id = journey_id
+        self.operator = operator
+        self.note = note
+        self.headway = headway
+        self.rows = array.array("i")
+        self.arrive = array.array("h")
+        self.depart = array.array("h")
+        self.timing = array.array("b")
+        self.utc_arrive = []
+        self.utc_depart = []
 
-    @property
-    def operator_name(self):
-        return self._first.operator_name if self._first is not None else None
+    def __repr__(self):
+        return f"<TimetableColumn({self.journey_id!r}, {len(self.rows)!r})>"
 
-    @property
-    def note_code(self):
-        return self._first.note_code if self._first is not None else None
+    def __len__(self):
+        return len(self.rows)
 
-    @property
-    def note_text(self):
-        return self._first.note_text if self._first is not None else None
+    def append(self, index, row):
+        """ Adds row from query result to this column at a row index, which
+            must be after all existing rows.
+        """
+        self.rows.append(index)
+        self.arrive.append(_to_minutes(row.arrive))
+        self.depart.append(_to_minutes(row.depart))
+        self.timing.append(row.timing_point)
+        self.utc_arrive.append(row.utc_arrive)
+        self.utc_depart.append(row.utc_depart)
+
+    def get(self, index, stop_point_ref=None, shift=None):
+        """ Gets cell at row index as a TimetableStop, or None if empty.
+
+            :param shift: Interval to add to UTC times if the column is shared
+            with a timetable on a different date.
+        """
+        i = bisect.bisect_left(self.rows, index)
+        if i == len(self.rows) or self.rows[i] != index:
+            return None
+
+        utc_arrive = self.utc_arrive[i]
+        utc_depart = self.utc_depart[i]
+        if shift:
+            utc_arrive = utc_arrive + shift if utc_arrive is not None else None
+            utc_depart = utc_depart + shift if utc_depart is not None else None
+
+        return TimetableStop(
+            stop_point_ref,
+            _from_minutes(self.arrive[i]),
+            _from_minutes(self.depart[i]),
+            bool(self.timing[i]),
+            utc_arrive,
+            utc_depart,
+        )
 
-    def insert(self, index, value):
-        self._check(value)
-        self._stops.insert(index, TimetableStop.from_row(value))
 
-    def _check(self, row):
-        if len(self._stops) == 0:
-            self._first = row
-            return
+class TimetableCells(abc.Sequence):
+    """ View of cells in a timetable row, created when accessed. """
+    __slots__ = ("_columns", "_index", "_stop_point_ref", "_shift")
 
-        this = (
-            self._first.journey_id,
-            self._first.departure,
-            self._first.local_operator_code,
-            self._first.operator_name,
-            self._first.note_code,
-            self._first.note_text,
-        )
-        other = (
-            row.journey_id,
-            row.departure,
-            row.local_operator_code,
-            row.operator_name,
-            row.note_code,
-            row.note_text,
-        )
-        if this != other:
-            raise ValueError(
-                f"Row {row!r} does not match with journey attributes {this!r}"
-            )
+    def __init__(self, columns, index, stop_point_ref, shift=None):
+        self._columns = columns
+        self._index = index
+        self._stop_point_ref = stop_point_ref
+        self._shift = shift
 
-    def wrap(self, sequence):
-        """ Wraps journey around sequence, adding extra columns and empty rows
-            if necessary.
-        """
-        len_ = len(sequence)
-        columns = [[]]
-        index = 0
-        col = 0
+    def __len__(self):
+        return len(self._columns)
 
-        for row in self:
-            if row.stop_point_ref not in sequence:
-                raise ValueError(
-                    f"Row {row!r} stop point ref does not exist in sequence."
-                )
-            # Skip over sequence until the next stop in journey
-            while index < len_ and row.stop_point_ref != sequence[index]:
-                columns[col].append(None)
-                index += 1
-            # Add new column, starting the sequence over
-            if index == len_:
-                columns.append([])
-                index = 0
-                col += 1
-            while row.stop_point_ref != sequence[index]:
-                columns[col].append(None)
-                index += 1
-
-            columns[col].append(row)
-            index += 1
-
-        # After last stop, fill rest of sequence
-        while index < len_:
-            columns[col].append(None)
-            index += 1
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [c.get(self._index, self._stop_point_ref, self._shift)
+                    for c in self._columns[index]]
 
-        return columns
+        return self._columns[index].get(self._index, self._stop_point_ref,
+                                        self._shift)
 
 
 class TimetableRow:
     """ Row in timetable with stop and timing status. """
     __slots__ = ("stop", "times", "timing")
 
-    def __init__(self, stop, list_times):
+    def __init__(self, stop, times, timing):
         self.stop = stop
-        self.times = list_times
-        self.timing = any(t is not None and t.timing for t in self.times)
+        self.times = times
+        self.timing = timing
 
     def __repr__(self):
         return f"<TimetableRow({self.stop.atco_code!r}, {self.timing!r})>"
@@ -613,6 +1183,9 @@ class TimetableRow:
 class Timetable:
     """ Creates a timetable for a service and direction.
 
+        Cells are held by columns in arrays, with rows giving views of cells
+        for each stop.
+
         :param service_id: Service ID.
         :param direction: Direction of service - outbound if false, inbound if
         True.
@@ -623,31 +1196,60 @@ class Timetable:
         :param dict_stops: Dictionary of stop points. If this is None the
         dictionary is generated from this service.
         :param query_result: Use this result set to create timetable.
+        :param time_start: Show journeys departing at or after this local time.
+        :param time_end: Show journeys departing before this local time.
+        :param after: Show journeys after this tuple of local departure time
+        and journey ID, as given by `next_page` for the previous page.
+        :param limit: Show this number of journeys in order of departure.
+        :param frequencies: Replace journeys running at a constant headway
+        with the first and last journeys and a column for the frequency.
     """
     def __init__(self, service_id, direction, date, sequence=None,
-                 dict_stops=None, query_result=None):
+                 dict_stops=None, query_result=None, time_start=None,
+                 time_end=None, after=None, limit=None, frequencies=False):
         self.service_id = service_id
         self.direction = direction
         self.date = date
+        self.time_start = time_start
+        self.time_end = time_end
+        self.after = after
+        self.limit = limit
+        self.frequencies = frequencies
+        # Cursor for the next page of journeys if limited
+        self.next_page = None
 
         if sequence is None or dict_stops is None:
-            g, stops = graph.service_graph_stops(service_id, direction)
-            self.sequence = g.sequence()
-            self.stops = stops
+            self.sequence, self.stops = graph.service_sequence(service_id,
+                                                               direction)
         else:
             self.sequence = list(sequence)
             self.stops = dict(dict_stops)
 
+        # Indices for each stop in sequence, which may appear more than once
+        self._indices = {}
+        for i, code in enumerate(self.sequence):
+            self._indices.setdefault(code, []).append(i)
+
+        self.columns = []
         self.head = []
         self.rows = []
         self.operators = {}
         self.notes = {}
         self.timed_rows = []
 
-        if self.sequence:
-            journeys = self._timetable_journeys(query_result)
-            self._create_table(journeys)
-            self.timed_rows = [r for r in self.rows if r.timing]
+        if not self.sequence:
+            return
+
+        if query_result is not None:
+            self._create_table(self._timetable_journeys(query_result))
+            if self.frequencies:
+                self._collapse_frequencies()
+            shift = None
+        else:
+            shift = self._load_table()
+
+        self._create_rows(shift)
+        self.timed_rows = [r for r in self.rows if r.timing]
 
     def __repr__(self):
         return (
@@ -655,38 +1257,152 @@ class Timetable:
             f"{self.date!r})>"
         )
 
+    @classmethod
+    def from_range(cls, service_id, direction, date_start, date_end,
+                   sequence=None, dict_stops=None, frequencies=False):
+        """ Creates timetables for each day within a range of dates inclusive
+            from a single query, adding them to the cache.
+
+            :param frequencies: Replace journeys running at a constant headway
+            with the first and last journeys and a column for the frequency.
+            :returns: Dictionary of dates and timetables.
+        """
+        if sequence is None or dict_stops is None:
+            sequence, dict_stops = graph.service_sequence(service_id,
+                                                          direction)
+
+        query = _query_timetable_range(service_id, direction, date_start,
+                                       date_end)
+        rows = {}
+        for date, group in itertools.groupby(query.all(), lambda r: r.date):
+            rows[date] = list(group)
+
+        version = models.DataVersion.current()
+        timetables = {}
+        for i in range((date_end - date_start).days + 1):
+            date = date_start + datetime.timedelta(days=i)
+            timetable = cls(service_id, direction, date, sequence, dict_stops,
+                            rows.get(date, []), frequencies=frequencies)
+            if version is not None and timetable:
+                key = _timetable_date_key(service_id, direction, date, version,
+                                          frequencies=frequencies)
+                _timetable_cache.set(key, (date, timetable.columns,
+                                           timetable.operators,
+                                           timetable.notes, None))
+            timetables[date] = timetable
+
+        return timetables
+
     def __bool__(self):
         return bool(self.sequence)
 
-    def _compare_times(self, journey_a, journey_b):
-        """ Compares two journeys based on UTC arrival/departure times at their
-            shared stops.
+    @property
+    def _window(self):
+        return {
+            "time_start": self.time_start,
+            "time_end": self.time_end,
+            "after": self.after,
+            "limit": self.limit,
+        }
+
+    def _load_table(self):
+        """ Creates table from the timetable query, or reuses a table from the
+            cache for this date or a different date with the same journeys.
+
+            Cached tables are keyed by the data version so they are replaced
+            after population. Only tables without a time window or cursor are
+            kept in the shared store, such that requests for other windows
+            cannot fill the store.
+
+            :returns: Interval between the cached timetable's date and this
+            date to add to UTC times, or None if not cached.
         """
-        for code in self.sequence:
-            try:
-                row_a = next(r for r in journey_a if r.stop_point_ref == code)
-                row_b = next(r for r in journey_b if r.stop_point_ref == code)
-            except StopIteration:
-                continue
-
-            time_a = row_a.utc_depart or row_a.utc_arrive
-            time_b = row_b.utc_depart or row_b.utc_arrive
-            if time_a is None or time_b is None:
-                continue
-            elif time_a > time_b:
-                return 1
-            elif time_a < time_b:
-                return -1
-
-        return 0
-
-    def _timetable_journeys(self, query_result=None):
-        if query_result is not None:
-            result = query_result
-        else:
-            query = _query_timetable(self.service_id, self.direction, self.date)
-            result = query.all()
+        date = self.date
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        window = self._window
+
+        version = models.DataVersion.current()
+        if version is None:
+            self._query_table(date, window)
+            return None
+
+        date_key = _timetable_date_key(self.service_id, self.direction, date,
+                                       version, window, self.frequencies)
+        cached = _timetable_cache.get(date_key)
+        if cached is not None:
+            return self._set_cached(cached, date)
+
+        shared = (self.time_start is None and self.time_end is None and
+                  self.after is None)
+
+        # Pages depend on the limit as well as journeys so are only cached by
+        # date
+        key = None
+        if self.limit is None:
+            journeys = _query_journeys(self.service_id, self.direction, date,
+                                       **window).all()
+            key = _timetable_key(self.service_id, self.direction, date,
+                                 self.sequence, journeys, version,
+                                 self.frequencies)
+            cached = _timetable_cache.get(key)
+            if cached is not None:
+                _timetable_cache.set(date_key, cached, shared=shared)
+                return self._set_cached(cached, date)
+
+        self._query_table(date, window)
+        cached = (date, self.columns, self.operators, self.notes,
+                  self.next_page)
+        if key is not None:
+            _timetable_cache.set(key, cached, shared=shared)
+        _timetable_cache.set(date_key, cached, shared=shared)
+
+        return None
+
+    def _query_table(self, date, window):
+        if self.limit is not None:
+            # Query an extra journey to find whether there is a next page
+            window = dict(window, limit=self.limit + 1)
+        query = _query_timetable(self.service_id, self.direction, date,
+                                 **window)
+        result = query.all()
+
+        if self.limit is not None:
+            def cursor(row):
+                return row.departure.astimezone(GB_TZ).time(), row.journey_id
+
+            # Count each journey once if repeated when clocks go back
+            journeys = sorted({cursor(r) for r in result})
+            if len(journeys) > self.limit:
+                self.next_page = journeys[self.limit - 1]
+                result = [r for r in result if cursor(r) <= self.next_page]
+
+        self._create_table(self._timetable_journeys(result))
+        if self.frequencies:
+            self._collapse_frequencies()
+
+    def _set_cached(self, cached, date):
+        (cached_date, self.columns, self.operators, self.notes,
+         self.next_page) = cached
+        self.head = [(c.journey_id, c.operator, c.note) for c in self.columns]
+
+        return date - cached_date
+
+    def _index_times(self, journey):
+        """ Creates list of sequence positions and UTC arrival/departure times
+            for the first call at each stop in a journey, ordered by position.
+        """
+        times = {}
+        for row in journey:
+            if row.stop_point_ref not in times:
+                times[row.stop_point_ref] = row.utc_depart or row.utc_arrive
+
+        return sorted(
+            (self._indices[code][0], time) for code, time in times.items()
+            if time is not None and code in self._indices
+        )
 
+    def _timetable_journeys(self, result):
         dict_journeys = {}
         for row in result:
             if row.stop_point_ref not in self.stops:
@@ -695,45 +1411,118 @@ class Timetable:
             if (journey := dict_journeys.get(key)) is not None:
                 journey.append(row)
             else:
-                journey = TimetableJourney()
-                journey.append(row)
-                dict_journeys[key] = journey
+                dict_journeys[key] = [row]
 
-        return sorted(dict_journeys.values(),
-                      key=functools.cmp_to_key(self._compare_times))
+        # Index times by position in sequence once for each journey so pairs
+        # of journeys can be compared without searching for each stop
+        indexed = [(self._index_times(j), j) for j in dict_journeys.values()]
+        compare = functools.cmp_to_key(_compare_times)
+        indexed.sort(key=lambda pair: compare(pair[0]))
 
-    def _create_table(self, journeys):
-        head_journey = []
-        head_operator = []
-        head_note = []
-        columns = []
+        return [j for _, j in indexed]
 
+    def _wrap(self, journey):
+        """ Wraps rows for journey around sequence, adding extra columns if
+            necessary.
+        """
+        first = journey[0]
+        columns = [TimetableColumn(first.journey_id, first.local_operator_code,
+                                   first.note_code)]
+        index = 0
+
+        for row in journey:
+            indices = self._indices.get(row.stop_point_ref)
+            if indices is None:
+                raise ValueError(
+                    f"Row {row!r} stop point ref does not exist in sequence."
+                )
+            # Find the next index for this stop, otherwise start the sequence
+            # over in a new column
+            i = bisect.bisect_left(indices, index)
+            if i == len(indices):
+                columns.append(TimetableColumn())
+                i = 0
+
+            columns[-1].append(indices[i], row)
+            index = indices[i] + 1
+
+        return columns
+
+    def _create_table(self, journeys):
+        self.columns = []
         self.operators = {}
         self.notes = {}
 
         for j in journeys:
-            wrapped = j.wrap(self.sequence)
-            o_code = j.local_operator_code
-            n_code = j.note_code
-
-            if o_code is not None:
-                self.operators[o_code] = j.operator_name
-            if n_code is not None:
-                self.notes[n_code] = j.note_text
-
-            head_journey.append(j.journey_id)
-            head_operator.append(o_code)
-            head_note.append(n_code)
-            columns.append(wrapped[0])
-
-            for i in range(1, len(wrapped)):
-                head_journey.append(None)
-                head_operator.append(None)
-                head_note.append(None)
-                columns.append(wrapped[i])
-
-        self.head = list(zip(head_journey, head_operator, head_note))
-        self.rows = []
-        for i, code in enumerate(self.sequence):
-            stop = self.stops[code]
-            self.rows.append(TimetableRow(stop, [c[i] for c in columns]))
+            first = j[0]
+            if first.local_operator_code is not None:
+                self.operators[first.local_operator_code] = first.operator_name
+            if first.note_code is not None:
+                self.notes[first.note_code] = first.note_text
+            self.columns.extend(self._wrap(j))
+
+        self.head = [(c.journey_id, c.operator, c.note) for c in self.columns]
+
+    def _collapse_frequencies(self):
+        """ Replaces runs of consecutive columns for journeys in the same
+            frequency band with the first and last columns and a column for
+            the headway between them.
+
+            Departures are checked as journeys may not be at a constant
+            headway in UTC when the clocks change.
+        """
+        bands = {}
+        for journeys, headway in _query_frequencies(self.service_id,
+                                                    self.direction):
+            for journey_id in journeys:
+                bands[journey_id] = (journeys[0], headway)
+
+        columns = []
+        run = []
+
+        def add_run():
+            if len(run) >= MIN_FREQUENCY_JOURNEYS:
+                minutes = int(run_headway.total_seconds()) // 60
+                columns.extend([run[0], TimetableColumn(headway=minutes),
+                                run[-1]])
+            else:
+                columns.extend(run)
+
+        for i, column in enumerate(self.columns):
+            band = bands.get(column.journey_id)
+            departure = column.utc_depart[0] or column.utc_arrive[0]
+            # Journeys wrapped over several columns are not replaced
+            single = (i + 1 == len(self.columns) or
+                      self.columns[i + 1].journey_id is not None)
+            if band is None or departure is None or not single:
+                add_run()
+                run = []
+                columns.append(column)
+                continue
+
+            if run and band[0] == run_band and (
+                departure - run_departure == band[1]
+            ):
+                run.append(column)
+            else:
+                add_run()
+                run = [column]
+            run_band, run_headway = band
+            run_departure = departure
+
+        add_run()
+        self.columns = columns
+        self.head = [(c.journey_id, c.operator, c.note) for c in self.columns]
+
+    def _create_rows(self, shift=None):
+        timing = array.array("b", bytes(len(self.sequence)))
+        for c in self.columns:
+            for index, timing_point in zip(c.rows, c.timing):
+                timing[index] |= timing_point
+
+        self.rows = [
+            TimetableRow(self.stops[code],
+                         TimetableCells(self.columns, i, code, shift),
+                         bool(timing[i]))
+            for i, code in enumerate(self.sequence)
+        ]
@@ -583,12 +583,9 @@ def service(service_code, reverse=None):
     }
     similar = sv.similar(is_reverse, 0.5)
 
-    s_graph, d_stops = graph.service_graph_stops(sv.id, is_reverse)
-    sequence = s_graph.sequence()
-    try:
-        layout = s_graph.draw(max_columns=graph.MAX_COLUMNS).serialize()
-    except graph.MaxColumnError:
-        layout = None
+    sequence, _, layout, _, d_stops = graph.service_layout(
+        sv.id, is_reverse, time_limit=graph.layout_time_limit()
+    )
 
     return render_template("service.html", service=sv, dest=destinations,
                            reverse=is_reverse, mirrored=mirrored,
@@ -619,7 +616,14 @@ def service_timetable(service_code, reverse=None):
     select_date.set_dates(sv)
 
     if select_date.validate():
-        tt_data = timetable.Timetable(sv.id, is_reverse, select_date.date.data)
+        tt_data = timetable.Timetable(
+            sv.id, is_reverse, select_date.date.data,
+            time_start=select_date.start.data,
+            time_end=select_date.end.data,
+            after=select_date.after_cursor,
+            limit=select_date.limit.data,
+            frequencies=not select_date.expand.data,
+        )
     else:
         tt_data = None
 
@@ -1,18 +1,26 @@
 """
 Testing live retrieval of data; will use sample data in the same format.
 """
+import datetime
 from importlib.resources import open_text
+import http.server
 import json
 import os
+import threading
+import time
 
 from flask import current_app
 import pytest
 import requests
 
-from nextbus.live import tapi
+from nextbus import live
+from nextbus import models
+from nextbus.live import circuit, quota, tapi
 
 
 ATCO_CODE = "490013767D"
+# Default connect and read timeouts in seconds
+TIMEOUT = (3.0, 5.0)
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -238,7 +246,9 @@ def mock_request(monkeypatch, mock_response):
     def get(*args, **kwargs):
         return mock_response()
 
-    monkeypatch.setattr(requests, "get", get)
+    session = requests.Session()
+    monkeypatch.setattr(session, "get", get)
+    monkeypatch.setattr(tapi, "get_session", lambda: session)
 
     return get
 
@@ -266,7 +276,7 @@ def test_live_data_arguments_default(with_app, mock_request):
         "limit": 6
     }
     assert mock_request.calls == [
-        ((tapi.URL_FCC.format(code=ATCO_CODE),), {"params": parameters})
+        ((tapi.URL_FCC.format(code=ATCO_CODE),), {"params": parameters, "timeout": TIMEOUT})
     ]
 
 
@@ -280,7 +290,7 @@ def test_live_data_arguments_ungrouped(with_app, mock_request):
         "limit": 8
     }
     assert mock_request.calls == [
-        ((tapi.URL_FCC.format(code=ATCO_CODE),), {"params": parameters})
+        ((tapi.URL_FCC.format(code=ATCO_CODE),), {"params": parameters, "timeout": TIMEOUT})
     ]
 
 
@@ -301,7 +311,7 @@ def test_live_data_arguments_api_key(with_app, mock_request):
         "app_key": api_key
     }
     assert mock_request.calls == [
-        ((tapi.URL_API.format(code=ATCO_CODE),), {"params": parameters})
+        ((tapi.URL_API.format(code=ATCO_CODE),), {"params": parameters, "timeout": TIMEOUT})
     ]
 
 
@@ -341,3 +351,369 @@ def test_live_data_default(with_app, mock_response, mock_request):
 
     current_app.config["TRANSPORT_API_ACTIVE"] = True
     assert tapi.get_nextbus_times(ATCO_CODE) == processed_data
+
+
+@pytest.fixture
+def mock_times(monkeypatch):
+    @Tracker
+    def get_nextbus_times(atco_code):
+        return {"atcoCode": atco_code, "services": []}
+
+    monkeypatch.setitem(current_app.config, "TRANSPORT_API_ACTIVE", True)
+    monkeypatch.setattr(live, "_within_limit", lambda: True)
+    monkeypatch.setattr(live, "_breaker", None)
+    monkeypatch.setattr(tapi, "get_nextbus_times", get_nextbus_times)
+    live._times_cache.clear()
+
+    return get_nextbus_times
+
+
+def test_live_times_shared(with_app, mock_times):
+    current_app.config["LIVE_CACHE_TTL"] = 30
+    first = live.get_times(ATCO_CODE)
+    second = live.get_times(ATCO_CODE)
+
+    assert first == second == {"atcoCode": ATCO_CODE, "services": []}
+    assert mock_times.calls == [((ATCO_CODE,), {})]
+
+
+def test_live_times_not_shared(with_app, mock_times):
+    current_app.config["LIVE_CACHE_TTL"] = 0
+    try:
+        live.get_times(ATCO_CODE)
+        live.get_times(ATCO_CODE)
+    finally:
+        current_app.config["LIVE_CACHE_TTL"] = 30
+
+    assert len(mock_times.calls) == 2
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """ Stands in for the Transport API, with a delay before responding and a
+        list of statuses to respond with.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.client_address)
+        time.sleep(self.server.delay)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = json.dumps({"name": "A bus stop"}).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch, with_app):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.delay = 0
+    server.statuses = []
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_port}/{{code}}/live.json"
+    monkeypatch.setattr(tapi, "URL_FCC", url)
+    monkeypatch.setattr(tapi, "RETRY_BACKOFF", 0)
+    for key, value in [("TRANSPORT_API_ACTIVE", True),
+                       ("TRANSPORT_API_ID", None),
+                       ("TRANSPORT_API_KEY", None),
+                       ("TRANSPORT_API_RETRIES", 2)]:
+        monkeypatch.setitem(current_app.config, key, value)
+    tapi.close_session()
+
+    yield server
+
+    tapi.close_session()
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_per_process(with_app):
+    tapi.close_session()
+    session = tapi.get_session()
+
+    assert tapi.get_session() is session
+    tapi.close_session()
+    assert tapi.get_session() is not session
+
+
+def test_session_reuses_connection(stub_server):
+    for _ in range(3):
+        assert tapi.get_live_data(ATCO_CODE) == {"name": "A bus stop"}
+
+    assert len(stub_server.requests) == 3
+    assert len(set(stub_server.requests)) == 1
+
+
+def test_session_read_timeout(stub_server, monkeypatch):
+    monkeypatch.setitem(current_app.config, "TRANSPORT_API_READ_TIMEOUT", 100)
+    stub_server.delay = 1
+
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        tapi.get_live_data(ATCO_CODE)
+
+    # Read timeouts are not retried
+    assert time.monotonic() - start < 1
+    assert len(stub_server.requests) == 1
+
+
+def test_session_retries_server_error(stub_server):
+    stub_server.statuses = [503, 502]
+
+    assert tapi.get_live_data(ATCO_CODE) == {"name": "A bus stop"}
+    assert len(stub_server.requests) == 3
+
+
+def test_session_internal_error_not_retried(stub_server):
+    stub_server.statuses = [500]
+
+    with pytest.raises(requests.HTTPError):
+        tapi.get_live_data(ATCO_CODE)
+    assert len(stub_server.requests) == 1
+
+
+def test_session_retries_exhausted(stub_server):
+    stub_server.statuses = [503, 503, 503]
+
+    with pytest.raises(requests.HTTPError):
+        tapi.get_live_data(ATCO_CODE)
+    assert len(stub_server.requests) == 3
+
+
+class Clock:
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+def test_breaker_opens_after_failures():
+    breaker = circuit.CircuitBreaker("test", failures=3, window=60,
+                                     clock=Clock())
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == circuit.CLOSED
+
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == circuit.OPEN
+    assert not breaker.allow()
+    assert breaker.to_json()["counts"] == {"allowed": 3, "failures": 3,
+                                           "opened": 1, "rejected": 1}
+
+
+def test_breaker_failures_expire():
+    clock = Clock()
+    breaker = circuit.CircuitBreaker("test", failures=2, window=60,
+                                     clock=clock)
+    breaker.failure()
+    clock.time = 61
+    breaker.failure()
+
+    assert breaker.state == circuit.CLOSED
+    assert breaker.to_json()["recentFailures"] == 1
+
+
+def test_breaker_slow_calls():
+    breaker = circuit.CircuitBreaker("test", failures=2, slow=1,
+                                     clock=Clock())
+    breaker.success(0.5)
+    breaker.success(2)
+    breaker.success(3)
+
+    assert breaker.state == circuit.OPEN
+    assert breaker.counts["slow"] == 2
+
+
+def test_breaker_half_open_probe():
+    clock = Clock()
+    breaker = circuit.CircuitBreaker("test", failures=1, reset=30,
+                                     clock=clock)
+    breaker.failure()
+    clock.time = 30
+    assert breaker.state == circuit.HALF_OPEN
+
+    # Only one call probes the service
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success(0.1)
+
+    assert breaker.state == circuit.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_half_open_failure():
+    clock = Clock()
+    breaker = circuit.CircuitBreaker("test", failures=1, reset=30,
+                                     clock=clock)
+    breaker.failure()
+    clock.time = 30
+    assert breaker.allow()
+    breaker.failure()
+
+    assert breaker.state == circuit.OPEN
+    clock.time = 59
+    assert not breaker.allow()
+    clock.time = 60
+    assert breaker.allow()
+
+
+def test_breaker_half_open_release():
+    clock = Clock()
+    breaker = circuit.CircuitBreaker("test", failures=1, reset=30,
+                                     clock=clock)
+    breaker.failure()
+    clock.time = 30
+    assert breaker.allow()
+    breaker.release()
+
+    assert breaker.state == circuit.HALF_OPEN
+    assert breaker.allow()
+
+
+@pytest.fixture
+def mock_timetabled(monkeypatch):
+    @Tracker
+    def get_timetabled_times(atco_code):
+        return {"atcoCode": atco_code, "live": False, "services": []}
+
+    monkeypatch.setattr(live.timetabled, "get_timetabled_times",
+                        get_timetabled_times)
+    monkeypatch.setitem(current_app.config, "LIVE_CACHE_TTL", 0)
+
+    return get_timetabled_times
+
+
+def test_live_times_fallback_error(with_app, monkeypatch, mock_times,
+                                   mock_timetabled):
+    def error(atco_code):
+        raise requests.ConnectionError
+
+    monkeypatch.setattr(tapi, "get_nextbus_times", error)
+    times = live.get_times(ATCO_CODE)
+
+    assert times == {"atcoCode": ATCO_CODE, "live": False, "services": []}
+    assert live.get_breaker().counts["failures"] == 1
+
+
+def test_live_times_fallback_open(with_app, mock_times, mock_timetabled):
+    breaker = live.get_breaker()
+    for _ in range(breaker.failures):
+        breaker.failure()
+    times = live.get_times(ATCO_CODE)
+
+    assert times == {"atcoCode": ATCO_CODE, "live": False, "services": []}
+    assert mock_times.calls == []
+    assert len(mock_timetabled.calls) == 1
+
+
+@pytest.fixture
+def mock_timetabled_stops(monkeypatch):
+    @Tracker
+    def get_timetabled_times_at_stops(atco_codes):
+        return {c: {"atcoCode": c, "live": False, "services": []}
+                for c in atco_codes}
+
+    monkeypatch.setattr(live.timetabled, "get_timetabled_times_at_stops",
+                        get_timetabled_times_at_stops)
+
+    return get_timetabled_times_at_stops
+
+
+def test_live_times_at_stops(with_app, mock_times, mock_timetabled_stops):
+    codes = ["490000015G", "490008638S", "490000015F"]
+    times = live.get_times_at_stops(codes)
+
+    assert times == {c: {"atcoCode": c, "services": []} for c in codes}
+    assert sorted(mock_times.calls) == [((c,), {}) for c in sorted(codes)]
+    assert mock_timetabled_stops.calls == []
+
+
+def test_live_times_at_stops_shared(with_app, mock_times,
+                                    mock_timetabled_stops):
+    current_app.config["LIVE_CACHE_TTL"] = 30
+    live.get_times("490000015G")
+    live.get_times_at_stops(["490000015G", "490008638S"])
+
+    assert mock_times.calls == [(("490000015G",), {}),
+                                (("490008638S",), {})]
+
+
+def test_live_times_at_stops_fallback(with_app, monkeypatch, mock_times,
+                                      mock_timetabled_stops):
+    monkeypatch.setitem(current_app.config, "LIVE_CACHE_TTL", 0)
+    breaker = live.get_breaker()
+    for _ in range(breaker.failures):
+        breaker.failure()
+
+    codes = ["490000015G", "490008638S"]
+    times = live.get_times_at_stops(codes)
+
+    assert times == {c: {"atcoCode": c, "live": False, "services": []}
+                     for c in codes}
+    assert mock_times.calls == []
+    assert mock_timetabled_stops.calls == [((codes,), {})]
+
+
+@pytest.fixture
+def mock_reserve(monkeypatch):
+    calls = {"count": 0}
+
+    @Tracker
+    def reserve(limit, block):
+        reserved = max(0, min(block, limit - calls["count"]))
+        calls["count"] += block
+        return reserved
+
+    monkeypatch.setattr(models.RequestLog, "reserve", reserve)
+
+    return reserve
+
+
+def test_quota_reserves_blocks(mock_reserve):
+    q = quota.Quota(block=4)
+    taken = [q.take(10) for _ in range(12)]
+
+    assert taken == [True] * 10 + [False] * 2
+    # Blocks of 4, 4 and 2 calls, then no more attempts once exhausted
+    assert mock_reserve.calls == [((10, 4), {})] * 4
+
+
+def test_quota_next_day(monkeypatch, mock_reserve):
+    q = quota.Quota(block=2)
+    assert [q.take(2) for _ in range(3)] == [True, True, False]
+    assert len(mock_reserve.calls) == 2
+
+    # Calls are reserved again on the next day
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    monkeypatch.setattr(quota.Quota, "_today", staticmethod(lambda: tomorrow))
+    q.take(2)
+    assert len(mock_reserve.calls) == 3
+
+
+def test_quota_no_limit_records_calls(monkeypatch, mock_reserve):
+    recorded = []
+    monkeypatch.setattr(models.RequestLog, "record", recorded.append)
+    q = quota.Quota(block=4)
+
+    assert all(q.take(None) for _ in range(10))
+    # Calls made are recorded for each block, without reserving any
+    assert recorded == [4, 4]
+    assert not mock_reserve.calls
+
+
+def test_quota_invalid_block():
+    with pytest.raises(ValueError):
+        quota.Quota(block=0)
@@ -0,0 +1,204 @@
+"""
+Testing caches shared across requests and workers.
+"""
+import os
+import threading
+import time
+
+import pytest
+
+from nextbus.cache import LRUCache, DirectoryStore, Cache
+
+
+def test_lru_get_set():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("b", 0) == 0
+    assert len(cache) == 1
+
+
+def test_lru_discard_least_recent():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_lru_invalid_size():
+    with pytest.raises(ValueError):
+        LRUCache(0)
+
+
+def test_directory_store(tmp_path):
+    path = str(tmp_path / "store")
+    store = DirectoryStore(path)
+    assert store.get("a") is None
+
+    store.set("a", {"value": [1, 2]})
+    assert store.get("a") == {"value": [1, 2]}
+    assert DirectoryStore(path).get("a") == {"value": [1, 2]}
+    assert os.listdir(path) == ["a"]
+
+
+def test_directory_store_evict_least_recent(tmp_path):
+    store = DirectoryStore(str(tmp_path), maxsize=2)
+    store.set("a", 1)
+    store.set("b", 2)
+    os.utime(tmp_path / "a", (0, 0))
+    os.utime(tmp_path / "b", (0, 1))
+    # Reading a value marks it as recently used
+    assert store.get("a") == 1
+    store.set("c", 3)
+    assert sorted(store.keys()) == ["a", "b", "c"]
+
+    store.evict()
+    assert sorted(store.keys()) == ["a", "c"]
+
+
+def test_directory_store_delete(tmp_path):
+    store = DirectoryStore(str(tmp_path))
+    store.set("a", 1)
+    with store.lock("a"):
+        pass
+    store.delete("a")
+    store.delete("b")
+
+    assert store.get("a") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_directory_store_invalid_key(tmp_path):
+    store = DirectoryStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.get("../a")
+
+
+def test_cache_memory_only():
+    cache = Cache("test", maxsize=2)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+
+
+def test_cache_directory(with_app, tmp_path):
+    with_app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        cache = Cache("test")
+        cache.set("a", 1)
+        # Another worker would only have the value in the directory
+        other = Cache("test")
+        assert other.get("a") == 1
+        assert "a" in other.local
+        assert os.listdir(tmp_path / "test") == ["a"]
+    finally:
+        with_app.config["CACHE_DIRECTORY"] = None
+
+
+def test_cache_directory_not_shared(with_app, tmp_path):
+    with_app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        cache = Cache("test")
+        cache.set("a", 1, shared=False)
+        assert cache.get("a") == 1
+        assert Cache("test").get("a") is None
+    finally:
+        with_app.config["CACHE_DIRECTORY"] = None
+
+
+def test_cache_prune(with_app, tmp_path):
+    with_app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        cache = Cache("test")
+        cache.set("1-a", 1)
+        cache.set("2-a", 2)
+        cache.prune(lambda key: key.startswith("2-"))
+
+        assert cache.local.keys() == ["2-a"]
+        assert os.listdir(tmp_path / "test") == ["2-a"]
+    finally:
+        with_app.config["CACHE_DIRECTORY"] = None
+
+
+def test_cache_directory_evicted(with_app, tmp_path):
+    with_app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        cache = Cache("test", store_size=32)
+        # Store is checked after every 2 values set
+        for i in range(33):
+            cache.set(f"k{i}", i)
+        assert len(os.listdir(tmp_path / "test")) == 33
+        cache.set("k33", 33)
+        assert len(os.listdir(tmp_path / "test")) == 32
+    finally:
+        with_app.config["CACHE_DIRECTORY"] = None
+
+
+def test_cache_ttl(monkeypatch):
+    cache = Cache("test")
+    cache.set("a", 1, ttl=10)
+    assert cache.get("a") == 1
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert cache.get("a") is None
+
+
+def test_cache_get_or_set():
+    cache = Cache("test")
+    calls = []
+
+    def create():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_set("a", create) == 1
+    assert cache.get_or_set("a", create) == 1
+    assert len(calls) == 1
+
+
+def test_cache_get_or_set_coalesced():
+    cache = Cache("test")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def create():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    def get():
+        results.append(cache.get_or_set("a", create, ttl=10))
+
+    threads = [threading.Thread(target=get) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ["value"] * 5
+
+
+def test_cache_get_or_set_directory(with_app, tmp_path):
+    with_app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        Cache("test").get_or_set("a", lambda: 1, ttl=10)
+        # Another worker would use the value set in the directory
+        assert Cache("test").get_or_set("a", lambda: 2, ttl=10) == 1
+    finally:
+        with_app.config["CACHE_DIRECTORY"] = None
@@ -3,9 +3,14 @@ Testing the graph module for service diagrams.
 """
 import pytest
 
+from nextbus import db, models
 from nextbus.graph import (
     Path, Graph, Layout, LayoutRow, _coalesce, _rearrange_cycles, _median,
-    MaxColumnError, LayoutError
+    _count_inversions, _transpose_order, _strong_components,
+    MaxColumnError, LayoutError, service_graph_stops, service_layout,
+    service_sequence,
+    compute_layouts, refresh_layouts, _graph_fingerprint, _layout_data,
+    _layout_cache
 )
 
 
@@ -577,6 +582,27 @@ def test_split_graph_connected(simple_graph):
     assert simple_graph.split() == [simple_graph]
 
 
+def test_split_graph_isolated():
+    graph = Graph([(0, 1), (2, 3)], singles=[4])
+
+    g_split = graph.split()
+    assert len(g_split) == 3
+    assert Graph([(0, 1)]) in g_split
+    assert Graph([(2, 3)]) in g_split
+    assert g_split[-1] == Graph(singles=[4])
+
+
+def test_split_graph_joined_later():
+    # Chains are only connected by the last edges
+    chains = [[(i, i + 1) for i in range(j, j + 9)] for j in range(0, 100, 10)]
+    edges = [e for c in chains for e in c]
+    graph = Graph(edges + [(j + 9, j + 10) for j in range(0, 40, 10)])
+
+    g_split = graph.split()
+    assert len(g_split) == 6
+    assert sorted(len(g) for g in g_split) == [10, 10, 10, 10, 10, 50]
+
+
 def test_copy_simple(simple_graph):
     copy = simple_graph.copy()
     assert copy == simple_graph
@@ -720,6 +746,56 @@ def test_search_paths_start_zero(key, expected):
     assert graph_from_key(key).search_paths(0) == expected
 
 
+def test_search_paths_sorted():
+    graph = Graph([(0, 1), (0, 2), (1, 3), (2, 3)], sort=lambda v: -v)
+    assert graph.search_paths(0)[3] == Path([0, 2, 3])
+
+
+def test_search_paths_target(complex_graph):
+    assert complex_graph.search_paths(0, t=8) == {8: Path([0, 1, 5, 7, 8])}
+
+
+def test_search_paths_target_not_found(complex_graph):
+    assert complex_graph.search_paths(5, t=0) == {0: Path()}
+
+
+def test_search_paths_backward(complex_graph):
+    paths = complex_graph.search_paths(5, forward=False)
+    assert paths[5] == Path([1, 5])
+    assert not any(p for v, p in paths.items() if v != 5)
+
+
+@pytest.mark.parametrize("key", [k for k in GRAPHS if k != "empty"])
+def test_search_tree(key):
+    graph = graph_from_key(key)
+    tree = graph.search_tree(0)
+    assert tree == graph.search_paths(0)
+    assert all(tree.length(v) == len(p) for v, p in tree.items())
+
+
+def test_search_tree_reached(complex_graph):
+    tree = complex_graph.search_tree(5)
+    assert tree.reached == [6, 7, 8, 9, 10]
+    assert tree.length(10) == 5
+    assert tree.length(0) == 0
+    assert tree[0] == Path()
+
+
+def test_search_tree_self_cycle():
+    graph = Graph([(0, 0), (0, 1), (1, 2)])
+    tree = graph.search_tree(0)
+    assert tree[0] == Path([0, 0])
+    assert tree.length(2) == 3
+
+
+def test_search_paths_modified(simple_graph):
+    assert simple_graph.search_paths(0)[4] == Path([0, 1, 2, 3, 4])
+    simple_graph.add_edge(1, 4)
+    assert simple_graph.search_paths(0)[4] == Path([0, 1, 4])
+    simple_graph.remove_edge(1, 4)
+    assert simple_graph.search_paths(0)[4] == Path([0, 1, 2, 3, 4])
+
+
 @pytest.mark.parametrize("key, expected", {
     "empty": Path(),
     "single": Path(),
@@ -740,6 +816,31 @@ def test_graph_diameter(key, expected):
     assert graph_from_key(key).diameter() == expected
 
 
+def test_graph_chains():
+    assert graph_from_key("path with loop")._chains() == {
+        1: ([1, 2], 0),
+        3: ([3, 4, 5], 0),
+        4: ([3, 4, 5], 1),
+        6: ([6, 7], 0),
+    }
+
+
+def test_graph_chains_cycle():
+    assert graph_from_key("simple cycle")._chains() == {}
+
+
+def test_graph_diameter_from_chain():
+    # Vertex 1 only has one preceding and one following vertex
+    graph = Graph([(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6), (0, 4),
+                   (0, 6)])
+    assert graph.diameter() == Path([1, 2, 3, 4, 5, 6])
+
+
+def test_graph_diameter_from_chain_cycle():
+    graph = Graph([(0, 1), (1, 2), (2, 3), (3, 0), (0, 2)])
+    assert graph.diameter() == Path([1, 2, 3, 0, 1])
+
+
 @pytest.mark.parametrize("key, expected", {
     "empty": [],
     "single": [],
@@ -827,6 +928,22 @@ def test_graph_sequence(key, expected):
     assert graph_from_key(key).sequence() == expected
 
 
+@pytest.mark.parametrize("key, expected", {
+    "simple": [{0}, {1}, {2}, {3}, {4}],
+    "self cycle": [{0}, {1}, {2}, {3}],
+    "simple cycle": [{0, 1, 2, 3}],
+    "ending cycle": [{0}, {1}, {2, 3, 4, 5}],
+    "crossed cycles": [{0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15}],
+}.items())
+def test_strong_components(key, expected):
+    components = _strong_components(graph_from_key(key))
+    groups = {}
+    for v, c in components.items():
+        groups.setdefault(c, set()).add(v)
+
+    assert sorted(groups.values(), key=min) == expected
+
+
 def test_graph_rearrange_cycles(complex_cycle_graph):
     # 8 is not in a cycle but is placed before 9 - need to rearrange
     sequence = [4, 6, 1, 2, 3, 5, 7, 8, 9, 0]
@@ -1165,6 +1282,34 @@ def test_count_crossings(simple_layout, start, end, expected):
     assert row.count_crossings() == expected
 
 
+@pytest.mark.parametrize("pairs, expected", [
+    (set(), 0),
+    ({(0, 0)}, 0),
+    ({(0, 1), (1, 0)}, 1),
+    ({(0, 0), (0, 1), (1, 0)}, 1),
+    ({(0, 2), (1, 1), (2, 0)}, 3),
+    ({(0, 1), (1, 1), (1, 0), (2, 1)}, 1),
+    ({(0, 3), (0, 2), (1, 2), (1, 0), (2, 1), (3, 0)}, 10),
+], ids=repr)
+def test_count_inversions(pairs, expected):
+    assert _count_inversions(pairs) == expected
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    ([{1}, {2}], [{1}, {2}], [0, 1]),
+    ([{1}, {2}], [{2}, {1}], [1, 0]),
+    ([{1}, {1, 2}, {3}], [{3}, {1}, {2}], [1, 2, 0]),
+    ([{1, 2}], [{2}, {1}], [0, 1]),
+], ids=repr)
+def test_transpose_order(simple_layout, start, end, expected):
+    row = LayoutRow(simple_layout, 0, 0, start, end, {}, {})
+    order = _transpose_order(row)
+    new_end = [end[i] for i in order]
+
+    assert order == expected
+    assert row.count_crossings(end=new_end) <= row.count_crossings()
+
+
 @pytest.mark.parametrize("key, expected", {
     "empty": 0,
     "single": 0,
@@ -1449,3 +1594,191 @@ def test_limit_not_hit(complex_graph):
 def test_limit_hit(complex_graph):
     with pytest.raises(MaxColumnError):
         complex_graph.draw(max_columns=1)
+
+
+def test_draw_time_limit(complex_graph):
+    layout = complex_graph.draw(time_limit=0)
+    unordered = Layout(complex_graph, ordered=False)
+
+    assert layout.approximate
+    assert layout.crossings() <= unordered.crossings()
+
+
+def test_draw_time_limit_not_hit(complex_graph):
+    layout = complex_graph.draw(time_limit=60)
+    assert not layout.approximate
+    assert layout.serialize() == Layout(complex_graph).serialize()
+
+
+def test_draw_memoized_arguments(complex_graph):
+    layout = complex_graph.draw(max_columns=4)
+    assert complex_graph.draw(max_columns=4) is layout
+
+    with pytest.raises(MaxColumnError):
+        complex_graph.draw(max_columns=1)
+
+
+def test_draw_approximate_not_memoized(complex_graph):
+    layout = complex_graph.draw(time_limit=0)
+    assert layout.approximate
+    assert complex_graph.draw(time_limit=0) is not layout
+    assert not complex_graph.draw().approximate
+
+
+def _live_layout(service_id, direction):
+    graph, stops = service_graph_stops(service_id, direction)
+    paths, sequence = graph.analyse()
+    layout = graph.draw(5).serialize()
+
+    return list(sequence), [list(p) for p in paths], layout, False, stops
+
+
+def test_service_layout_precomputed(load_db):
+    row = models.ServiceLayout.query.get((645, False))
+    assert row is not None
+    assert models.ServiceLayout.query.count() == 2
+
+    sequence, paths, layout, _, stops = _live_layout(645, False)
+    assert row.sequence == sequence
+    assert row.paths == paths
+    assert row.layout == layout
+
+    assert service_layout(645, False) == (sequence, paths, layout, False,
+                                          stops)
+
+
+def test_service_layout_not_precomputed(load_db):
+    expected = _live_layout(645, True)
+    models.ServiceLayout.query.delete()
+    db.session.commit()
+
+    assert service_layout(645, True) == expected
+
+
+def test_service_sequence(load_db):
+    sequence, _, _, _, stops = _live_layout(645, False)
+    expected = [v for v in sequence if v is not None]
+    assert service_sequence(645, False) == (expected, stops)
+
+
+def test_service_sequence_not_precomputed(load_db, monkeypatch):
+    graph, stops = service_graph_stops(645, True)
+    expected = list(graph.sequence())
+    models.ServiceLayout.query.delete()
+    db.session.commit()
+
+    def no_draw(*args, **kwargs):
+        raise AssertionError("Layout should not be drawn")
+
+    monkeypatch.setattr(Graph, "draw", no_draw)
+    assert service_sequence(645, True) == (expected, stops)
+
+
+def test_service_layout_max_columns(load_db):
+    assert service_layout(645, False, max_columns=0)[2] is None
+
+
+def test_compute_layouts_pool(load_db):
+    with db.engine.connect() as connection:
+        expected = compute_layouts(connection)
+        rows = compute_layouts(connection, jobs=2)
+
+    key = lambda r: (r["service_ref"], r["direction"])
+    assert sorted(rows, key=key) == sorted(expected, key=key)
+    assert {key(r) for r in rows} == {(645, False), (645, True)}
+
+
+def test_refresh_layouts(load_db):
+    expected = {
+        (r.service_ref, r.direction): (r.sequence, r.paths, r.layout)
+        for r in models.ServiceLayout.query.all()
+    }
+    db.session.remove()
+    models.ServiceLayout.query.delete()
+    db.session.commit()
+
+    refresh_layouts(jobs=2)
+
+    layouts = {
+        (r.service_ref, r.direction): (r.sequence, r.paths, r.layout)
+        for r in models.ServiceLayout.query.all()
+    }
+    assert layouts == expected
+
+
+def test_graph_fingerprint_relabelled():
+    rank_a = {"A": 0, "B": 1, "C": 2, "D": 3}
+    rank_b = {"W": 0, "X": 1, "Y": 2, "Z": 3}
+    graph_a = Graph([("A", "B"), ("B", "C"), ("A", "D"), ("D", "C")],
+                    sort=rank_a.get)
+    graph_b = Graph([("Z", "Y"), ("W", "X"), ("X", "Y"), ("W", "Z")],
+                    sort=rank_b.get)
+
+    key_a, ranked_a = _graph_fingerprint(graph_a, 5)
+    key_b, ranked_b = _graph_fingerprint(graph_b, 5)
+    assert key_a == key_b
+    assert ranked_a == ["A", "B", "C", "D"]
+    assert ranked_b == ["W", "X", "Y", "Z"]
+    assert _graph_fingerprint(graph_a, 4)[0] != key_a
+
+
+def test_graph_fingerprint_ranking():
+    graph_a = Graph([("A", "B"), ("B", "C")], sort={"A": 0, "B": 1, "C": 2}.get)
+    graph_b = Graph([("A", "B"), ("B", "C")], sort={"A": 2, "B": 1, "C": 0}.get)
+
+    assert _graph_fingerprint(graph_a, 5)[0] != _graph_fingerprint(graph_b, 5)[0]
+
+
+def test_graph_fingerprint_not_unique():
+    graph = Graph([("A", "B"), ("B", "C")], sort={"A": 0, "B": 0, "C": 1}.get)
+    assert _graph_fingerprint(graph, 5) is None
+
+
+def test_layout_data_cached():
+    _layout_cache.clear()
+    rank_a = {"A": 0, "B": 1, "C": 2, "D": 3}
+    rank_b = {"W": 0, "X": 1, "Y": 2, "Z": 3}
+    graph_a = Graph([("A", "B"), ("B", "C"), ("A", "D"), ("D", "C")],
+                    sort=rank_a.get)
+    graph_b = Graph([("W", "X"), ("X", "Y"), ("W", "Z"), ("Z", "Y")],
+                    sort=rank_b.get)
+
+    sequence, paths, layout, approximate = _layout_data(graph_a)
+    assert not approximate
+    assert len(_layout_cache.local) == 1
+
+    labels = dict(zip("ABCD", "WXYZ"))
+    assert _layout_data(graph_b) == (
+        [labels[v] for v in sequence],
+        [[labels[v] for v in p] for p in paths],
+        [[labels[v], c, p] for v, c, p in layout],
+        False
+    )
+    assert len(_layout_cache.local) == 1
+
+
+def test_graph_fingerprint_cyclic():
+    graph = Graph([("A", "B"), ("B", "C"), ("C", "A"), ("C", "D")],
+                  sort={"A": 0, "B": 1, "C": 2, "D": 3}.get)
+    assert _graph_fingerprint(graph, 5) is None
+
+
+def test_layout_data_cyclic_not_relabelled():
+    _layout_cache.clear()
+    rank_a = {"A": 0, "B": 1, "C": 2, "D": 3, "E": 4}
+    rank_b = {"V": 0, "W": 1, "X": 2, "Y": 3, "Z": 4}
+    edges_a = [("A", "B"), ("B", "C"), ("C", "D"), ("D", "B"), ("C", "E"),
+               ("E", "C")]
+    labels = dict(zip("ABCDE", "VWXYZ"))
+    edges_b = [(labels[u], labels[v]) for u, v in edges_a]
+
+    _layout_data(Graph(edges_a, sort=rank_a.get), max_columns=5)
+    assert len(_layout_cache.local) == 0
+
+    layout = Layout(Graph(edges_b, sort=rank_b.get), max_columns=5)
+    sequence, paths, data, approximate = _layout_data(
+        Graph(edges_b, sort=rank_b.get), max_columns=5
+    )
+    assert data == layout.serialize()
+    assert not approximate
+    assert len(_layout_cache.local) == 0
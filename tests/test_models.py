@@ -1,6 +1,8 @@
 """
 Test models
 """
+import datetime
+
 from nextbus import db, models
 
 
@@ -46,3 +48,89 @@ def test_request_next_day(create_db):
 
     assert models.RequestLog.call(5)
     assert log.call_count == 1
+
+
+def test_request_log_reserve(create_db):
+    assert models.RequestLog.reserve(120, 50) == 50
+    assert models.RequestLog.reserve(120, 50) == 50
+    assert models.RequestLog.reserve(120, 50) == 20
+    assert models.RequestLog.reserve(120, 50) == 0
+
+    # Only calls within the limit are counted
+    log = models.RequestLog.query.one()
+    assert log.call_count == 120
+
+
+def test_request_log_reserve_no_limit(create_db):
+    assert models.RequestLog.reserve(None, 50) == 50
+    assert models.RequestLog.reserve(-1, 50) == 50
+
+    # Nothing is reserved without a limit
+    log = models.RequestLog.query.one()
+    assert log.call_count == 0
+
+
+def test_request_log_record(create_db):
+    models.RequestLog.record(3)
+    models.RequestLog.record(2)
+
+    log = models.RequestLog.query.one()
+    assert log.call_count == 5
+
+
+def test_request_log_reserve_after_call(create_db):
+    assert all(list(models.RequestLog.call(10) for _ in range(8)))
+    db.session.commit()
+
+    assert models.RequestLog.reserve(10, 5) == 2
+
+
+def test_data_version_empty(create_db):
+    assert models.DataVersion.current() is None
+
+
+def test_data_version_refreshed(load_db):
+    version = models.DataVersion.current()
+    assert version.isdigit()
+
+    with db.engine.begin() as connection:
+        models.data.refresh(connection)
+
+    assert models.DataVersion.current() > version
+
+
+def test_data_version_once_per_request(load_db, app):
+    with app.test_request_context():
+        version = models.DataVersion.current()
+        with db.engine.begin() as connection:
+            models.data.refresh(connection)
+        # Kept for the rest of the request
+        assert models.DataVersion.current() == version
+
+    assert models.DataVersion.current() > version
+
+
+def test_journey_data(load_db):
+    journey = models.Journey.query.get(400012)
+
+    assert journey.stop_refs[0] == "490000015G"
+    assert journey.flags[0] == models.TIMING_POINT | models.STOPPING
+    assert journey.arrive[0] is None
+    assert journey.depart[0] == 0
+
+
+def test_journey_record_set(load_db):
+    data = models.Journey.record_set()
+    first = (
+        db.session.query(data)
+        .select_from(models.Journey)
+        .join(data, db.true())
+        .filter(models.Journey.id == 400012)
+        .order_by(data.c.sequence)
+        .first()
+    )
+
+    assert first.stop_point_ref == "490000015G"
+    assert first.timing_point and first.stopping
+    assert first.arrive is None
+    assert first.depart == datetime.timedelta(0)
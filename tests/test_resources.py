@@ -215,6 +215,7 @@ SERVICE_JSON = {
         ["490000015G", 0, [[0, 0, 0, None]]],
         ["490008638S", 0, []]
     ],
+    "layoutApproximate": False,
     "other": []
 }
 
@@ -258,6 +259,36 @@ def test_live_data_api(client, db_loaded):
     assert response.cache_control.max_age == 60
 
 
+def test_live_data_api_stops(client, db_loaded):
+    response = client.get("/api/live?stops=490000015G,490008638S,490000015F")
+    data = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert response.cache_control.max_age == 60
+    assert list(data["stops"]) == ["490000015G", "490008638S"]
+    assert data["stops"]["490000015G"]["atcoCode"] == "490000015G"
+    assert data["notFound"] == ["490000015F"]
+
+
+@pytest.mark.parametrize("stops, status", [
+    ("", 400),
+    (",".join(f"490000015{i:02d}" for i in range(21)), 400),
+    ("490000015F", 404),
+])
+def test_live_data_api_stops_invalid(client, db_loaded, stops, status):
+    response = client.get(f"/api/live?stops={stops}")
+
+    assert response.status_code == status
+
+
+def test_live_status_api(client, db_loaded):
+    response = client.get("/api/status/live")
+
+    assert response.status_code == 200
+    assert response.cache_control.no_store
+    assert json.loads(response.data)["state"] == "closed"
+
+
 def test_live_data_api_not_found(client, db_loaded):
     response = client.get("/api/live/490000015F")
 
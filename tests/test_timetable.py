@@ -1,13 +1,20 @@
 """
 Test timetable generation.
 """
+import collections
 import datetime
+import os
 
 import pytest
 
-from nextbus import db, models
+from nextbus import db, models, timetable
 from nextbus.timetable import (_query_journeys, _query_timetable, Timetable,
-                               TimetableRow, TimetableStop)
+                               _query_journeys_range, _query_timetable_range,
+                               TimetableRow, TimetableStop, get_next_services,
+                               _in_calendar, _select_journey_calendar,
+                               _departure_time_range, _timetable_cache,
+                               _find_frequencies, get_next_services_at_stops,
+                               prune_cache)
 
 
 SERVICE = 645
@@ -16,6 +23,12 @@ DIRECTION = False
 GMT = datetime.timezone(datetime.timedelta(hours=0))
 BST = datetime.timezone(datetime.timedelta(hours=1))
 
+Row = collections.namedtuple("Row", [
+    "journey_id", "departure", "local_operator_code", "operator_code",
+    "operator_name", "note_code", "note_text", "stop_point_ref",
+    "timing_point", "utc_arrive", "utc_depart", "arrive", "depart"
+])
+
 
 @pytest.fixture
 def load_org(load_db):
@@ -100,6 +113,27 @@ def set_night_times(load_db):
         }, synchronize_session=False)
     )
     db.session.commit()
+    _load_stop_departures()
+
+
+def _load_calendar(date_start, days=60):
+    table = models.JourneyCalendar.__table__
+    columns = [c.name for c in table.columns]
+    with db.engine.begin() as connection:
+        connection.execute(table.delete())
+        connection.execute(table.insert().from_select(
+            columns,
+            _select_journey_calendar(date_start, days)
+        ))
+
+
+def _load_stop_departures():
+    table = models.StopDeparture.__table__
+    columns = [c.name for c in table.columns]
+    with db.engine.begin() as connection:
+        connection.execute(table.delete())
+        for statement in models.derived.insert_stop_departures(connection):
+            connection.execute(table.insert().from_select(columns, statement))
 
 
 def _expected_journeys(first_departure):
@@ -432,6 +466,87 @@ def test_query_timetable_sunday(load_db):
     ]
 
 
+def test_journeys_time_window(load_db):
+    date = datetime.date(2019, 3, 3)
+    query = _query_journeys(SERVICE, DIRECTION, date,
+                            time_start=datetime.time(9, 0),
+                            time_end=datetime.time(10, 0))
+    result = query.order_by("departure").all()
+
+    assert result == [
+        (400013, datetime.datetime(2019, 3, 3, 9, 0, tzinfo=GMT)),
+        (400014, datetime.datetime(2019, 3, 3, 9, 30, tzinfo=GMT)),
+    ]
+
+
+def test_journeys_limit_after(load_db):
+    date = datetime.date(2019, 3, 3)
+    query = _query_journeys(SERVICE, DIRECTION, date,
+                            after=(datetime.time(9, 0), 400013), limit=2)
+    result = query.order_by("departure").all()
+
+    assert result == [
+        (400014, datetime.datetime(2019, 3, 3, 9, 30, tzinfo=GMT)),
+        (400015, datetime.datetime(2019, 3, 3, 10, 0, tzinfo=GMT)),
+    ]
+
+
+def test_journeys_limit_dst(set_night_times):
+    # Journeys repeated when clocks go back are counted once
+    date = datetime.date(2019, 10, 27)
+    query = _query_journeys(SERVICE, DIRECTION, date,
+                            after=(datetime.time(0, 45), 400013), limit=2)
+    result = query.order_by("departure").all()
+
+    assert result == [
+        (400014, datetime.datetime(2019, 10, 27, 1, 15, tzinfo=BST)),
+        (400015, datetime.datetime(2019, 10, 27, 1, 45, tzinfo=BST)),
+        (400014, datetime.datetime(2019, 10, 27, 1, 15, tzinfo=GMT)),
+        (400015, datetime.datetime(2019, 10, 27, 1, 45, tzinfo=GMT)),
+    ]
+
+
+def _days(date_start, date_end):
+    return [date_start + datetime.timedelta(days=i)
+            for i in range((date_end - date_start).days + 1)]
+
+
+@pytest.mark.parametrize("date_start, date_end", [
+    (datetime.date(2019, 3, 3), datetime.date(2019, 3, 3)),
+    (datetime.date(2019, 3, 28), datetime.date(2019, 4, 2)),
+    (datetime.date(2019, 10, 26), datetime.date(2019, 10, 28)),
+])
+def test_journeys_range(set_night_times, date_start, date_end):
+    query = _query_journeys_range(SERVICE, DIRECTION, date_start, date_end)
+    result = query.order_by("date", "departure").all()
+
+    expected = []
+    for date in _days(date_start, date_end):
+        query = _query_journeys(SERVICE, DIRECTION, date).order_by("departure")
+        expected.extend((date, *r) for r in query.all())
+
+    assert [tuple(r) for r in result] == expected
+
+
+def test_journeys_range_invalid(load_db):
+    with pytest.raises(ValueError):
+        _query_journeys_range(SERVICE, DIRECTION, datetime.date(2019, 3, 4),
+                              datetime.date(2019, 3, 3))
+
+
+def test_query_timetable_range(load_db):
+    date_start, date_end = datetime.date(2019, 3, 1), datetime.date(2019, 3, 7)
+    result = _query_timetable_range(SERVICE, DIRECTION, date_start,
+                                    date_end).all()
+
+    assert result[0]._fields[0] == "date"
+    for date in _days(date_start, date_end):
+        expected = _query_timetable(SERVICE, DIRECTION, date).all()
+        assert [tuple(r)[1:] for r in result if r.date == date] == [
+            tuple(r) for r in expected
+        ]
+
+
 def test_timetable_empty():
     service, direction, date = 0, False, datetime.date(2019, 3, 3)
     tt = Timetable(service, direction, date, [], {})
@@ -443,6 +558,57 @@ def test_timetable_empty():
     assert tt.rows == []
 
 
+def _timetable_row(journey_id, stop, time, timing=True):
+    utc = datetime.datetime(2019, 3, 3, *time)
+    return Row(journey_id, None, None, None, None, None, None, stop,
+               timing, utc, utc, f"{time[0]:02d}{time[1]:02d}",
+               f"{time[0]:02d}{time[1]:02d}")
+
+
+def test_timetable_journeys_ordered():
+    date = datetime.date(2019, 3, 3)
+    sequence = ["A", "B", "C"]
+    stops = {code: None for code in sequence}
+    result = [
+        _timetable_row(1, "A", (8, 0)),
+        _timetable_row(1, "B", (8, 10)),
+        # Starts at second stop, running between the other two journeys
+        _timetable_row(2, "B", (8, 5)),
+        _timetable_row(2, "C", (8, 15)),
+        _timetable_row(3, "A", (7, 50)),
+        _timetable_row(3, "B", (8, 0)),
+        _timetable_row(3, "C", (8, 10)),
+    ]
+    tt = Timetable(SERVICE, DIRECTION, date, sequence, stops, result)
+
+    assert [h[0] for h in tt.head] == [3, 2, 1]
+    assert [t.depart if t else None for t in tt.rows[0].times] == [
+        "0750", None, "0800"
+    ]
+
+
+def test_timetable_journey_wrapped():
+    date = datetime.date(2019, 3, 3)
+    sequence = ["A", "B", "C"]
+    stops = {code: None for code in sequence}
+    result = [
+        _timetable_row(1, "A", (8, 0)),
+        _timetable_row(1, "B", (8, 10)),
+        _timetable_row(1, "C", (8, 20), timing=False),
+        _timetable_row(1, "A", (8, 30)),
+        _timetable_row(1, "B", (8, 40)),
+    ]
+    tt = Timetable(SERVICE, DIRECTION, date, sequence, stops, result)
+
+    assert tt.head == [(1, None, None), (None, None, None)]
+    assert [[t.depart if t else None for t in r.times] for r in tt.rows] == [
+        ["0800", "0830"],
+        ["0810", "0840"],
+        ["0820", None],
+    ]
+    assert [r.timing for r in tt.rows] == [True, True, False]
+
+
 def test_timetable_sunday(load_db):
     date = datetime.date(2019, 3, 3)
     tt = Timetable(SERVICE, DIRECTION, date)
@@ -466,3 +632,330 @@ def test_timetable_sunday(load_db):
                       datetime.datetime(2019, 3, 3, 8, 34, 35),
                       datetime.datetime(2019, 3, 3, 8, 34, 35))
     ]
+
+
+def test_timetable_shared_dates(load_db):
+    _timetable_cache.clear()
+    tt_first = Timetable(SERVICE, DIRECTION, datetime.date(2019, 3, 3))
+    tt_second = Timetable(SERVICE, DIRECTION, datetime.date(2019, 3, 10))
+
+    # Both Sundays in GMT with the same journeys, with a key for each date
+    assert len(_timetable_cache.local) == 3
+    assert tt_second.columns is tt_first.columns
+    assert tt_second.head == tt_first.head
+    assert tt_second.rows[0].times[0] == TimetableStop(
+        "490000015G", None, "0830", True, None,
+        datetime.datetime(2019, 3, 10, 8, 30)
+    )
+
+
+def test_timetable_not_shared_dst(load_db):
+    _timetable_cache.clear()
+    Timetable(SERVICE, DIRECTION, datetime.date(2019, 3, 3))
+    Timetable(SERVICE, DIRECTION, datetime.date(2019, 4, 7))
+
+    assert len(_timetable_cache.local) == 4
+
+
+def test_timetable_cached_version(load_db):
+    _timetable_cache.clear()
+    date = datetime.date(2019, 3, 3)
+    tt_first = Timetable(SERVICE, DIRECTION, date)
+    tt_second = Timetable(SERVICE, DIRECTION, date)
+    assert tt_second.columns is tt_first.columns
+
+    with db.engine.begin() as connection:
+        models.data.refresh(connection)
+    tt_third = Timetable(SERVICE, DIRECTION, date)
+
+    assert tt_third.columns is not tt_first.columns
+    assert tt_third.head == tt_first.head
+
+
+def test_timetable_window_not_shared(load_db, app, tmp_path):
+    _timetable_cache.clear()
+    app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        date = datetime.date(2019, 3, 3)
+        Timetable(SERVICE, DIRECTION, date)
+        stored = sorted(os.listdir(tmp_path / "timetables"))
+        Timetable(SERVICE, DIRECTION, date, time_start=datetime.time(9, 0))
+        Timetable(SERVICE, DIRECTION, date, after=(datetime.time(9), 400013),
+                  limit=5)
+
+        # Windows are kept in memory only
+        assert len(stored) == 2
+        assert sorted(os.listdir(tmp_path / "timetables")) == stored
+        assert len(_timetable_cache.local) == 5
+    finally:
+        app.config["CACHE_DIRECTORY"] = None
+
+
+def test_timetable_cache_pruned(load_db, app, tmp_path):
+    _timetable_cache.clear()
+    app.config["CACHE_DIRECTORY"] = str(tmp_path)
+    try:
+        date = datetime.date(2019, 3, 3)
+        Timetable(SERVICE, DIRECTION, date)
+        prune_cache()
+        assert len(os.listdir(tmp_path / "timetables")) == 2
+
+        with db.engine.begin() as connection:
+            models.data.refresh(connection)
+        prune_cache()
+
+        assert len(_timetable_cache.local) == 0
+        assert os.listdir(tmp_path / "timetables") == []
+    finally:
+        app.config["CACHE_DIRECTORY"] = None
+
+
+def test_timetable_from_range(load_db):
+    _timetable_cache.clear()
+    date_start, date_end = datetime.date(2019, 3, 3), datetime.date(2019, 3, 9)
+    timetables = Timetable.from_range(SERVICE, DIRECTION, date_start, date_end)
+
+    assert list(timetables) == _days(date_start, date_end)
+    assert len(_timetable_cache.local) == 7
+
+    _timetable_cache.clear()
+    for date, tt in timetables.items():
+        expected = Timetable(SERVICE, DIRECTION, date)
+        assert tt.date == date
+        assert tt.head == expected.head
+        assert [list(r.times) for r in tt.rows] == [
+            list(r.times) for r in expected.rows
+        ]
+
+
+@pytest.mark.parametrize("frequencies", [False, True])
+def test_timetable_from_range_cached(load_db, monkeypatch, frequencies):
+    _timetable_cache.clear()
+    date_start, date_end = datetime.date(2019, 3, 3), datetime.date(2019, 3, 9)
+    timetables = Timetable.from_range(SERVICE, DIRECTION, date_start, date_end,
+                                      frequencies=frequencies)
+
+    def no_query(*args, **kwargs):
+        raise AssertionError("Timetable should be served from the cache")
+
+    monkeypatch.setattr(timetable, "_query_journeys", no_query)
+    monkeypatch.setattr(timetable, "_query_timetable", no_query)
+    tt = Timetable(SERVICE, DIRECTION, date_start, frequencies=frequencies)
+
+    assert tt.head == timetables[date_start].head
+    assert len(tt.head) == (3 if frequencies else 13)
+
+
+def test_timetable_pages(load_db):
+    _timetable_cache.clear()
+    date = datetime.date(2019, 3, 3)
+    pages = []
+    after = None
+    while True:
+        tt = Timetable(SERVICE, DIRECTION, date, after=after, limit=5)
+        pages.append([h[0] for h in tt.head])
+        if tt.next_page is None:
+            break
+        after = tt.next_page
+
+    assert pages == [
+        [400012 + i for i in range(5)],
+        [400017 + i for i in range(5)],
+        [400022 + i for i in range(3)],
+    ]
+
+
+def test_timetable_pages_exact(load_db):
+    _timetable_cache.clear()
+    date = datetime.date(2019, 3, 3)
+    tt_all = Timetable(SERVICE, DIRECTION, date, limit=13)
+    tt_part = Timetable(SERVICE, DIRECTION, date, limit=12)
+
+    # No next page if the last journey fills the limit
+    assert len(tt_all.head) == 13
+    assert tt_all.next_page is None
+    assert len(tt_part.head) == 12
+    assert tt_part.next_page == (datetime.time(14, 0), 400023)
+
+
+def test_timetable_time_window(load_db):
+    date = datetime.date(2019, 3, 3)
+    tt = Timetable(SERVICE, DIRECTION, date, time_start=datetime.time(9, 0),
+                   time_end=datetime.time(10, 0))
+
+    assert tt.head == [(400013, "ATC", None), (400014, "ATC", None)]
+    assert tt.next_page is None
+
+
+def _departures(*minutes):
+    return [(i, datetime.time(m // 60, m % 60)) for i, m in enumerate(minutes)]
+
+
+@pytest.mark.parametrize("journeys, expected", [
+    (_departures(), []),
+    (_departures(480, 510, 540), []),
+    (_departures(480, 510, 540, 570), [[0, 1, 2, 3]]),
+    (_departures(480, 500, 510, 540, 570, 600), [[2, 3, 4, 5]]),
+    (_departures(480, 510, 540, 570, 580, 590, 600, 610),
+     [[0, 1, 2, 3], [4, 5, 6, 7]]),
+    (_departures(480, 510, 510, 540, 570), []),
+])
+def test_find_frequencies(journeys, expected):
+    runs = _find_frequencies(journeys)
+    assert [[j for j, _ in r] for r in runs] == expected
+
+
+def test_journey_frequency_refreshed(load_db):
+    frequencies = (
+        models.JourneyFrequency.query
+        .filter_by(pattern_ref=110732)
+        .all()
+    )
+
+    assert len(frequencies) == 1
+    assert frequencies[0].id == 400012
+    assert frequencies[0].time_start == datetime.time(8, 30)
+    assert frequencies[0].time_end == datetime.time(14, 30)
+    assert frequencies[0].headway == datetime.timedelta(minutes=30)
+    assert frequencies[0].journeys == [400012 + i for i in range(13)]
+
+
+def test_timetable_frequencies(load_db):
+    _timetable_cache.clear()
+    date = datetime.date(2019, 3, 3)
+    tt = Timetable(SERVICE, DIRECTION, date, frequencies=True)
+
+    assert tt.head == [(400012, "ATC", None), (None, None, None),
+                       (400024, "ATC", None)]
+    assert tt.columns[1].headway == 30
+    assert list(tt.rows[0].times) == [
+        TimetableStop("490000015G", None, "0830", True, None,
+                      datetime.datetime(2019, 3, 3, 8, 30)),
+        None,
+        TimetableStop("490000015G", None, "1430", True, None,
+                      datetime.datetime(2019, 3, 3, 14, 30)),
+    ]
+
+
+def test_timetable_frequencies_expanded(load_db):
+    _timetable_cache.clear()
+    date = datetime.date(2019, 3, 3)
+    collapsed = Timetable(SERVICE, DIRECTION, date, frequencies=True)
+    expanded = Timetable(SERVICE, DIRECTION, date)
+
+    assert len(collapsed.head) == 3
+    assert [h[0] for h in expanded.head] == [400012 + i for i in range(13)]
+
+
+def test_journey_calendar_refreshed(load_db):
+    assert models.JourneyCalendar.query.count() == 26
+    assert not _in_calendar(datetime.date(2019, 3, 3))
+
+
+def test_journey_calendar_dates(load_db):
+    _load_calendar(datetime.date(2019, 3, 1), days=10)
+    calendar = models.JourneyCalendar.query.get(400012)
+
+    assert calendar.date_start == datetime.date(2019, 3, 1)
+    # Runs on Sundays 3rd and 10th March
+    assert calendar.dates == "0010000001"
+    assert _in_calendar(datetime.date(2019, 3, 1))
+    assert _in_calendar(datetime.date(2019, 3, 10))
+    assert not _in_calendar(datetime.date(2019, 3, 11))
+
+
+def test_journey_calendar_range_once_per_request(load_db, app):
+    with app.test_request_context():
+        assert not _in_calendar(datetime.date(2019, 3, 3))
+        _load_calendar(datetime.date(2019, 3, 1), days=10)
+        # Range is kept for the rest of the request
+        assert not _in_calendar(datetime.date(2019, 3, 3))
+
+    assert _in_calendar(datetime.date(2019, 3, 3))
+
+
+@pytest.mark.parametrize("date", [
+    datetime.date(2019, 3, 3),
+    datetime.date(2019, 3, 4),
+    datetime.date(2019, 4, 7),
+    datetime.date(2019, 4, 14),
+    datetime.date(2019, 4, 21),
+    datetime.date(2019, 4, 22),
+    datetime.date(2019, 4, 28),
+])
+def test_journeys_calendar(load_org, date):
+    query = _query_journeys(SERVICE, DIRECTION, date).order_by("departure")
+    expected = query.all()
+
+    _load_calendar(datetime.date(2019, 3, 1))
+    assert _in_calendar(date)
+    query = _query_journeys(SERVICE, DIRECTION, date).order_by("departure")
+
+    assert query.all() == expected
+
+
+@pytest.mark.parametrize("timestamp", [
+    datetime.datetime(2019, 3, 3, 8, 0),
+    datetime.datetime(2019, 4, 7, 8, 0, tzinfo=BST),
+    datetime.datetime(2019, 4, 22, 10, 0, tzinfo=BST),
+    datetime.datetime(2019, 3, 10, 14, 15),
+])
+def test_next_services_calendar(load_db, timestamp):
+    expected = get_next_services("490000015G", timestamp)
+    assert expected
+
+    _load_calendar(datetime.date(2019, 3, 1))
+    result = get_next_services("490000015G", timestamp)
+
+    assert result == expected
+
+
+@pytest.mark.parametrize("timestamp", [
+    datetime.datetime(2019, 3, 3, 8, 0),
+    datetime.datetime(2019, 3, 10, 14, 15),
+])
+def test_next_services_at_stops(load_db, timestamp):
+    codes = ["490000015G", "490008638S", "490000015F"]
+    result = get_next_services_at_stops(codes, timestamp)
+
+    assert list(result) == codes
+    assert result["490000015G"]
+    for code in codes:
+        assert result[code] == get_next_services(code, timestamp)
+
+
+def test_stop_departures_refreshed(load_db):
+    departures = (
+        models.StopDeparture.query
+        .filter_by(journey_ref=400012)
+        .order_by(models.StopDeparture.sequence)
+        .all()
+    )
+
+    assert departures[0].stop_point_ref == "490000015G"
+    assert departures[0].time == datetime.time(8, 30)
+    assert departures[0].t_offset == datetime.timedelta(0)
+
+
+@pytest.mark.parametrize("timestamp, interval, expected", [
+    (datetime.datetime(2019, 3, 3, 8, 0), None,
+     (datetime.time(7, 0), datetime.time(10, 0))),
+    (datetime.datetime(2019, 4, 7, 8, 0, tzinfo=GMT), None,
+     (datetime.time(8, 0), datetime.time(11, 0))),
+    (datetime.datetime(2019, 3, 23, 23, 30), datetime.timedelta(hours=2),
+     (datetime.time(22, 30), datetime.time(2, 30))),
+    (datetime.datetime(2019, 3, 3, 8, 0), datetime.timedelta(hours=22),
+     None),
+])
+def test_departure_time_range(timestamp, interval, expected):
+    assert _departure_time_range(timestamp, interval) == expected
+
+
+def test_next_services_over_midnight(set_night_times):
+    timestamp = datetime.datetime(2019, 3, 23, 23, 50)
+    result = get_next_services("490000015G", timestamp)
+
+    assert [r.expected for r in result] == [
+        datetime.datetime(2019, 3, 24, 0, 15, tzinfo=GMT),
+        datetime.datetime(2019, 3, 24, 0, 45, tzinfo=GMT),
+    ]
@@ -433,6 +433,32 @@ def test_service_timetable_redirect(client, db_loaded):
            in response.location
 
 
+def test_service_timetable_invalid_times(client, db_loaded):
+    response = client.get("/service/dagenham-sunday-market-shuttle/outbound/"
+                          "timetable?date=2019-03-03&start=10:00&end=09:00")
+
+    assert response.status_code == 200
+    assert b"The end of the time range must be after the start." \
+           in response.data
+
+
+def test_service_timetable_page(client, db_loaded):
+    response = client.get("/service/dagenham-sunday-market-shuttle/outbound/"
+                          "timetable?date=2019-03-03&limit=5")
+
+    assert response.status_code == 200
+    assert b"after=103000-400016" in response.data
+
+
+def test_service_timetable_invalid_page(client, db_loaded):
+    response = client.get("/service/dagenham-sunday-market-shuttle/outbound/"
+                          "timetable?date=2019-03-03&limit=5"
+                          "&after=1030-400016")
+
+    assert response.status_code == 200
+    assert b"Invalid page." in response.data
+
+
 def test_postcode(client, db_loaded):
     response = client.get("/near/IG11+7UG")
 